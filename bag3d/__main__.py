@@ -4,8 +4,12 @@ import yaml
 import logging
 
 from bag3d import app
+from bag3d import telemetry
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'perf-report':
+        telemetry.perf_report(sys.argv[2:])
+        return
     here = os.path.abspath(os.path.dirname(__file__))
     with open(os.path.join(here, 'logging.cfg'), 'r') as f:
         log_conf = yaml.safe_load(f)
@@ -18,9 +18,11 @@ from bag3d.config import batch3dfier
 from bag3d.update import bag
 from bag3d.update import ahn
 from bag3d.batch3dfier import process
+from bag3d.batch3dfier import distributed
 from bag3d import importer
 from bag3d import exporter
 from bag3d import quality
+from bag3d import telemetry
 
 from pprint import pformat
 
@@ -40,6 +42,7 @@ def app(cli_args, here, log_conf):
     log_conf['handlers']['console']['level'] = args_in['loglevel']
     log_conf['handlers']['logfile']['filename'] = "bag3d_" + datetime.utcnow().date().isoformat() + ".log"
     log_conf['handlers']['logfile_performance']['filename'] = "bag3d_performance_" + datetime.utcnow().date().isoformat() + ".log"
+    log_conf['handlers']['logfile_telemetry']['filename'] = "bag3d_telemetry_" + datetime.utcnow().date().isoformat() + ".jsonl"
     logging.config.dictConfig(log_conf)
     logger = logging.getLogger(__name__)
 
@@ -62,6 +65,11 @@ def app(cli_args, here, log_conf):
     except Exception as e:
         logger.exception(e)
         sys.exit(1)
+    db.db.slow_query = cfg["database"].get("slow_query", db.db.slow_query)
+    db.db.explain_hot = cfg["database"].get("explain_hot", db.db.explain_hot)
+    db.db.ddl_batch_size = cfg["database"].get("ddl_batch_size", db.db.ddl_batch_size)
+    db.db.ddl_connections = cfg["database"].get("ddl_connections", db.db.ddl_connections)
+    db.db.copy_connections = cfg["database"].get("copy_connections", db.db.copy_connections)
     
     try:
         # well, let's assume the user provided the AHN3 dir first
@@ -71,143 +79,219 @@ def app(cli_args, here, log_conf):
         ahn2_dir = cfg["input_elevation"]["dataset_dir"][1]
 
 
+        if args_in['worker']:
+            with telemetry.stage('worker', profile_dir=args_in['profile']):
+                logger.info("Running as a worker node")
+                distributed.run_worker(conn, threads=cfg["threads"], 
+                                       doexec=args_in['no_exec'])
+
+
         if args_in['update_bag']:
-            logger.info("Updating BAG database")
-            # At this point an empty database should exists, restore_BAG 
-            # takes care of the rest
-            bag.restore_BAG(cfg["database"], doexec=args_in['no_exec'])
+            with telemetry.stage('update_bag', profile_dir=args_in['profile']):
+                logger.info("Updating BAG database")
+                # At this point an empty database should exists, restore_BAG 
+                # takes care of the rest
+                bag.restore_BAG(cfg["database"], jobs=args_in['restore_jobs'],
+                                staging=args_in['restore_staging'],
+                                doexec=args_in['no_exec'])
 
 
         if args_in['update_ahn']:
-            logger.info("Updating AHN files")
+            with telemetry.stage('update_ahn', profile_dir=args_in['profile']):
+                logger.info("Updating AHN files")
 
-            ahn.download(path_lasinfo=cfg['path_lasinfo'],
-                         ahn3_dir=ahn3_dir, 
-                         ahn2_dir=ahn2_dir, 
-                         tile_index_file=cfg["elevation"]["file"],
-                         ahn3_file_pat=ahn3_fp,
-                         ahn2_file_pat=ahn2_fp)
+                ahn.download(path_lasinfo=cfg['path_lasinfo'],
+                             ahn3_dir=ahn3_dir, 
+                             ahn2_dir=ahn2_dir, 
+                             tile_index_file=cfg["elevation"]["file"],
+                             ahn3_file_pat=ahn3_fp,
+                             ahn2_file_pat=ahn2_fp,
+                             path_lasindex=cfg['path_lasindex'],
+                             threads=cfg['threads'])
+
+
+        if args_in['index_pointclouds']:
+            with telemetry.stage('index_pointclouds', profile_dir=args_in['profile']):
+                logger.info("Indexing the point cloud files")
+                if cfg['path_lasindex']:
+                    ahn.index_pointclouds(cfg['path_lasindex'], 
+                                          cfg["input_elevation"]["dataset_dir"],
+                                          threads=cfg['threads'],
+                                          doexec=args_in['no_exec'])
+                else:
+                    logger.error("path_lasindex is not set in the configuration")
 
 
         if args_in['update_ahn_raster']:
-            logger.info("Updating AHN 0.5m raster files")
-            ahn.download_raster(conn, cfg, 
-                                cfg["quality"]["ahn2_rast_dir"], 
-                                cfg["quality"]["ahn3_rast_dir"], 
-                                doexec=args_in['no_exec'])
+            with telemetry.stage('update_ahn_raster', profile_dir=args_in['profile']):
+                logger.info("Updating AHN 0.5m raster files")
+                ahn.download_raster(conn, cfg, 
+                                    cfg["quality"]["ahn2_rast_dir"], 
+                                    cfg["quality"]["ahn3_rast_dir"], 
+                                    threads=cfg['threads'],
+                                    doexec=args_in['no_exec'])
     
         if args_in['import_tile_idx']:
-            logger.info("Importing BAG tile index")
-            bag.import_index(cfg['polygons']["file"], cfg["database"]["dbname"], 
-                             cfg['polygons']["schema"], str(cfg["database"]["host"]), 
-                             str(cfg["database"]["port"]), cfg["database"]["user"], 
-                             cfg["database"]["pw"],
-                             doexec=args_in['no_exec'])
-            # Update BAG tiles to include the lower/left boundary
-            footprints.update_tile_index(conn,
+            with telemetry.stage('import_tile_idx', profile_dir=args_in['profile']):
+                logger.info("Importing BAG tile index")
+                # The lower/left boundary of the BAG tiles is added while loading
+                bag.load_index(conn, cfg['polygons']["file"],
+                               cfg['polygons']["schema"], cfg['polygons']["table"],
+                               fields_index=[cfg['polygons']["fields"]["primary_key"],
+                                             cfg['polygons']["fields"]["geometry"]],
+                               border=True,
+                               doexec=args_in['no_exec'])
+                logger.info("Partitioning the BAG")
+                logger.debug("Creating centroids")
+                footprints.create_centroids(conn,
+                                            table_centroid=[cfg['footprints']["schema"], 
+                                                            "pand_centroid"],
+                                            table_footprint=[cfg['footprints']["schema"], 
+                                                             cfg['footprints']["table"]],
+                                            fields_footprint=[cfg['footprints']["fields"]["primary_key"], 
+                                                              cfg['footprints']["fields"]["geometry"]]
+                                            )
+                logger.debug("Creating tiles")
+                footprints.create_views(conn, schema_tiles=cfg['tile_schema'], 
                                          table_index=[cfg['polygons']["schema"], 
                                                       cfg['polygons']["table"]],
                                          fields_index=[cfg['polygons']["fields"]["primary_key"], 
                                                        cfg['polygons']["fields"]["geometry"], 
-                                                       cfg['polygons']["fields"]["unit_name"]]
-                                         )
-            logger.info("Partitioning the BAG")
-            logger.debug("Creating centroids")
-            footprints.create_centroids(conn,
-                                        table_centroid=[cfg['footprints']["schema"], 
-                                                        "pand_centroid"],
-                                        table_footprint=[cfg['footprints']["schema"], 
-                                                         cfg['footprints']["table"]],
-                                        fields_footprint=[cfg['footprints']["fields"]["primary_key"], 
-                                                          cfg['footprints']["fields"]["geometry"]]
-                                        )
-            logger.debug("Creating tiles")
-            footprints.create_views(conn, schema_tiles=cfg['tile_schema'], 
-                                     table_index=[cfg['polygons']["schema"], 
-                                                  cfg['polygons']["table"]],
-                                     fields_index=[cfg['polygons']["fields"]["primary_key"], 
-                                                   cfg['polygons']["fields"]["geometry"], 
-                                                   cfg['polygons']["fields"]["unit_name"]],
-                                     table_centroid=[cfg['footprints']["schema"], "pand_centroid"],
-                                     fields_centroid=[cfg['footprints']["fields"]["primary_key"], 
-                                                      "geom"],
-                                     table_footprint=[cfg['footprints']["schema"], 
-                                                      cfg['footprints']["table"]],
-                                     fields_footprint=[cfg['footprints']["fields"]["primary_key"], 
-                                                       cfg['footprints']["fields"]["geometry"],
-                                                       cfg['footprints']["fields"]["uniqueid"]
-                                                       ],
-                                     prefix_tiles=cfg['prefix_tile_footprint'])
+                                                       cfg['polygons']["fields"]["unit_name"]],
+                                         table_centroid=[cfg['footprints']["schema"], "pand_centroid"],
+                                         fields_centroid=[cfg['footprints']["fields"]["primary_key"], 
+                                                          "geom"],
+                                         table_footprint=[cfg['footprints']["schema"], 
+                                                          cfg['footprints']["table"]],
+                                         fields_footprint=[cfg['footprints']["fields"]["primary_key"], 
+                                                           cfg['footprints']["fields"]["geometry"],
+                                                           cfg['footprints']["fields"]["uniqueid"]
+                                                           ],
+                                         prefix_tiles=cfg['prefix_tile_footprint'])
             
-            logger.info("Importing AHN tile index")
-            bag.import_index(cfg['elevation']["file"], cfg["database"]["dbname"], 
-                             cfg['elevation']["schema"], str(cfg["database"]["host"]), 
-                             str(cfg["database"]["port"]), cfg["database"]["user"], 
-                             cfg["database"]["pw"],
-                             doexec=args_in['no_exec'])
+                logger.info("Importing AHN tile index")
+                bag.load_index(conn, cfg['elevation']["file"],
+                               cfg['elevation']["schema"], cfg['elevation']["table"],
+                               fields_index=[cfg['elevation']["fields"]["primary_key"],
+                                             cfg['elevation']["fields"]["geometry"]],
+                               doexec=args_in['no_exec'])
+                logger.info("Updating AHN tile adjacency")
+                border.update_adjacency_table(conn, cfg, 
+                                              doexec=args_in['no_exec'])
 
 
         if args_in['add_borders']:
-            logger.info("Configuring AHN2-3 border tiles")
-            border.create_border_table(conn, cfg, 
-                                       doexec=args_in['no_exec'])
-            border.update_file_date(conn, cfg, ahn2_dir, ahn2_fp, 
-                                    doexec=args_in['no_exec'])
+            with telemetry.stage('add_borders', profile_dir=args_in['profile']):
+                logger.info("Configuring AHN2-3 border tiles")
+                border.create_border_table(conn, cfg, 
+                                           doexec=args_in['no_exec'])
+                border.update_file_date(conn, cfg, ahn2_dir, ahn2_fp, 
+                                        doexec=args_in['no_exec'])
 
 
         if args_in['run_3dfier']:
-            logger.info("Configuring batch3dfier")
-            clip_prefix = "_clip3dfy_"
-            logger.debug("clip_prefix is %s", clip_prefix)
-            cfg_out = batch3dfier.configure_tiles(conn, cfg, clip_prefix)
-            cfg_rest, cfg_ahn2, cfg_ahn3 = border.process(conn, cfg_out, ahn3_dir, 
-                                                          ahn2_dir, 
-                                                          export=False)
-            for c in [cfg_rest, cfg_ahn2, cfg_ahn3]:
-                # clean up previous files
-                if os.path.isdir(c["output"]["dir"]):
-                    rmtree(c["output"]["dir"], ignore_errors=True, onerror=None)
-                    logger.debug("Deleted %s", c["output"]["dir"])
-                try:
-                    os.makedirs(c["output"]["dir"], exist_ok=False)
-                    logger.debug("Created %s", c["output"]["dir"])
-                except Exception as e:
-                    logger.error(e)
-                    sys.exit(1)
+            with telemetry.stage('run_3dfier', profile_dir=args_in['profile']):
+                logger.info("Configuring batch3dfier")
+                clip_prefix = "_clip3dfy_"
+                logger.debug("clip_prefix is %s", clip_prefix)
+                cfg_out = batch3dfier.configure_tiles(conn, cfg, clip_prefix)
+                cfg_rest, cfg_ahn2, cfg_ahn3 = border.process(conn, cfg_out, ahn3_dir, 
+                                                              ahn2_dir, 
+                                                              export=False)
+                configs = [cfg_rest, cfg_ahn2, cfg_ahn3]
+                for c in configs:
+                    # clean up previous files
+                    if os.path.isdir(c["output"]["dir"]):
+                        rmtree(c["output"]["dir"], ignore_errors=True, onerror=None)
+                        logger.debug("Deleted %s", c["output"]["dir"])
+                    try:
+                        os.makedirs(c["output"]["dir"], exist_ok=False)
+                        logger.debug("Created %s", c["output"]["dir"])
+                    except Exception as e:
+                        logger.error(e)
+                        sys.exit(1)
                 
-                logger.info("Running batch3dfier")
-                res = process.run(conn, c, doexec=args_in['no_exec'])
+                if args_in['coordinator']:
+                    logger.info("Queueing tiles for the worker nodes")
+                    if args_in['no_exec']:
+                        distributed.create_queue_tables(conn)
+                        distributed.start_run(conn)
+                    def run(configs):
+                        return distributed.run_coordinator(conn, configs, 
+                                                           doexec=args_in['no_exec'])
+                else:
+                    logger.info("Running batch3dfier")
+                    def run(configs):
+                        return process.run_groups(conn, configs, 
+                                                  doexec=args_in['no_exec'])
+                res = run(configs)
                 
                 restart = 0
                 while restart < 3:
-                    if res is None:
+                    failed = [c for c in configs 
+                              if res.get(process.get_tile_group(c))]
+                    if len(failed) == 0:
                         break
-                    elif len(res) == 0:
-                        break
-                    elif len(res) > 0:
-                        restart += 1
-                        logger.info("Restarting 3dfier with tiles %s", res)
-                        c["input_polygons"]["tile_list"] = res
-                        res = process.run(conn, c, doexec=args_in['no_exec'])
+                    restart += 1
+                    for c in failed:
+                        tiles = res[process.get_tile_group(c)]
+                        logger.info("Restarting 3dfier with tiles %s", tiles)
+                        c["input_polygons"]["tile_list"] = list(tiles)
+                    res.update(run(failed))
+                if args_in['coordinator'] and args_in['no_exec']:
+                    # let the workers exit, if the coordinator dies before 
+                    # this the run becomes stale
+                    distributed.finish_run(conn)
                 
-                if not os.listdir(c["output"]["dir"]):
-                    logger.warning("3dfier failed completely for %s, skipping import", 
-                                   c["config"]["in"])
+                if args_in['border_merge']:
+                    to_import = [cfg_rest]
                 else:
-                    logger.info("Importing batch3dfier output into database")
-                    importer.import_csv(conn, c)
-            
-            logger.info("Joining 3D tables")
-            importer.unite_border_tiles(conn, cfg["output"]["schema"], 
-                                        cfg_ahn2["output"]["bag3d_table"], 
-                                        cfg_ahn3["output"]["bag3d_table"])
-            importer.create_bag3d_table(conn, cfg["output"]["schema"],
-                                        cfg["output"]["bag3d_table"])
+                    to_import = configs
+                for c in to_import:
+                    if not os.listdir(c["output"]["dir"]):
+                        logger.warning("3dfier failed completely for %s, skipping import", 
+                                       c["config"]["in"])
+                    else:
+                        logger.info("Importing batch3dfier output into database")
+                        importer.import_csv(conn, c)
             
-            logger.info("Cleaning up")
-            importer.drop_border_view(conn, cfg["output"]["schema"])
-            for c in [cfg_rest, cfg_ahn2, cfg_ahn3]:
-                importer.drop_border_table(conn, c)
+                # the spatial order of the rows of the 3D BAG table
+                order = cfg["output"].get("order")
+                if order == 'none':
+                    order = None
+                brin = cfg["output"].get("brin", False)
+                if args_in['border_merge']:
+                    logger.info("Importing and merging the AHN2 and AHN3 border tiles")
+                    cfg_border = importer.merge_border_csv(conn, cfg_ahn2, cfg_ahn3)
+                    logger.info("Joining 3D tables")
+                    importer.create_bag3d_table(conn, cfg["output"]["schema"],
+                                                cfg["output"]["bag3d_table"],
+                                                border=cfg_border["output"]["bag3d_table"],
+                                                order=order, brin=brin)
+                    if cfg["output"].get("compact"):
+                        importer.create_compact_table(conn, cfg["output"]["schema"],
+                                                      cfg["output"]["bag3d_table"],
+                                                      order=order, brin=brin)
+                    logger.info("Cleaning up")
+                    for c in [cfg_rest, cfg_border]:
+                        importer.drop_border_table(conn, c)
+                else:
+                    logger.info("Joining 3D tables")
+                    importer.unite_border_tiles(conn, cfg["output"]["schema"], 
+                                                cfg_ahn2["output"]["bag3d_table"], 
+                                                cfg_ahn3["output"]["bag3d_table"])
+                    importer.create_bag3d_table(conn, cfg["output"]["schema"],
+                                                cfg["output"]["bag3d_table"],
+                                                order=order, brin=brin)
+                    if cfg["output"].get("compact"):
+                        importer.create_compact_table(conn, cfg["output"]["schema"],
+                                                      cfg["output"]["bag3d_table"],
+                                                      order=order, brin=brin)
+                
+                    logger.info("Cleaning up")
+                    importer.drop_border_view(conn, cfg["output"]["schema"])
+                    for c in [cfg_rest, cfg_ahn2, cfg_ahn3]:
+                        importer.drop_border_table(conn, c)
 
 
         if args_in["grant_access"]:
@@ -217,22 +301,25 @@ def app(cli_args, here, log_conf):
 
 
         if args_in['export']:
-            logger.info("Exporting 3D BAG")
-            exporter.csv(conn, cfg, cfg["output"]["dir"])
-            exporter.gpkg(conn, cfg, cfg["output"]["dir"], args_in['no_exec'])
-            exporter.postgis(conn, cfg, cfg["output"]["dir"], args_in['no_exec'])
+            with telemetry.stage('export', profile_dir=args_in['profile']):
+                logger.info("Exporting 3D BAG")
+                exporter.csv(conn, cfg, cfg["output"]["dir"])
+                exporter.gpkg(conn, cfg, cfg["output"]["dir"], args_in['no_exec'])
+                exporter.postgis(conn, cfg, cfg["output"]["dir"], args_in['no_exec'])
 
 
         if args_in["quality"]:
-            logger.info("Checking 3D BAG quality")
-#             cfg_quality = quality.create_quality_views(conn, cfg)
-            quality.create_quality_table(conn)
-            counts = quality.get_counts(conn, cfg)
-            building_per_tile = quality.buildings_per_tile(conn, cfg)
-            quality.update_quality_table(conn, counts, building_per_tile)
+            with telemetry.stage('quality', profile_dir=args_in['profile']):
+                logger.info("Checking 3D BAG quality")
+#                 cfg_quality = quality.create_quality_views(conn, cfg)
+                quality.create_quality_table(conn)
+                quality.create_tile_quality_table(conn)
+                counts = quality.get_counts(conn, cfg)
+                building_per_tile = quality.buildings_per_tile(conn, cfg)
+                quality.update_quality_table(conn, counts, building_per_tile)
 
 
-        # Clean up
+        # Clean up, including the cached 3dfier configs of the tiles
         for c in [cfg['config']['out_border_ahn2'], 
                   cfg['config']['out_border_ahn3'],
                   cfg['config']['out_rest']]:
@@ -268,5 +355,8 @@ def app(cli_args, here, log_conf):
     except Exception as e:
         logger.exception(e)
     finally:
+        if db.query_stats():
+            logger.info("Queries with the most total time:\n%s", 
+                        db.query_report())
         conn.close()
         logging.shutdown()
@@ -0,0 +1,628 @@
+# -*- coding: utf-8 -*-
+
+"""Distributed execution of the 3dfier tiles on multiple worker nodes
+
+The coordinator puts the tiles into a queue table in the database. The
+workers claim the tiles one by one with ``SELECT ... FOR UPDATE SKIP LOCKED``,
+renew the heartbeat of their claimed tiles while 3dfier is running, and
+upload the CSV output into the queue table. When all tiles are finished,
+the coordinator writes the CSV files into output:dir, from where they are
+imported as usual.
+
+A tile whose heartbeat is older than *stale_after* seconds is considered
+abandoned (eg. the worker node died) and can be claimed by another worker.
+
+The coordinator marks the run as active in the run table for as long as it
+queues tile groups (see :py:func:`start_run` and :py:func:`finish_run`), and
+the workers wait for new tiles until the run is finished. The workers also
+renew their own heartbeat in the worker table, from which the coordinator 
+knows if there is any worker left to process the queued tiles.
+"""
+
+import os
+import json
+import socket
+import tempfile
+import threading
+import logging
+from time import sleep, perf_counter
+from shutil import rmtree
+
+from psycopg2 import sql
+from psycopg2.extras import Json
+
+from bag3d.config import db
+from bag3d.config import batch3dfier
+from bag3d.batch3dfier import process
+from bag3d import telemetry
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SCHEMA = "public"
+QUEUE_TABLE = "bag3d_tile_queue"
+CONFIG_TABLE = "bag3d_tile_queue_config"
+RUN_TABLE = "bag3d_tile_queue_run"
+WORKER_TABLE = "bag3d_tile_queue_worker"
+
+
+def _dumps(obj):
+    return json.dumps(obj, default=str)
+
+
+def shared_config(config):
+    """The configuration without the database connection parameters
+    
+    The configuration of a tile group is stored in the database and read by 
+    the workers, which connect to the database with their own settings. 
+    Thus the credentials of the coordinator are not stored.
+    """
+    return {k: v for k,v in config.items() if k != "database"}
+
+
+def create_queue_tables(conn):
+    """Create the tile queue and the table of the tile group configurations
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    """
+    query = sql.SQL("""
+    CREATE TABLE IF NOT EXISTS {schema}.{config_table} (
+        tile_group text PRIMARY KEY,
+        config jsonb
+    );
+    CREATE TABLE IF NOT EXISTS {schema}.{queue} (
+        tile_group text REFERENCES {schema}.{config_table} ON DELETE CASCADE,
+        tile text,
+        status text DEFAULT 'pending',
+        worker text,
+        attempts int DEFAULT 0,
+        queued_at timestamptz DEFAULT now(),
+        heartbeat timestamptz,
+        finished_at timestamptz,
+        result text,
+        PRIMARY KEY (tile_group, tile)
+    );
+    CREATE INDEX IF NOT EXISTS {idx} ON {schema}.{queue} (status);
+    CREATE TABLE IF NOT EXISTS {schema}.{run_table} (
+        id int PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+        status text,
+        heartbeat timestamptz
+    );
+    CREATE TABLE IF NOT EXISTS {schema}.{worker_table} (
+        worker text PRIMARY KEY,
+        heartbeat timestamptz
+    );
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                queue=sql.Identifier(QUEUE_TABLE),
+                config_table=sql.Identifier(CONFIG_TABLE),
+                run_table=sql.Identifier(RUN_TABLE),
+                worker_table=sql.Identifier(WORKER_TABLE),
+                idx=sql.Identifier(QUEUE_TABLE + "_status_idx"))
+    logger.debug(conn.print_query(query))
+    conn.sendQuery(query)
+
+
+def start_run(conn):
+    """Mark the run as active, so that the workers wait for the tiles
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    """
+    query = sql.SQL("""
+    INSERT INTO {schema}.{run_table} (id, status, heartbeat)
+    VALUES (1, 'running', now())
+    ON CONFLICT (id) DO UPDATE SET status = 'running', heartbeat = now();
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                run_table=sql.Identifier(RUN_TABLE))
+    logger.debug(conn.print_query(query))
+    conn.sendQuery(query)
+
+
+def touch_run(conn):
+    """Renew the heartbeat of the active run"""
+    query = sql.SQL("""
+    UPDATE {schema}.{run_table} SET heartbeat = now() WHERE status = 'running';
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                run_table=sql.Identifier(RUN_TABLE))
+    conn.sendQuery(query)
+
+
+def finish_run(conn):
+    """Mark the run as finished, so that the workers exit when idle
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    """
+    query = sql.SQL("""
+    UPDATE {schema}.{run_table} SET status = 'finished', heartbeat = now();
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                run_table=sql.Identifier(RUN_TABLE))
+    logger.debug(conn.print_query(query))
+    conn.sendQuery(query)
+
+
+def run_active(conn, stale_after=600):
+    """Is there an active run?
+
+    A run whose coordinator has not renewed its heartbeat in *stale_after*
+    seconds is considered abandoned.
+
+    Returns
+    -------
+    bool
+    """
+    query = sql.SQL("""
+    SELECT count(*) FROM {schema}.{run_table}
+    WHERE status = 'running'
+    AND heartbeat >= now() - {stale} * INTERVAL '1 second';
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                run_table=sql.Identifier(RUN_TABLE),
+                stale=sql.Literal(stale_after))
+    return conn.getQuery(query)[0][0] > 0
+
+
+def live_workers(conn, stale_after=600):
+    """Nr. of workers that renewed their heartbeat in *stale_after* seconds"""
+    query = sql.SQL("""
+    SELECT count(*) FROM {schema}.{worker_table}
+    WHERE heartbeat >= now() - {stale} * INTERVAL '1 second';
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                worker_table=sql.Identifier(WORKER_TABLE),
+                stale=sql.Literal(stale_after))
+    return conn.getQuery(query)[0][0]
+
+
+def enqueue(conn, config, tile_group):
+    """Put the tiles of a configuration into the queue
+
+    The previous entries of the tile group are replaced. The configuration is
+    stored without the database section, see :py:func:`shared_config`.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    config : dict
+        bag3d configuration, as returned by :py:func:`bag3d.config.border.process`
+    tile_group : str
+        Name of the tile group
+    """
+    tiles = config["input_polygons"]["tile_list"]
+    with conn.conn:
+        with conn.conn.cursor() as cur:
+            cur.execute(sql.SQL("""
+            DELETE FROM {schema}.{config_table} WHERE tile_group = %s;
+            INSERT INTO {schema}.{config_table} (tile_group, config)
+            VALUES (%s, %s);
+            INSERT INTO {schema}.{queue} (tile_group, tile)
+            SELECT %s, unnest(%s::text[]);
+            """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                        queue=sql.Identifier(QUEUE_TABLE),
+                        config_table=sql.Identifier(CONFIG_TABLE)),
+                        [tile_group, tile_group,
+                         Json(shared_config(config), dumps=_dumps),
+                         tile_group, tiles])
+    logger.info("Queued %s tiles of %s", len(tiles), tile_group)
+
+
+def claim_tile(conn, worker, stale_after=600):
+    """Claim the next pending or abandoned tile
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    worker : str
+        Name of the worker
+    stale_after : int
+        Seconds after a running tile without a heartbeat is considered
+        abandoned
+
+    Returns
+    -------
+    tuple or None
+        (tile_group, tile) or None if there is no tile to claim
+    """
+    query = sql.SQL("""
+    UPDATE {schema}.{queue} q
+    SET
+        status = 'running',
+        worker = {worker},
+        attempts = q.attempts + 1,
+        heartbeat = now()
+    FROM (
+        SELECT tile_group, tile
+        FROM {schema}.{queue}
+        WHERE status = 'pending'
+        OR (
+            status = 'running'
+            AND heartbeat < now() - {stale} * INTERVAL '1 second'
+        )
+        ORDER BY queued_at
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ) c
+    WHERE q.tile_group = c.tile_group AND q.tile = c.tile
+    RETURNING q.tile_group, q.tile;
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                queue=sql.Identifier(QUEUE_TABLE),
+                worker=sql.Literal(worker),
+                stale=sql.Literal(stale_after))
+    r = conn.getQuery(query)
+    if r:
+        return r[0]
+    else:
+        return None
+
+
+def heartbeat(conn, worker):
+    """Renew the heartbeat of a worker and of the tiles that are running on it"""
+    query = sql.SQL("""
+    INSERT INTO {schema}.{worker_table} (worker, heartbeat)
+    VALUES ({worker}, now())
+    ON CONFLICT (worker) DO UPDATE SET heartbeat = now();
+    UPDATE {schema}.{queue}
+    SET heartbeat = now()
+    WHERE worker = {worker} AND status = 'running';
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                queue=sql.Identifier(QUEUE_TABLE),
+                worker_table=sql.Identifier(WORKER_TABLE),
+                worker=sql.Literal(worker))
+    conn.sendQuery(query)
+
+
+def complete_tile(conn, tile_group, tile, worker, out_path, max_attempts=3):
+    """Upload the result of a tile and mark it as done
+
+    If there is no output, the tile is put back into the queue, or marked as
+    failed after max_attempts.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    tile_group : str
+        Name of the tile group
+    tile : str
+        Name of the tile
+    worker : str
+        Name of the worker
+    out_path : str or None
+        Path to the CSV output of 3dfier
+    max_attempts : int
+        Nr. of attempts before a tile is marked as failed
+    """
+    result = None
+    if out_path and os.path.isfile(out_path):
+        with open(out_path, "r") as f_in:
+            result = f_in.read()
+    if result is not None:
+        status = sql.SQL("'done'")
+    else:
+        status = sql.SQL("""CASE WHEN attempts >= {m} THEN 'failed'
+                            ELSE 'pending' END""").format(
+                                m=sql.Literal(max_attempts))
+    with conn.conn:
+        with conn.conn.cursor() as cur:
+            cur.execute(sql.SQL("""
+            UPDATE {schema}.{queue}
+            SET
+                status = {status},
+                result = %s,
+                finished_at = now()
+            WHERE tile_group = %s AND tile = %s AND worker = %s;
+            """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                        queue=sql.Identifier(QUEUE_TABLE),
+                        status=status),
+                        [result, tile_group, tile, worker])
+
+
+def get_group_config(conn, tile_group):
+    """Get the configuration of a tile group from the queue"""
+    query = sql.SQL("""
+    SELECT config FROM {schema}.{config_table} WHERE tile_group = {g};
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                config_table=sql.Identifier(CONFIG_TABLE),
+                g=sql.Literal(tile_group))
+    return conn.getQuery(query)[0][0]
+
+
+def get_status(conn, tile_group=None):
+    """Count the tiles per status
+
+    Returns
+    -------
+    dict
+        {status : count}
+    """
+    if tile_group:
+        where = sql.SQL("WHERE tile_group = {}").format(sql.Literal(tile_group))
+    else:
+        where = sql.SQL("")
+    query = sql.SQL("""
+    SELECT status, count(*) FROM {schema}.{queue} {where} GROUP BY status;
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                queue=sql.Identifier(QUEUE_TABLE),
+                where=where)
+    return dict(conn.getQuery(query))
+
+
+def worker_loop(conn, worker, poll=10, stale_after=600, doexec=True):
+    """Claim and process tiles until the run is finished and the queue is empty
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection, used only by this loop
+    worker : str
+        Name of the worker
+    poll : int
+        Seconds to wait before checking the queue again if there is no tile
+        to claim, but the run is active or some tiles are still running on 
+        other workers
+    stale_after : int
+        Passed to :py:func:`claim_tile` and :py:func:`run_active`
+
+    Returns
+    -------
+    int
+        Nr. of tiles processed
+    """
+    groups = {}
+    work_dir = tempfile.mkdtemp(prefix="bag3d_" + worker + "_")
+    processed = 0
+    try:
+        while True:
+            claimed = claim_tile(conn, worker, stale_after)
+            if claimed is None:
+                status = get_status(conn)
+                if status.get('pending', 0) + status.get('running', 0) == 0 \
+                        and not run_active(conn, stale_after):
+                    break
+                sleep(poll)
+                continue
+            tile_group, tile = claimed
+            try:
+                if tile_group not in groups:
+                    c = get_group_config(conn, tile_group)
+                    pc_name_map = batch3dfier.pc_name_dict(
+                        c["input_elevation"]["dataset_dir"],
+                        c["input_elevation"]["dataset_name"])
+                    groups[tile_group] = (c, 
+                                          batch3dfier.pc_file_index(pc_name_map))
+                c, pc_file_idx = groups[tile_group]
+                logger.debug("%s processing %s of %s", worker, tile, tile_group)
+                t = process.lift_tile(conn, c, tile, worker, pc_file_idx, 
+                                      tile_group, yml_dir=work_dir, 
+                                      output_dir=work_dir, doexec=doexec)
+            except Exception:
+                # count the attempt, so that the tile is not left 'running' 
+                # and is retried or failed as any other tile without output
+                logger.exception("%s failed to process %s of %s", worker, tile,
+                                 tile_group)
+                conn.conn.rollback()
+                complete_tile(conn, tile_group, tile, worker, None)
+                continue
+            telemetry.record('tile', group=tile_group, tile=tile, 
+                             thread=worker, **t['stats'])
+            complete_tile(conn, tile_group, tile, worker, t['out_path'])
+            if t['out_path'] and os.path.isfile(t['out_path']):
+                os.remove(t['out_path'])
+            processed += 1
+    finally:
+        rmtree(work_dir, ignore_errors=True)
+    return processed
+
+
+def run_worker(conn, threads=1, poll=10, stale_after=600, doexec=True):
+    """Run a worker node
+
+    Starts *threads* worker loops, each with its own database connection,
+    and a heartbeat thread that renews the heartbeat of the workers and 
+    their claimed tiles every stale_after/3 seconds. A worker loop that 
+    exits is removed from the heartbeat.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection, its parameters are used for the new connections
+    threads : int
+        Nr. of tiles to process in parallel
+
+    Returns
+    -------
+    int
+        Nr. of tiles processed
+    """
+    host = socket.gethostname()
+    stop = threading.Event()
+    create_queue_tables(conn)
+
+    def new_conn():
+        return db.db(dbname=conn.dbname, host=conn.host, port=conn.port,
+                     user=conn.user, password=conn.password)
+
+    workers = ["{h}-{p}-{t}".format(h=host, p=os.getpid(), t=t + 1)
+               for t in range(threads)]
+    alive = set(workers)
+    alive_lock = threading.Lock()
+    counts = []
+
+    def beat():
+        hb_conn = new_conn()
+        try:
+            while True:
+                with alive_lock:
+                    beating = sorted(alive)
+                for w in beating:
+                    heartbeat(hb_conn, w)
+                if stop.wait(max(stale_after // 3, 1)):
+                    break
+        finally:
+            hb_conn.close()
+
+    def work(w):
+        try:
+            c = new_conn()
+            try:
+                counts.append(worker_loop(c, w, poll, stale_after, doexec))
+            finally:
+                c.close()
+        finally:
+            # a dead worker must not keep renewing its tile, so that the tile
+            # can be claimed again once it is stale
+            with alive_lock:
+                alive.discard(w)
+
+    hb = threading.Thread(target=beat, daemon=True)
+    hb.start()
+    threads_ = [threading.Thread(target=work, args=(w,)) for w in workers]
+    for t in threads_:
+        t.start()
+    for t in threads_:
+        t.join()
+    stop.set()
+    hb.join()
+    logger.info("Worker %s processed %s tiles", host, sum(counts))
+    return sum(counts)
+
+
+def run_coordinator(conn, configs, poll=30, stale_after=600, timeout=None,
+                    doexec=True):
+    """Queue the tiles of several configurations and collect the results
+
+    Drop-in replacement of :py:func:`bag3d.batch3dfier.process.run_groups` 
+    that distributes the tiles to the worker nodes. The tiles of all the 
+    configurations are queued before waiting for the results. The run must 
+    be started with :py:func:`start_run` and finished with 
+    :py:func:`finish_run` around the calls of this function, so that the 
+    workers do not exit between the calls (eg. when the failed tiles are 
+    restarted).
+    
+    The waiting stops when there is no live worker for *stale_after* 
+    seconds, or after *timeout* seconds. The tiles that are not finished by 
+    then are marked as failed.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    configs : list of dict
+        bag3d configurations, as returned by :py:func:`bag3d.config.border.process`
+    poll : int
+        Seconds between checking the status of the queue
+    stale_after : int
+        Seconds after a worker without a heartbeat is considered dead
+    timeout : int
+        Seconds to wait for the results at most, no limit if None
+
+    Returns
+    -------
+    dict
+        {tile group : set of the tiles that failed}, None for a 
+        configuration with an empty tile_list
+    """
+    res = {}
+    groups = {}
+    create_queue_tables(conn)
+    for config in configs:
+        tile_group = process.get_tile_group(config)
+        if config["input_polygons"]["tile_list"] is None:
+            logger.error("tile_list in %s is empty, skipping", 
+                         config["config"]["in"])
+            res[tile_group] = None
+            continue
+        enqueue(conn, config, tile_group)
+        groups[tile_group] = config
+    if not doexec or not groups:
+        res.update({g: set() for g in groups})
+        return res
+
+    start = perf_counter()
+    no_worker = None
+    while True:
+        touch_run(conn)
+        status = {g: get_status(conn, g) for g in groups}
+        logger.info("Queue: %s", status)
+        if sum(s.get('pending', 0) + s.get('running', 0) 
+               for s in status.values()) == 0:
+            break
+        if live_workers(conn, stale_after) > 0:
+            no_worker = None
+        elif no_worker is None:
+            no_worker = perf_counter()
+        if no_worker is not None and perf_counter() - no_worker >= stale_after:
+            logger.error("There is no live worker for %s seconds, stopping", 
+                         stale_after)
+            fail_unfinished(conn, list(groups))
+            break
+        if timeout is not None and perf_counter() - start >= timeout:
+            logger.error("Timeout after %s seconds, stopping", timeout)
+            fail_unfinished(conn, list(groups))
+            break
+        sleep(poll)
+
+    for tile_group,config in groups.items():
+        res[tile_group] = collect_results(conn, config, tile_group)
+    return res
+
+
+def fail_unfinished(conn, tile_groups):
+    """Mark the pending and running tiles of the tile groups as failed"""
+    query = sql.SQL("""
+    UPDATE {schema}.{queue}
+    SET status = 'failed', finished_at = now()
+    WHERE tile_group = ANY({g}) AND status IN ('pending', 'running');
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                queue=sql.Identifier(QUEUE_TABLE),
+                g=sql.Literal(tile_groups))
+    logger.debug(conn.print_query(query))
+    conn.sendQuery(query)
+
+
+def collect_results(conn, config, tile_group):
+    """Write the CSV output of the finished tiles of a tile group into 
+    output:dir
+
+    Returns
+    -------
+    set of str
+        The tiles that failed
+    """
+    query = sql.SQL("""
+    SELECT tile, status, result
+    FROM {schema}.{queue}
+    WHERE tile_group = {g};
+    """).format(schema=sql.Identifier(QUEUE_SCHEMA),
+                queue=sql.Identifier(QUEUE_TABLE),
+                g=sql.Literal(tile_group))
+    tiles_skipped = set()
+    with conn.conn:
+        with conn.conn.cursor(name="tile_queue_results", withhold=True) as cur:
+            cur.itersize = 10
+            cur.execute(query)
+            for tile, status, result in cur:
+                if status == 'done' and result is not None:
+                    tile_out = config["tile_out"] or tile.replace(
+                        config["clip_prefix"], '', 1)
+                    out_path = os.path.join(config['output']['dir'],
+                                            tile_out + ".csv")
+                    with open(out_path, "w") as f_out:
+                        f_out.write(result)
+                else:
+                    tiles_skipped.add(tile)
+    # Drop temporary views that reference the clipped extent
+    to_drop = [tile for tile in config["input_polygons"]["tile_list"] if
+               config["clip_prefix"] in tile or
+               (config["tile_out"] and config["tile_out"] in tile)]
+    if to_drop:
+        batch3dfier.drop_2Dtiles(conn, config["input_polygons"]['user_schema'],
+                                 views_to_drop=to_drop)
+    logger.info("%s tiles skipped: %s", tile_group, tiles_skipped)
+    return tiles_skipped
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""A stand-in for 3dfier, for testing and benchmarking batch3dfier
+
+Reads the YAML config that is generated by
+:py:func:`bag3d.config.batch3dfier.yamlr` and writes a CSV-BUILDINGS-MULTIPLE
+output with generated heights for each footprint of the tile, without reading
+the point clouds. Set ``path_3dfier`` to ``bag3d-fake3dfier`` in the bag3d
+config to use it.
+
+Its behaviour is controlled with environment variables:
+
+BAG3D_FAKE3DFIER_LATENCY
+    Seconds to wait per tile (default 0)
+BAG3D_FAKE3DFIER_LATENCY_PER_BUILDING
+    Seconds to wait per footprint (default 0)
+BAG3D_FAKE3DFIER_JITTER
+    Random variation of the latency, as a fraction of it (default 0)
+BAG3D_FAKE3DFIER_MEMORY
+    Megabytes of memory to allocate while running (default 0)
+BAG3D_FAKE3DFIER_FAIL_RATE
+    Probability of failing with a non-zero exit code (default 0)
+BAG3D_FAKE3DFIER_NODATA_RATE
+    Fraction of the buildings without roof points (default 0)
+BAG3D_FAKE3DFIER_SEED
+    Seed of the random failures and the jitter
+"""
+
+import os
+import sys
+import zlib
+import time
+import random
+import argparse
+
+import yaml
+import fiona
+import psycopg2
+from psycopg2 import sql
+
+NODATA = "-99.99"
+
+HEADER = ("id,ground-0.00,ground-0.10,ground-0.20,ground-0.30,ground-0.40,"
+          "ground-0.50,roof-0.00,rmse-0.00,roof-0.10,rmse-0.10,roof-0.25,"
+          "rmse-0.25,roof-0.50,rmse-0.50,roof-0.75,rmse-0.75,roof-0.90,"
+          "rmse-0.90,roof-0.95,rmse-0.95,roof-0.99,rmse-0.99,roof_flat,"
+          "nr_ground_pts,nr_roof_pts,\n")
+
+
+def getenv(name, default=0.0):
+    """Numeric value of the BAG3D_FAKE3DFIER_<name> environment variable"""
+    return float(os.environ.get("BAG3D_FAKE3DFIER_" + name, default))
+
+
+def parse_dsn(dsn):
+    """Parse an OGR PostgreSQL connection string
+
+    Parameters
+    ----------
+    dsn : str
+        Such as 'PG:dbname=db host=localhost ... schemas=s tables=t'
+
+    Returns
+    -------
+    dict
+        The key-value pairs of the connection string
+    """
+    params = {}
+    for kv in dsn[3:].split():
+        k,v = kv.split("=", 1)
+        params[k] = v
+    return params
+
+
+def read_footprint_ids(dataset, uniqueid):
+    """Read the IDs of the footprints of the tile
+
+    Parameters
+    ----------
+    dataset : str
+        OGR PostgreSQL connection string or path to a file
+    uniqueid : str
+        Name of the ID field
+
+    Returns
+    -------
+    list
+    """
+    if dataset.startswith("PG:"):
+        p = parse_dsn(dataset)
+        conn = psycopg2.connect(dbname=p['dbname'], host=p.get('host'),
+                                port=p.get('port'), user=p.get('user'),
+                                password=p.get('password'))
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("SELECT {uid} FROM {schema}.{table};").format(
+                    uid=sql.Identifier(uniqueid),
+                    schema=sql.Identifier(p['schemas']),
+                    table=sql.Identifier(p['tables'])))
+                return [r[0] for r in cur.fetchall()]
+        finally:
+            conn.close()
+    else:
+        with fiona.open(dataset) as src:
+            return [f['properties'][uniqueid] for f in src]
+
+
+def csv_row(uid, nodata_rate=0.0):
+    """A CSV-BUILDINGS-MULTIPLE record with heights generated from the ID
+
+    The same ID always gets the same heights. The record ends with a comma,
+    like the output of 3dfier.
+    """
+    h = zlib.crc32(str(uid).encode())
+    ground = (h % 300) / 100.0
+    roof = ground + 3.0 + (h % 2500) / 100.0
+    grounds = ["%.2f" % (ground + 0.01 * i) for i in range(6)]
+    nr_roof_pts = 100 + h % 500
+    roofs = []
+    if (h % 10000) < nodata_rate * 10000:
+        roofs = [NODATA] * 16
+        nr_roof_pts = 0
+    else:
+        for i,p in enumerate([0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]):
+            roofs += ["%.2f" % (roof + p * 2), "%.2f" % (0.05 + i * 0.01)]
+    flat = 'true' if h % 3 == 0 else 'false'
+    return ",".join([str(uid)] + grounds + roofs +
+                    [flat, str(10 + h % 50), str(nr_roof_pts)]) + ",\n"
+
+
+def run(config_path, output_path):
+    """Generate the CSV-BUILDINGS-MULTIPLE output of a 3dfier config
+
+    Returns
+    -------
+    int
+        Exit code
+    """
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f)
+    polygons = config['input_polygons'][0]
+    uniqueid = polygons['uniqueid']
+    seed = os.environ.get("BAG3D_FAKE3DFIER_SEED")
+    rnd = random.Random(seed + output_path if seed is not None else None)
+
+    # hold the memory until the output is written
+    memory = bytearray(int(getenv("MEMORY") * 1024 * 1024))
+    for i in range(0, len(memory), 4096):
+        memory[i] = 1
+
+    for p in config['input_elevation'][0]['datasets']:
+        if not os.path.isfile(p):
+            sys.stderr.write("Point cloud file %s does not exist\n" % p)
+            return 1
+    ids = []
+    for dataset in polygons['datasets']:
+        ids += read_footprint_ids(dataset, uniqueid)
+
+    latency = getenv("LATENCY") + getenv("LATENCY_PER_BUILDING") * len(ids)
+    jitter = getenv("JITTER")
+    if jitter:
+        latency *= 1 + rnd.uniform(-jitter, jitter)
+    time.sleep(max(latency, 0))
+
+    if rnd.random() < getenv("FAIL_RATE"):
+        sys.stderr.write("Simulated failure of 3dfier\n")
+        return 1
+    nodata_rate = getenv("NODATA_RATE")
+    with open(output_path, 'w') as f:
+        f.write(HEADER)
+        for uid in ids:
+            f.write(csv_row(uid, nodata_rate))
+    del memory
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="bag3d-fake3dfier",
+        description="Stand-in for 3dfier, generates a CSV-BUILDINGS-MULTIPLE output without reading the point clouds")
+    parser.add_argument("config", help="3dfier YAML config")
+    parser.add_argument("--stat_RMSE", action="store_true",
+                        help="Ignored, the RMSE is always written")
+    parser.add_argument("--CSV-BUILDINGS-MULTIPLE", dest="output",
+                        required=True, help="Output CSV file")
+    a = parser.parse_args(argv)
+    sys.exit(run(a.config, a.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,34 +8,210 @@ import queue
 import threading
 import logging
 import re
+import time
+from shutil import rmtree
 
 import psutil
 
 from bag3d.config import batch3dfier
+from bag3d import telemetry
 
 logger = logging.getLogger(__name__)
 
 
-def run(conn, config, doexec=True):
+def get_tile_group(config):
+    """The name of the tile group (eg. rest, border_ahn2) of a configuration"""
+    return re.search(r"bag3d_cfg_(\w+).yml", config["config"]["in"]).group(1)
+
+
+def lift_tile(conn, config, tile, thread, pc_file_idx, tile_group, yml_dir,
+              output_dir=None, footprint_snapshot=None, doexec=True):
+    """Run 3dfier on a single tile of a configuration
+    
+    The point clouds of the clipped extents and of the border tiles are 
+    cropped to the footprints if input_elevation:crop_dir is set.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    config : dict
+        bag3d configuration, as returned by :py:func:`bag3d.config.border.process`
+    tile : str
+        Name of the footprint tile view
+    thread : str
+        Name/ID of the active thread
+    pc_file_idx : dict
+        As returned by :py:func:`bag3d.config.batch3dfier.pc_file_index`
+    tile_group : str
+        Name of the tile group
+    yml_dir : str
+        Directory for the 3dfier configs
+    output_dir : str
+        Directory for the 3dfier output. Defaults to output:dir.
+    footprint_snapshot : dict
+        As returned by :py:func:`bag3d.config.batch3dfier.extract_footprints`
+    
+    Returns
+    -------
+    dict
+        As returned by :py:func:`bag3d.config.batch3dfier.call_3dfier`
     """
+    if not output_dir:
+        output_dir = config['output']['dir']
+    crop_dir = config["input_elevation"].get("crop_dir")
+    if crop_dir and (config["extent_ewkb"] or tile_group.startswith("border")):
+        crop = {'dir': os.path.join(crop_dir, tile_group),
+                'buffer': config["input_elevation"].get("crop_buffer") or 5.0,
+                'geometry': config["input_polygons"]["footprints"]["fields"]["geometry"],
+                'path_las2las': config.get('path_las2las') or 'las2las'}
+    else:
+        crop = None
+    return batch3dfier.call_3dfier(
+        db=conn,
+        tile=tile,
+        schema_tiles=config["input_polygons"]['user_schema'],
+        table_index_pc=config["tile_index"]['elevation'],
+        fields_index_pc=config["tile_index"]['elevation']['fields'],
+        idx_identical=config["tile_index"]["identical"],
+        table_index_footprint=config["tile_index"]['polygons'],
+        fields_index_footprint=config["tile_index"]['polygons']['fields'],
+        uniqueid=config["input_polygons"]["footprints"]["fields"]['uniqueid'],
+        extent_ewkb=config["extent_ewkb"],
+        clip_prefix=config["clip_prefix"],
+        prefix_tile_footprint=config["input_polygons"]['tile_prefix'],
+        yml_dir=yml_dir,
+        tile_out=config["tile_out"],
+        output_format='CSV-BUILDINGS-MULTIPLE',
+        output_dir=output_dir,
+        path_3dfier=config['path_3dfier'],
+        thread=thread,
+        pc_file_index=pc_file_idx,
+        tile_group=tile_group,
+        footprint_snapshot=footprint_snapshot,
+        crop=crop,
+        footprint_cnt=(config.get("footprint_cnt") or {}).get(tile),
+        doexec=doexec)
+
+
+def prepare_group(conn, config, doexec=True):
+    """Collect what the workers need for processing the tiles of a configuration
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    config : dict
+        bag3d configuration, as returned by :py:func:`bag3d.config.border.process`
+    
     Returns
     -------
-    list of str
-        The tiles that failed
+    dict
+        The tile group, configuration, tiles, point cloud file index, 3dfier 
+        config directory and footprint snapshot of the configuration, or None 
+        if the tile_list is empty
     """
     if config["input_polygons"]["tile_list"] is None:
         logger.error("tile_list in %s is empty, exiting function", config["config"]["in"])
         return None
-    else:
-        tiles = config["input_polygons"]["tile_list"]
-    cfg_dir = os.path.dirname(config["config"]["in"])
+    tiles = config["input_polygons"]["tile_list"]
     pc_name_map = batch3dfier.pc_name_dict(config["input_elevation"]["dataset_dir"], 
                                            config["input_elevation"]["dataset_name"])
-    pc_file_idx = batch3dfier.pc_file_index(pc_name_map)
-    tile_group = re.search(r"bag3d_cfg_(\w+).yml", config["config"]["in"]).group(1)
+    tile_group = get_tile_group(config)
+    snapshot_dir = config["input_polygons"].get("footprints_snapshot")
+    if snapshot_dir:
+        snapshot_dir = os.path.join(snapshot_dir, tile_group)
+        logger.info("Extracting footprints into %s", snapshot_dir)
+        footprint_snapshot = batch3dfier.extract_footprints(
+            conn,
+            schema_tiles=config["input_polygons"]['user_schema'],
+            tiles=tiles,
+            uniqueid=config["input_polygons"]["footprints"]["fields"]['uniqueid'],
+            geometry=config["input_polygons"]["footprints"]["fields"]['geometry'],
+            out_dir=snapshot_dir,
+            threads=config['threads'],
+            doexec=doexec)
+    else:
+        footprint_snapshot = None
+    return {'tile_group': tile_group,
+            'config': config,
+            'tiles': tiles,
+            'pc_file_idx': batch3dfier.pc_file_index(pc_name_map),
+            'yml_dir': os.path.dirname(config["config"]["in"]),
+            'footprint_snapshot': footprint_snapshot,
+            'snapshot_dir': snapshot_dir}
+
+
+def finish_group(conn, group, tiles_skipped):
+    """Drop the temporary views and the footprint snapshot of a tile group 
+    and report the results
+    
+    Returns
+    -------
+    set of str
+        The tiles that failed
+    """
+    config = group['config']
+    tiles = group['tiles']
+    # Drop temporary views that reference the clipped extent
+    try:
+        to_drop = [tile for tile in tiles if 
+                   config["clip_prefix"] in tile or 
+                   config["tile_out"] in tile]
+        if to_drop:
+            batch3dfier.drop_2Dtiles(
+                conn,
+                config["input_polygons"]['user_schema'],
+                views_to_drop=to_drop)
+    except TypeError:
+        logger.debug("No views to drop")
+    if group.get('snapshot_dir'):
+        rmtree(group['snapshot_dir'], ignore_errors=True)
+        logger.debug("Deleted %s", group['snapshot_dir'])
+    # Reporting
+    tiles = set(tiles)
+    tiles_skipped = set(tiles_skipped)
+    logger.info("Total number of tiles processed in %s: %s", group['tile_group'],
+                 str(len(tiles.difference(tiles_skipped))))
+    logger.info("Tiles skipped in %s: %s", group['tile_group'], tiles_skipped)
+    return tiles_skipped
+
+
+def run_groups(conn, configs, doexec=True):
+    """Run 3dfier on the tiles of several configurations with one pool of threads
+    
+    The tiles of all the configurations are put into a single queue, each 
+    with its own tile group, configuration and output directory, so that 
+    the tiles of a group are processed while the last tiles of the 
+    previous group are still running. The number of threads is taken from 
+    the first configuration.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    configs : list of dict
+        bag3d configurations, as returned by :py:func:`bag3d.config.border.process`
+    
+    Returns
+    -------
+    dict
+        {tile group : set of the tiles that failed}. The tile group is None 
+        for the configurations with an empty tile_list.
+    """
+    groups = []
+    result = {}
+    for c in configs:
+        g = prepare_group(conn, c, doexec=doexec)
+        if g is None:
+            result[get_tile_group(c)] = None
+        else:
+            groups.append(g)
+    if len(groups) == 0:
+        return result
 
     exitFlag = 0
-    tiles_skipped = []
+    tiles_skipped = {g['tile_group']: [] for g in groups}
     out_paths = []
 
     class myThread (threading.Thread):
@@ -53,40 +229,28 @@ def run(conn, config, doexec=True):
         while not exitFlag:
             queueLock.acquire()
             if not workQueue.empty():
-                tile = q.get()
+                group, tile, queued_at = q.get()
                 queueLock.release()
-                logger.debug("Processing %s" % tile)
-                t = batch3dfier.call_3dfier(
-                    db=conn,
-                    tile=tile,
-                    schema_tiles=config["input_polygons"]['user_schema'],
-                    table_index_pc=config["tile_index"]['elevation'],
-                    fields_index_pc=config["tile_index"]['elevation']['fields'],
-                    idx_identical=config["tile_index"]["identical"],
-                    table_index_footprint=config["tile_index"]['polygons'],
-                    fields_index_footprint=config["tile_index"]['polygons']['fields'],
-                    uniqueid=config["input_polygons"]["footprints"]["fields"]['uniqueid'],
-                    extent_ewkb=config["extent_ewkb"],
-                    clip_prefix=config["clip_prefix"],
-                    prefix_tile_footprint=config["input_polygons"]['tile_prefix'],
-                    yml_dir=cfg_dir,
-                    tile_out=config["tile_out"],
-                    output_format='CSV-BUILDINGS-MULTIPLE',
-                    output_dir=config['output']['dir'],
-                    path_3dfier=config['path_3dfier'],
-                    thread=threadName,
-                    pc_file_index=pc_file_idx,
-                    tile_group=tile_group,
-                    doexec=doexec)
+                queue_wait = time.perf_counter() - queued_at
+                tile_group = group['tile_group']
+                logger.debug("Processing %s of %s" % (tile, tile_group))
+                t = lift_tile(conn, group['config'], tile, threadName, 
+                              group['pc_file_idx'], tile_group, 
+                              yml_dir=group['yml_dir'],
+                              footprint_snapshot=group['footprint_snapshot'],
+                              doexec=doexec)
+                telemetry.record('tile', group=tile_group, tile=tile, 
+                                 thread=threadName, queue_wait=queue_wait, 
+                                 **t['stats'])
                 if t['tile_skipped'] is not None:
-                    tiles_skipped.append(t['tile_skipped'])
+                    tiles_skipped[tile_group].append(t['tile_skipped'])
                 else:
                     out_paths.append(t['out_path'])
             else:
                 queueLock.release()
 
     # Prep
-    threadList = ["Thread-" + str(t + 1) for t in range(config['threads'])]
+    threadList = ["Thread-" + str(t + 1) for t in range(groups[0]['config']['threads'])]
     queueLock = threading.Lock()
     workQueue = queue.Queue(0)
     threads = []
@@ -99,8 +263,9 @@ def run(conn, config, doexec=True):
         threadID += 1
     # Fill the queue
     queueLock.acquire()
-    for tile in tiles:
-        workQueue.put(tile)
+    for g in groups:
+        for tile in g['tiles']:
+            workQueue.put((g, tile, time.perf_counter()))
     queueLock.release()
     # Wait for queue to empty
     while not workQueue.empty():
@@ -111,23 +276,19 @@ def run(conn, config, doexec=True):
     for t in threads:
         t.join()
 
-    # Drop temporary views that reference the clipped extent
-    try:
-        to_drop = [tile for tile in tiles if 
-                   config["clip_prefix"] in tile or 
-                   config["tile_out"] in tile]
-        if to_drop:
-            batch3dfier.drop_2Dtiles(
-                conn,
-                config["input_polygons"]['user_schema'],
-                views_to_drop=to_drop)
-    except TypeError:
-        logger.debug("No views to drop")
-    # Reporting
-    tiles = set(tiles)
-    tiles_skipped = set(tiles_skipped)
-    logger.info("Total number of tiles processed: %s",
-                 str(len(tiles.difference(tiles_skipped))))
-    logger.info("Tiles skipped: %s", tiles_skipped)
+    for g in groups:
+        result[g['tile_group']] = finish_group(conn, g, tiles_skipped[g['tile_group']])
+    return result
+
+
+def run(conn, config, doexec=True):
+    """Run 3dfier on the tiles of a configuration
     
-    return tiles_skipped
+    See :py:func:`run_groups`.
+    
+    Returns
+    -------
+    list of str
+        The tiles that failed
+    """
+    return run_groups(conn, [config], doexec=doexec)[get_tile_group(config)]
@@ -41,11 +41,27 @@ def parse_console_args(args):
         dest='update_bag',
         action="store_true",
         help="Update the BAG in the database. If it does not exists, download and restore the BAG extract into the database")
+    parser.add_argument(
+        "--restore-jobs",
+        dest='restore_jobs',
+        default=20,
+        type=int,
+        help="Together with --update-bag, the number of parallel jobs for restoring the BAG extract")
+    parser.add_argument(
+        "--restore-staging",
+        dest='restore_staging',
+        action="store_true",
+        help="Together with --update-bag, restore the BAG into a staging schema and swap it with bagactueel, so that the BAG remains available during the update")
     parser.add_argument(
         "--update-ahn",
         dest='update_ahn',
         action="store_true",
         help="Download/update the AHN files")
+    parser.add_argument(
+        "--index-pointclouds",
+        dest='index_pointclouds',
+        action="store_true",
+        help="Create the spatial index (.lax) of the point cloud files in input_elevation:dataset_dir with lasindex")
     parser.add_argument(
         "--update-ahn-raster",
         dest='update_ahn_raster',
@@ -66,6 +82,19 @@ def parse_console_args(args):
         dest='run_3dfier',
         action="store_true",
         help="Run batch3dfier")
+    parser.add_argument(
+        "--border-merge",
+        dest='border_merge',
+        action="store_true",
+        help="Together with --run-3dfier, import the AHN2 and AHN3 border tiles into a single table, choosing the AHN version per building")
+    parser.add_argument(
+        "--coordinator",
+        action="store_true",
+        help="Together with --run-3dfier, queue the tiles in the database for the worker nodes instead of running 3dfier locally")
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Run as a worker node, processing the tiles queued by the coordinator with --threads parallel 3dfier processes")
     parser.add_argument(
         "--grant-access",
         dest='grant_access',
@@ -85,6 +114,11 @@ def parse_console_args(args):
         dest="no_exec",
         action="store_false",
         help="Control the execution of subprocesses. Used for debugging.")
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        type=str,
+        help="Profile each stage with cProfile and write the statistics into this directory")
     parser.add_argument(
         "--log",
         dest="loglevel",
@@ -92,11 +126,16 @@ def parse_console_args(args):
         help="Set logging level.")
     parser.set_defaults(get_bag=False)
     parser.set_defaults(update_bag=False)
+    parser.set_defaults(restore_staging=False)
     parser.set_defaults(update_ahn=False)
+    parser.set_defaults(index_pointclouds=False)
     parser.set_defaults(update_ahn_raster=False)
     parser.set_defaults(import_tile_idx=False)
     parser.set_defaults(add_borders=False)
     parser.set_defaults(run_3dfier=False)
+    parser.set_defaults(border_merge=False)
+    parser.set_defaults(coordinator=False)
+    parser.set_defaults(worker=False)
     parser.set_defaults(export=False)
     parser.set_defaults(quality=False)
     parser.set_defaults(no_exec=True)
@@ -114,15 +153,22 @@ def parse_console_args(args):
     args_in['threads'] = args.threads
     args_in['get_bag'] = args.get_bag
     args_in['update_bag'] = args.update_bag
+    args_in['restore_jobs'] = args.restore_jobs
+    args_in['restore_staging'] = args.restore_staging
     args_in['update_ahn'] = args.update_ahn
+    args_in['index_pointclouds'] = args.index_pointclouds
     args_in['update_ahn_raster'] = args.update_ahn_raster
     args_in['import_tile_idx'] = args.import_tile_idx
     args_in['add_borders'] = args.add_borders
     args_in['run_3dfier'] = args.run_3dfier
+    args_in['border_merge'] = args.border_merge
+    args_in['coordinator'] = args.coordinator
+    args_in['worker'] = args.worker
     args_in['export'] = args.export
     args_in['quality'] = args.quality
     args_in['grant_access'] = args.grant_access
     args_in['no_exec'] = args.no_exec
+    args_in['profile'] = os.path.abspath(args.profile) if args.profile else None
 
     return args_in
 
@@ -218,6 +264,9 @@ def parse_config(args_in, schema):
     cfg["input_elevation"] = cfg_stream["input_elevation"]
     cfg["input_elevation"]["dataset_dir"] = add_abspath(
         cfg_stream["input_elevation"]["dataset_dir"])
+    if cfg["input_elevation"].get("crop_dir"):
+        cfg["input_elevation"]["crop_dir"] = os.path.abspath(
+            cfg["input_elevation"]["crop_dir"])
     #FIXME: remove this below --v
     cfg["pc_dir"] = add_abspath(
         cfg_stream["input_elevation"]["dataset_dir"])
@@ -237,8 +286,14 @@ def parse_config(args_in, schema):
 
     cfg['path_3dfier'] = cfg_stream["path_3dfier"]
     cfg['path_lasinfo'] = cfg_stream['path_lasinfo']
+    cfg['path_lasindex'] = cfg_stream.get('path_lasindex')
+    cfg['path_las2las'] = cfg_stream.get('path_las2las')
+    cfg['path_gdal_translate'] = cfg_stream.get('path_gdal_translate')
 
     cfg["input_polygons"] = cfg_stream["input_polygons"]
+    if cfg["input_polygons"].get("footprints_snapshot"):
+        cfg["input_polygons"]["footprints_snapshot"] = os.path.abspath(
+            cfg["input_polygons"]["footprints_snapshot"])
     #FIXME: sanitzie this below --v
     try:
         # in case user gave " " or "" for 'extent'
@@ -3,21 +3,29 @@
 """Configure batch3dfier with the input data."""
 
 import os.path
-from os import remove
 import re
+import struct
+import hashlib
+import json
+import tempfile
 from itertools import chain
 from pprint import pformat
 import time
 import logging
 from random import shuffle
+from concurrent.futures import ThreadPoolExecutor
 
-from shapely.geometry import shape
+from shapely.geometry import shape, mapping
 from shapely import geos
+from shapely import wkb
 from psycopg2 import sql
 import fiona
+from fiona.crs import from_epsg
 import psutil
 
 from bag3d.update import bag
+from bag3d.config import footprints
+from bag3d import telemetry
 
 logger = logging.getLogger(__name__)
 
@@ -28,12 +36,17 @@ def call_3dfier(db, tile, schema_tiles,
                 yml_dir, tile_out, output_format, output_dir,
                 path_3dfier, thread,
                 pc_file_index, tile_group,
+                footprint_snapshot=None, crop=None, footprint_cnt=None,
                 doexec=True):
     """Call 3dfier with the YAML config created by yamlr().
 
     Note
     ----
     For the rest of the parameters see batch3dfier_config.yml.
+    
+    The 3dfier configs are cached in yml_dir (see :py:func:`yml_cache_path`)
+    and they are not deleted after the call, so that retries of a tile reuse 
+    the same config. The directory is removed at the end of the run.
 
     Parameters
     ----------
@@ -52,6 +65,18 @@ def call_3dfier(db, tile, schema_tiles,
     prefix_tile_footprint : str or None
         Prefix prepended to the footprint tile view names. If None, the views are named as
         the values in fields_index_fooptrint['unit_name'].
+    footprint_snapshot : dict or None
+        {tile : path to the footprint file} as returned by 
+        :py:func:`extract_footprints`. If the tile is in it, 3dfier reads the
+        footprints from the file instead of the database.
+    crop : dict or None
+        If provided, the point cloud files are cropped to the footprints of 
+        the tile before running 3dfier (see :py:func:`crop_pointclouds`), 
+        and the cropped files are deleted afterwards. Keys: dir, buffer, 
+        geometry, path_las2las.
+    footprint_cnt : int or None
+        Nr. of footprints in the tile from the tile catalog. If None, the 
+        footprints are counted with :py:func:`count_footprints`.
 
     Returns
     -------
@@ -61,11 +86,11 @@ def call_3dfier(db, tile, schema_tiles,
             was found in 'dataset_dir' (YAML)
         out_path : str
             Output path of 3dfier
+        stats : dict
+            Telemetry of the tile: yml_time, points, footprints, wall_time,
+            cpu_time, peak_rss, output_rows, success
     """
-    # perf = report_procs()
-    # if perf:
-    #     logger_perf.debug("%s - %s - %s" % (tile_group, tile, perf))
-    start = time.process_time()
+    stats = {}
     tiles = find_pc_tiles(db, table_index_pc, fields_index_pc, idx_identical,
                              table_index_footprint, fields_index_footprint,
                              extent_ewkb, tile_footprint=tile,
@@ -77,21 +102,48 @@ def call_3dfier(db, tile, schema_tiles,
     if not tile_out:
         tile_out = tile.replace(clip_prefix, '', 1)
     if pc_path:
-        # Needs a YAML per thread so one doesn't overwrite it while the other
-        # uses it
-        yml_name = tile + ".yml"
-        yml_path = os.path.join(yml_dir, yml_name)
-        config = yamlr(dbname=db.dbname, host=db.host, port=db.port, user=db.user,
-                       pw=db.password, schema_tiles=schema_tiles,
-                       bag_tile=tile, pc_path=pc_path, uniqueid=uniqueid,
-                       ahn_version=ahn_version)
-        # Write temporary config file
-        logger.debug(config)
-        try:
-            with open(yml_path, "w") as text_file:
-                text_file.write(config)
-        except BaseException as e:
-            logger.exception("Error: cannot write _config.yml")
+        # Needs a YAML per tile so one thread doesn't overwrite it while the
+        # other uses it. The config is cached, so that retries of the tile
+        # reuse it.
+        if footprint_snapshot and tile in footprint_snapshot:
+            footprints = footprint_snapshot[tile]
+        else:
+            footprints = None
+        pc_path_orig = pc_path
+        if crop:
+            start = time.perf_counter()
+            bounds = footprint_bounds(db, schema_tiles, tile, crop['geometry'],
+                                      footprints) if doexec else None
+            if bounds:
+                pc_path = crop_pointclouds(bounds, pc_path, 
+                                           os.path.join(crop['dir'], tile),
+                                           buffer=crop['buffer'], 
+                                           path_las2las=crop['path_las2las'],
+                                           doexec=doexec)
+            stats['crop_time'] = time.perf_counter() - start
+        start = time.perf_counter()
+        yml_path = yml_cache_path(yml_dir, tile, pc_path, ahn_version, 
+                                  footprints)
+        if os.path.exists(yml_path):
+            logger.debug("Using cached 3dfier config %s", yml_path)
+        else:
+            config = yamlr(dbname=db.dbname, host=db.host, port=db.port, 
+                           user=db.user, pw=db.password, 
+                           schema_tiles=schema_tiles, bag_tile=tile, 
+                           pc_path=pc_path, uniqueid=uniqueid,
+                           ahn_version=ahn_version, footprints=footprints)
+            logger.debug(config)
+            try:
+                write_yml_atomic(config, yml_path)
+            except BaseException as e:
+                logger.exception("Error: cannot write %s", yml_path)
+        stats['yml_time'] = time.perf_counter() - start
+        stats['points'] = sum(telemetry.las_point_count(f) or 0 for f in pc_path)
+        if footprint_cnt is not None:
+            stats['footprints'] = footprint_cnt
+        elif doexec:
+            stats['footprints'] = count_footprints(db, schema_tiles, tile, 
+                                                   footprints)
         # Prep output file name
         if "obj" in output_format.lower():
             o = tile_out + ".obj"
@@ -106,39 +158,256 @@ def call_3dfier(db, tile, schema_tiles,
                    output_path]
         try:
             logger.debug(" ".join(command))
-            success = bag.run_subprocess(command, shell=True, doexec=doexec, monitor=True, tile_id=tile)
+            success = bag.run_subprocess(command, shell=True, doexec=doexec, 
+                                         monitor=True, tile_id=tile, 
+                                         stats=stats)
             if success:
                 tile_skipped = None
+                if doexec:
+                    stats['output_rows'] = count_rows(output_path)
             else:
                 tile_skipped = tile
                 output_path = None
-            try:
-                remove(yml_path)
-            except Exception as e:
-                logger.error(e)
         except BaseException as e:
             logger.exception("Cannot run 3dfier on tile %s", tile)
             tile_skipped = tile
             output_path = None
+        for f in set(pc_path) - set(pc_path_orig):
+            try:
+                os.remove(f)
+            except OSError as e:
+                logger.debug(e)
     else:
         logger.debug("Pointcloud file(s) %s not available. Skipping tile.",
                      str(tiles.keys()))
         tile_skipped = tile
         output_path = None
-    # end = time.process_time()
-    # proc_time = (end - start) / 60
-    # logger_perf.debug("%s - %s - process_time: %s" % (tile_group, tile, proc_time))
-    return {'tile_skipped': tile_skipped, 'out_path': output_path}
+    stats['success'] = tile_skipped is None
+    return {'tile_skipped': tile_skipped, 'out_path': output_path, 
+            'stats': stats}
+
+
+def las_bounds(path):
+    """The (xmin, ymin, xmax, ymax) of a LAS/LAZ file, read from the file header
+    
+    Returns
+    -------
+    tuple
+        The bounds, or None if the header cannot be read
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(227)
+    except OSError as e:
+        logger.debug(e)
+        return None
+    if len(header) < 227 or header[:4] != b'LASF':
+        logger.debug("%s is not a LAS file", path)
+        return None
+    xmax, xmin, ymax, ymin = struct.unpack_from('<4d', header, 179)
+    return (xmin, ymin, xmax, ymax)
+
+
+def footprint_bounds(conn, schema_tiles, tile, geometry, footprints=None):
+    """The bounding box of the footprints in a tile
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    schema_tiles : str
+        Schema of the footprint tiles
+    tile : str
+        Name of the footprint tile view
+    geometry : str
+        Name of the geometry field of the footprints
+    footprints : str
+        Path to the footprint snapshot of the tile, if it is used instead of 
+        the view
+    
+    Returns
+    -------
+    tuple
+        (xmin, ymin, xmax, ymax), or None if the tile is empty
+    """
+    if footprints:
+        with fiona.open(footprints) as src:
+            return src.bounds if len(src) > 0 else None
+    query = sql.SQL("""
+    SELECT st_xmin(e), st_ymin(e), st_xmax(e), st_ymax(e)
+    FROM (SELECT st_extent({geom}) e FROM {schema}.{tile}) a;
+    """).format(geom=sql.Identifier(geometry),
+                schema=sql.Identifier(schema_tiles),
+                tile=sql.Identifier(tile))
+    logger.debug(conn.print_query(query))
+    r = conn.getQuery(query, hot=True)[0]
+    return None if r[0] is None else tuple(r)
+
+
+def crop_pointclouds(bounds, pc_path, crop_dir, buffer=5.0, 
+                     path_las2las='las2las', doexec=True):
+    """Crop the point cloud files to the bounding box of the footprints
+    
+    Writes the points within the buffered bounds of each file into crop_dir 
+    with las2las. The files that are within the buffered bounds are not 
+    cropped.
+    
+    Parameters
+    ----------
+    bounds : tuple
+        (xmin, ymin, xmax, ymax) of the footprints, as returned by 
+        :py:func:`footprint_bounds`
+    pc_path : list of str
+        Paths to the point cloud files
+    crop_dir : str
+        Directory for the cropped files
+    buffer : float
+        Buffer around the bounds in meters
+    path_las2las : str
+        Path to the las2las executable
+    
+    Returns
+    -------
+    list of str
+        Paths to the point cloud files that 3dfier should read, the cropped 
+        file where cropping succeeded, otherwise the original file
+    """
+    xmin, ymin, xmax, ymax = (bounds[0] - buffer, bounds[1] - buffer, 
+                              bounds[2] + buffer, bounds[3] + buffer)
+    os.makedirs(crop_dir, exist_ok=True)
+    out = []
+    for f in pc_path:
+        b = las_bounds(f)
+        if b and b[0] >= xmin and b[1] >= ymin and b[2] <= xmax and b[3] <= ymax:
+            out.append(f)
+            continue
+        o = os.path.join(crop_dir, os.path.basename(f))
+        command = [path_las2las, '-i', f, '-keep_xy', 
+                   *["%.3f" % c for c in (xmin, ymin, xmax, ymax)], '-o', o]
+        if bag.run_subprocess(command, doexec=doexec):
+            out.append(o)
+        else:
+            logger.error("Cannot crop %s, using the whole file", f)
+            out.append(f)
+    return out
+
+
+def count_footprints(conn, schema_tiles, tile, footprints=None):
+    """Number of footprints in a tile
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    schema_tiles : str
+        Schema of the footprint tiles
+    tile : str
+        Name of the footprint tile view
+    footprints : str
+        Path to the footprint snapshot of the tile, if it is used instead of 
+        the view
+    
+    Returns
+    -------
+    int
+        Nr. of footprints, None if they cannot be counted
+    
+    Note
+    ----
+    The footprints are counted in the snapshot if there is one, otherwise 
+    with a query on the view. When the tile catalog is available, the count 
+    is taken from it instead (see :py:func:`call_3dfier`).
+    """
+    try:
+        if footprints:
+            with fiona.open(footprints) as src:
+                return len(src)
+        query = sql.SQL("SELECT count(*) FROM {schema}.{tile};").format(
+            schema=sql.Identifier(schema_tiles), tile=sql.Identifier(tile))
+        logger.debug(conn.print_query(query))
+        return conn.getQuery(query)[0][0]
+    except BaseException as e:
+        logger.debug("Cannot count the footprints in %s: %s", tile, e)
+        return None
+
+
+def count_rows(path):
+    """Number of records in a CSV file with header, None if it doesn't exist"""
+    try:
+        with open(path, 'r') as f:
+            return max(sum(1 for line in f) - 1, 0)
+    except OSError:
+        return None
+
+
+def yml_cache_path(yml_dir, tile, pc_path, ahn_version, footprints=None):
+    """Path of the cached 3dfier config of a tile
+    
+    The file name is the tile name and the digest of the inputs that 
+    determine the config, thus a config is reused as long as the tile is 
+    processed with the same point cloud files and AHN versions.
+    
+    Parameters
+    ----------
+    yml_dir : str
+        Directory of the cached configs
+    tile : str
+        Name of of the 2D tile
+    pc_path : list of str
+        Paths to the point cloud files of the tile
+    ahn_version : set
+        Version of the AHN point clouds
+    footprints : str or None
+        Path to the footprint file of the tile, if the footprints are not read
+        from the database
+    
+    Returns
+    -------
+    str
+        Path to the YAML config file
+    """
+    key = json.dumps([tile, sorted(pc_path), sorted(ahn_version), footprints])
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(yml_dir, "{t}_{d}.yml".format(t=tile, d=digest))
+
+
+def write_yml_atomic(config, yml_path):
+    """Write a config file atomically
+    
+    The config is written into a temporary file in the same directory first,
+    which is then renamed to yml_path. Thus a 3dfier process never reads a
+    partially written config.
+    
+    Parameters
+    ----------
+    config : str
+        The YAML config as returned by :py:func:`yamlr`
+    yml_path : str
+        Path to the config file
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", 
+                                    dir=os.path.dirname(yml_path))
+    try:
+        with os.fdopen(fd, "w") as text_file:
+            text_file.write(config)
+        os.replace(tmp_path, yml_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
 def yamlr(dbname, host, port, user, pw, schema_tiles,
-          bag_tile, pc_path, uniqueid, ahn_version):
+          bag_tile, pc_path, uniqueid, ahn_version, footprints=None):
     """Parse the YAML config file for 3dfier.
 
     Parameters
     ----------
     ahn_version : set
         Version of the latest available AHN point cloud for the current tile
+    footprints : str or None
+        Path to a file with the footprints of the tile. If None, 3dfier reads
+        the footprints from the tile view in the database.
 
     Returns
     -------
@@ -156,7 +425,9 @@ def yamlr(dbname, host, port, user, pw, schema_tiles,
     # !!! Do not correct the indentation of the config template, otherwise it
     # results in 'YAML::TypedBadConversion<std::__cxx11::basic_string<char, std::char_traits<char>, std::allocator<char> > >'
     # because every line is indented as here
-    if pw:
+    if footprints:
+        dns = footprints
+    elif pw:
         d = 'PG:dbname={dbname} host={host} port={port} user={user} password={pw} schemas={schema_tiles} tables={bag_tile}'
         dns = d.format(dbname=dbname,
                host=host,
@@ -213,6 +484,88 @@ options:
     return config
 
 
+def extract_footprints(conn, schema_tiles, tiles, uniqueid, geometry, 
+                       out_dir, threads=1, doexec=True):
+    """Extract the footprints of each tile into a local GeoPackage
+    
+    The footprints are read over the single open connection with a 
+    server-side cursor, while the files are written by a pool of threads. 
+    Then 3dfier can read the footprints from the files instead of opening 
+    a database connection per process.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    schema_tiles : str
+        Schema of the footprint tiles
+    tiles : list of str
+        Names of the footprint tile views
+    uniqueid : str
+        Name of the field with the footprint ID
+    geometry : str
+        Name of the geometry field of the footprints
+    out_dir : str
+        Directory for the footprint files
+    threads : int
+        Number of threads for writing the files
+    
+    Returns
+    -------
+    dict
+        {tile : path to the footprint file}
+    """
+    if not doexec:
+        logger.debug("Not extracting footprints into %s", out_dir)
+        return {}
+    os.makedirs(out_dir, exist_ok=True)
+    schema = {'geometry': 'Unknown', 'properties': {uniqueid: 'str'}}
+    
+    def write_tile(tile, features):
+        path = os.path.join(out_dir, tile + ".gpkg")
+        # write into a temporary file first, so that 3dfier never reads a
+        # partially written snapshot
+        tmp_path = os.path.join(out_dir, tile + ".tmp.gpkg")
+        with fiona.open(tmp_path, 'w', driver='GPKG', schema=schema, 
+                        crs=from_epsg(28992), layer=tile) as dst:
+            dst.writerecords(features)
+        os.replace(tmp_path, path)
+        return path
+    
+    snapshot = {}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for tile in tiles:
+            query = sql.SQL("""
+            SELECT {uniqueid}::text, ST_AsBinary(ST_Force2D({geometry}))
+            FROM {schema}.{view};
+            """).format(uniqueid=sql.Identifier(uniqueid),
+                        geometry=sql.Identifier(geometry),
+                        schema=sql.Identifier(schema_tiles),
+                        view=sql.Identifier(tile))
+            logger.debug(conn.print_query(query))
+            features = []
+            with conn.conn.cursor(name="footprints_snapshot", 
+                                  withhold=True) as cur:
+                cur.itersize = 5000
+                cur.execute(query)
+                for uid, geom in cur:
+                    features.append({
+                        'geometry': mapping(wkb.loads(bytes(geom))),
+                        'properties': {uniqueid: uid}
+                        })
+            conn.conn.commit()
+            futures[tile] = executor.submit(write_tile, tile, features)
+        for tile, f in futures.items():
+            try:
+                snapshot[tile] = f.result()
+            except BaseException as e:
+                logger.exception("Cannot write the footprints of %s", tile)
+    logger.info("Extracted the footprints of %s tiles into %s", 
+                len(snapshot), out_dir)
+    return snapshot
+
+
 def pc_name_dict(pc_dir, dataset_name):
     """Map dataset_dir to dataset_name
     
@@ -310,9 +663,41 @@ def pc_file_index(pc_name_map):
                 file_index = f
         pri.append(d[1]['priority'])
     logger.debug(file_index)
+    files = [f for paths in file_index.values() for f in paths]
+    indexed = indexed_files(file_index)
+    logger.info("%s of %s point cloud files have a spatial index (.lax)",
+                len(indexed), len(files))
     return file_index
 
 
+def lax_path(path):
+    """Path of the LAStools spatial index (.lax) of a LAS/LAZ file"""
+    return os.path.splitext(path)[0] + '.lax'
+
+
+def has_index(path):
+    """True if the LAS/LAZ file has a spatial index that is newer than the file"""
+    lax = lax_path(path)
+    return os.path.isfile(lax) and os.path.getmtime(lax) >= os.path.getmtime(path)
+
+
+def indexed_files(file_index):
+    """The point cloud files that have an up-to-date spatial index (.lax)
+    
+    Parameters
+    ----------
+    file_index : dict
+        As returned by :py:func:`pc_file_index`
+    
+    Returns
+    -------
+    set of str
+        Paths of the indexed files
+    """
+    return set(f for paths in file_index.values() for f in paths 
+               if has_index(f))
+
+
 def find_pc_tiles(conn, table_index_pc, fields_index_pc, idx_identical,
                   table_index_footprint=None, fields_index_footprint=None,
                   extent_ewkb=None, tile_footprint=None,
@@ -359,7 +744,7 @@ def find_pc_tiles(conn, table_index_pc, fields_index_pc, idx_identical,
                     schema_pc=schema_pc_q,
                     tile=tile_q)
         logger.debug(conn.print_query(query))
-        resultset = conn.getQuery(query)
+        resultset = conn.getQuery(query, hot=True)
         tiles = {}
         for tile in resultset:
             tile_id = tile[0].lower()
@@ -409,7 +794,7 @@ def find_pc_tiles(conn, table_index_pc, fields_index_pc, idx_identical,
                     field_pc_geom=field_pc_geom_q,
                     field_ftpr_geom=field_ftpr_geom_q)
         logger.debug(conn.print_query(query))
-        resultset = conn.getQuery(query)
+        resultset = conn.getQuery(query, hot=True)
         tiles = {}
         for tile in resultset:
             tile_id = tile[0].lower()
@@ -542,13 +927,61 @@ def get_2Dtile_area(db, table_index):
     return db.getQuery(query)[0][0]
 
 
-def get_2Dtile_views(db, schema_tiles, tiles):
+def read_tile_catalog(db, schema_tiles):
+    """Read the tile catalog of schema_tiles into memory
+    
+    The catalog is created by :py:func:`bag3d.config.footprints.create_views`.
+
+    Parameters
+    ----------
+    db : :py:class:`bag3d.config.db.db`
+        Open connection
+    schema_tiles: str
+        Name of the schema where the 2D tile views are stored.
+
+    Returns
+    -------
+    dict
+        {'tiles' : {tile ID : entry}, 'views' : {view name : entry}}, where 
+        an entry is {'view', 'footprint_cnt', 'bbox', 'fields', 'geometry'} 
+        and bbox is (xmin, ymin, xmax, ymax) of the footprints. The entries 
+        are keyed both ways, so that a tile is looked up by its ID or view 
+        name in constant time. None if there is no catalog in schema_tiles.
+    """
+    catalog = sql.Literal("{}.{}".format(
+        sql.Identifier(schema_tiles).as_string(db.conn),
+        sql.Identifier(footprints.TILE_CATALOG).as_string(db.conn)))
+    if db.getQuery(sql.SQL("SELECT to_regclass({});").format(catalog))[0][0] is None:
+        logger.info("There is no tile catalog in %s", schema_tiles)
+        return None
+    query = sql.SQL("""
+    SELECT tile_id, view_name, footprint_cnt,
+        st_xmin(bbox), st_ymin(bbox), st_xmax(bbox), st_ymax(bbox),
+        fields, geometry_column
+    FROM {schema}.{catalog};
+    """).format(schema=sql.Identifier(schema_tiles),
+                catalog=sql.Identifier(footprints.TILE_CATALOG))
+    logger.debug(db.print_query(query))
+    tiles = {}
+    for r in db.getQuery(query):
+        tiles[r[0]] = {'view': r[1],
+                       'footprint_cnt': r[2],
+                       'bbox': r[3:7] if r[3] is not None else None,
+                       'fields': r[7],
+                       'geometry': r[8]}
+    logger.debug("Read %s tiles from the tile catalog", len(tiles))
+    return {'tiles': tiles,
+            'views': {t['view']: t for t in tiles.values()}}
+
+
+def get_2Dtile_views(db, schema_tiles, tiles, catalog=None):
     """Get View names of the 2D tiles. It tries to find views in schema_tiles
     that contain the respective tile ID in their name.
     
     Note
     ----
-    It uses wildcard search to subsitute prefixes.
+    Without a catalog, it uses wildcard search on information_schema to 
+    subsitute prefixes.
 
     Parameters
     ----------
@@ -558,12 +991,27 @@ def get_2Dtile_views(db, schema_tiles, tiles):
         Name of the schema where the 2D tile views are stored.
     tiles : list
         Tile IDs
+    catalog : dict
+        The tile catalog, as returned by :py:func:`read_tile_catalog`. If 
+        provided, the views are looked up in the catalog.
 
     Returns
     -------
     list
         Name of the view that contain the tile ID as substring.
     """
+    if catalog:
+        tile_views = [catalog['tiles'][str(t)]['view'] for t in tiles 
+                      if str(t) in catalog['tiles']]
+        if len(tile_views) < len(tiles):
+            logger.warning("%s tiles are not in the tile catalog",
+                           len(tiles) - len(tile_views))
+        if tile_views:
+            return tile_views
+        else:
+            logger.error("get_2Dtile_views did not find %s in the tile catalog",
+                         tiles)
+            return None
     # Get View names for the tiles
     tstr = ["%" + str(tile) for tile in tiles]
     t = sql.Literal(tstr)
@@ -609,7 +1057,7 @@ def clip_2Dtiles(db, user_schema, schema_tiles, tiles, poly, clip_prefix,
     fields_all = fields_view['all']
     field_geom_q = sql.Identifier(fields_view['geometry'])
 
-    #FIXME: append all queries into a single string
+    queries = []
     for tile in tiles:
         t = clip_prefix + tile
         tiles_clipped.append(t)
@@ -632,19 +1080,10 @@ def clip_2Dtiles(db, user_schema, schema_tiles, tiles, poly, clip_prefix,
                                  tile_view=tile_view,
                                  geom=field_geom_q,
                                  wkb=wkb)
-        db.sendQuery(query)
-    try:
-        db.conn.commit()
-        print(
-            str(
-                len(tiles_clipped)) +
-            " views with prefix '{}' are created in schema {}.".format(
-                clip_prefix,
-                user_schema))
-    except BaseException:
-        print("Cannot create view {user_schema}.{clip_prefix}{tile}".format(
-            schema_tiles=schema_tiles, clip_prefix=clip_prefix))
-        db.conn.rollback()
+        queries.append(query)
+    db.execute_batch(queries)
+    logger.debug("%s views with prefix '%s' are created in schema %s.",
+                 len(tiles_clipped), clip_prefix, user_schema.as_string(db.conn))
 
     return(tiles_clipped)
 
@@ -707,18 +1146,24 @@ def union_2Dtiles(db, user_schema, tiles_clipped, clip_prefix, fields_view):
     return u
 
 
-def get_view_fields(db, user_schema, tile_views):
+def get_view_fields(db, user_schema, tile_views, catalog=None):
     """Get the fields in a 2D tile view
 
     Parameters
     ----------
     tile_views : list of str
+    catalog : dict
+        The tile catalog, as returned by :py:func:`read_tile_catalog`. If 
+        the view is in it, the fields are taken from the catalog.
 
     Returns
     -------
     dict
         {'all' : list, 'geometry' : str}
     """
+    if catalog and len(tile_views) > 0 and tile_views[0] in catalog['views']:
+        t = catalog['views'][tile_views[0]]
+        return {'all': list(t['fields']), 'geometry': t['geometry']}
     if len(tile_views) > 0:
         schema_q = sql.Literal(user_schema)
         view_q = sql.Literal(tile_views[0])
@@ -830,6 +1275,8 @@ def configure_tiles(conn, config, clip_prefix):
         - `clip_prefix` : 
         - `tile_out` : name of the tile
         - extent_ewkb : ewkb of the extent polygon
+        - tile_catalog : the tile catalog of input_polygons:tile_schema, as 
+        returned by :py:func:`read_tile_catalog`
         - tile_list is overwritten, either based on the provided extent or 
         the provided tile names are substituted with the names of the tile 
         views in input_polygons:tile_schema
@@ -837,6 +1284,8 @@ def configure_tiles(conn, config, clip_prefix):
     config["clip_prefix"] = clip_prefix
     config["tile_out"] = None
     config["extent_ewkb"] = None
+    config["tile_catalog"] = read_tile_catalog(
+        conn, config["input_polygons"]["tile_schema"])
     logger.debug("tile_list: %s", config["input_polygons"]["tile_list"])
     # TODO: assert that CREATE/DROP allowed on TILE_SCHEMA and/or USER_SCHEMA
     if config["input_polygons"]["extent"]:
@@ -850,10 +1299,10 @@ def configure_tiles(conn, config, clip_prefix):
         # Get view names for tiles
         tile_views = get_2Dtile_views(conn, 
                                       config["input_polygons"]["tile_schema"], 
-                                      tiles)
+                                      tiles, config["tile_catalog"])
         view_fields = get_view_fields(conn, 
                                       config["input_polygons"]["tile_schema"], 
-                                      tile_views)
+                                      tile_views, config["tile_catalog"])
         # clip 2D tiles to extent
         tiles_clipped = clip_2Dtiles(conn, 
                                      config["input_polygons"]['user_schema'], 
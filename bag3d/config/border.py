@@ -9,6 +9,7 @@ import copy
 import re
 import logging
 from random import shuffle
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
 
 import yaml
@@ -21,6 +22,201 @@ from bag3d.config import batch3dfier
 logger = logging.getLogger(__name__)
 
 
+def get_adjacency_table(config):
+    """Name of the tile adjacency table of the AHN tile index
+    
+    Uses tile_index:elevation:adjacency_table if set, otherwise the name of
+    the AHN tile index with an '_adjacency' suffix.
+    
+    Parameters
+    ----------
+    config : dict
+        bag3d configuration parameters
+    
+    Returns
+    -------
+    str
+        Name of the adjacency table, in the schema of tile_index:elevation
+    """
+    elevation = config["tile_index"]['elevation']
+    if elevation.get('adjacency_table'):
+        return elevation['adjacency_table']
+    else:
+        return elevation['table'] + "_adjacency"
+
+
+def update_adjacency_table(conn, config, rebuild=False, doexec=True):
+    """Creates or updates the tile adjacency table of the AHN tile index
+    
+    The adjacency table stores every pair of touching tiles (tile_a, tile_b) 
+    in both directions. It only depends on the tile geometries, thus the 
+    AHN version of a tile is joined at query time and the table does not 
+    need to be recomputed when the AHN versions change.
+    
+    The table is updated incrementally. The checksum of the geometry of each 
+    tile that is in the adjacency table is stored in the '<adjacency>_tiles' 
+    table. The pairs of the tiles that are not in the tile index anymore or 
+    whose geometry has changed are deleted, and the neighbours are only 
+    computed for these tiles and the new tiles. The neighbours are found with 
+    an index-backed join (&& bounding box prefilter on the GIST index), 
+    instead of a cross join.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    config : dict
+        bag3d configuration parameters
+    rebuild : bool
+        Recompute the whole table
+    
+    Returns
+    -------
+    None
+        Creates/updates the adjacency table in the schema of tile_index:elevation
+    """
+    adjacency = get_adjacency_table(config)
+    tbl_schema = sql.Identifier(config["tile_index"]['elevation']['schema'])
+    tbl_name = sql.Identifier(config["tile_index"]['elevation']['table'])
+    tbl_tile = sql.Identifier(config["tile_index"]['elevation']['fields']['unit_name'])
+    tbl_geom = sql.Identifier(config["tile_index"]['elevation']['fields']['geometry'])
+    adj_table = sql.Identifier(adjacency)
+    adj_tiles = sql.Identifier(adjacency + "_tiles")
+    
+    create_q = sql.SQL("""
+    CREATE TABLE IF NOT EXISTS {schema}.{adjacency} (
+        tile_a text,
+        tile_b text,
+        PRIMARY KEY (tile_a, tile_b)
+    );
+    CREATE INDEX IF NOT EXISTS {idx_b} ON {schema}.{adjacency} (tile_b);
+    CREATE TABLE IF NOT EXISTS {schema}.{adj_tiles} (
+        tile text PRIMARY KEY,
+        geom_md5 text
+    );
+    """).format(
+        schema=tbl_schema,
+        adjacency=adj_table,
+        adj_tiles=adj_tiles,
+        idx_b=sql.Identifier(adjacency + "_tile_b_idx")
+        )
+    logger.debug(conn.print_query(create_q))
+    
+    if rebuild:
+        delete_q = sql.SQL("""
+        TRUNCATE {schema}.{adjacency}, {schema}.{adj_tiles};
+        """).format(schema=tbl_schema, adjacency=adj_table, adj_tiles=adj_tiles)
+    else:
+        delete_q = sql.SQL("""
+        DELETE FROM {schema}.{adj_tiles} k
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {schema}.{table} t
+            WHERE t.{tile} = k.tile
+            AND md5(st_asbinary(t.{geom})) = k.geom_md5
+        );
+        DELETE FROM {schema}.{adjacency} j
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {schema}.{adj_tiles} k WHERE k.tile = j.tile_a
+        )
+        OR NOT EXISTS (
+            SELECT 1 FROM {schema}.{adj_tiles} k WHERE k.tile = j.tile_b
+        );
+        """).format(
+            schema=tbl_schema,
+            adjacency=adj_table,
+            adj_tiles=adj_tiles,
+            table=tbl_name,
+            tile=tbl_tile,
+            geom=tbl_geom
+            )
+    logger.debug(conn.print_query(delete_q))
+    
+    insert_q = sql.SQL("""
+    INSERT INTO {schema}.{adjacency} (tile_a, tile_b)
+    WITH new_tiles AS (
+        SELECT t.{tile}, t.{geom}
+        FROM {schema}.{table} t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {schema}.{adj_tiles} k WHERE k.tile = t.{tile}
+        )
+    ),
+    pairs AS (
+        SELECT
+            n.{tile} AS tile_a,
+            t.{tile} AS tile_b
+        FROM new_tiles n
+        INNER JOIN {schema}.{table} t ON
+            n.{geom} && t.{geom}
+            AND n.{tile} <> t.{tile}
+            AND st_touches(n.{geom}, t.{geom})
+    )
+    SELECT tile_a, tile_b FROM pairs
+    UNION
+    SELECT tile_b, tile_a FROM pairs
+    ON CONFLICT DO NOTHING;
+    INSERT INTO {schema}.{adj_tiles} (tile, geom_md5)
+    SELECT t.{tile}, md5(st_asbinary(t.{geom}))
+    FROM {schema}.{table} t
+    ON CONFLICT DO NOTHING;
+    """).format(
+        schema=tbl_schema,
+        adjacency=adj_table,
+        adj_tiles=adj_tiles,
+        table=tbl_name,
+        tile=tbl_tile,
+        geom=tbl_geom
+        )
+    logger.debug(conn.print_query(insert_q))
+    
+    if doexec:
+        conn.sendQuery(create_q)
+        conn.sendQuery(delete_q)
+        conn.sendQuery(insert_q)
+        conn.vacuum(config["tile_index"]['elevation']['schema'], adjacency)
+        conn.vacuum(config["tile_index"]['elevation']['schema'], 
+                    adjacency + "_tiles")
+
+
+def get_neighbours(conn, config, tile):
+    """Get the tiles that touch the given tile
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    config : dict
+        bag3d configuration parameters
+    tile : str
+        Tile ID, as in tile_index:elevation:fields:unit_name
+    
+    Returns
+    -------
+    list of tuple
+        (tile ID, ahn_version) of the neighbouring tiles
+    """
+    tbl_schema = sql.Identifier(config["tile_index"]['elevation']['schema'])
+    tbl_name = sql.Identifier(config["tile_index"]['elevation']['table'])
+    tbl_tile = sql.Identifier(config["tile_index"]['elevation']['fields']['unit_name'])
+    tbl_version = sql.Identifier(config["tile_index"]['elevation']['fields']['version'])
+    adj_table = sql.Identifier(get_adjacency_table(config))
+    
+    query = sql.SQL("""
+    SELECT t.{tile}, t.{version}
+    FROM {schema}.{adjacency} j
+    INNER JOIN {schema}.{table} t ON j.tile_b = t.{tile}
+    WHERE j.tile_a = {t};
+    """).format(
+        schema=tbl_schema,
+        adjacency=adj_table,
+        table=tbl_name,
+        tile=tbl_tile,
+        version=tbl_version,
+        t=sql.Literal(tile)
+        )
+    logger.debug(conn.print_query(query))
+    return conn.getQuery(query)
+
+
 def create_border_table(conn, config, doexec=True):
     """Creates the table tile_index:elevation:border_table in the database
     
@@ -31,6 +227,12 @@ def create_border_table(conn, config, doexec=True):
     boundaries (eg a river). Therefore these tiles need to be identified and 
     processed separately.
     
+    The border tiles are the AHN3 tiles that have at least one AHN2 
+    neighbour in the tile adjacency table (see :py:func:`update_adjacency_table`),
+    which is updated before creating the border table. The update is 
+    incremental, thus it is cheap if the table is already up to date after 
+    the import of the AHN tile index.
+    
     If border_table exists, it will drop it first.
     
     Parameters
@@ -47,9 +249,12 @@ def create_border_table(conn, config, doexec=True):
     """
     tbl_schema = sql.Identifier(config["tile_index"]['elevation']['schema'])
     tbl_name = sql.Identifier(config["tile_index"]['elevation']['table'])
+    tbl_tile = sql.Identifier(config["tile_index"]['elevation']['fields']['unit_name'])
     tbl_version = sql.Identifier(config["tile_index"]['elevation']['fields']['version'])
-    tbl_geom = sql.Identifier(config["tile_index"]['elevation']['fields']['geometry'])
     border_table = sql.Identifier(config["tile_index"]['elevation']['border_table'])
+    adj_table = sql.Identifier(get_adjacency_table(config))
+
+    update_adjacency_table(conn, config, doexec=doexec)
 
     drop_q = sql.SQL("""
     DROP TABLE IF EXISTS {schema}.{border_table} CASCADE;
@@ -58,24 +263,22 @@ def create_border_table(conn, config, doexec=True):
     
     create_q = sql.SQL("""
     CREATE TABLE {schema}.{border_table} AS
-    WITH ahn2 AS (
-        SELECT *
-        FROM {schema}.{table}
-        WHERE {version} = 2
-    ),
-    ahn3 AS (
-        SELECT *
-        FROM {schema}.{table}
-        WHERE {version} = 3
-    )
-    SELECT DISTINCT ahn3.*
-    FROM ahn3, ahn2
-    WHERE st_touches(ahn3.{geom}, ahn2.{geom});
+    SELECT ahn3.*
+    FROM {schema}.{table} ahn3
+    WHERE ahn3.{version} = 3
+    AND EXISTS (
+        SELECT 1
+        FROM {schema}.{adjacency} j
+        INNER JOIN {schema}.{table} ahn2 ON j.tile_b = ahn2.{tile}
+        WHERE j.tile_a = ahn3.{tile}
+        AND ahn2.{version} = 2
+    );
     """).format(
             schema=tbl_schema,
             table=tbl_name,
             version=tbl_version,
-            geom=tbl_geom,
+            tile=tbl_tile,
+            adjacency=adj_table,
             border_table=border_table
             )
     logger.debug(conn.print_query(create_q))
@@ -105,6 +308,9 @@ def update_file_date(conn, config, ahn2_dir, ahn2_fp, doexec=True):
     The border tiles only partially contain AHN3 data, therefore they need to be 
     extended with AHN2 data, resulting in a 3D BAG tile with mixed AHN2-3 heights.
     
+    The file dates are read with *threads* parallel lasinfo processes, and 
+    the border table is updated with a single UPDATE ... FROM (VALUES ...).
+    
     Parameters
     ----------
     conn : :py:class:`bag3d.config.db.db`
@@ -141,46 +347,52 @@ def update_file_date(conn, config, ahn2_dir, ahn2_fp, doexec=True):
     logger.debug(conn.print_query(tile_q))
     r = conn.getQuery(tile_q)
     tiles = [field[0].lower() for field in r]
+    if not tiles:
+        logger.info("There are no border tiles to update")
+        return None
+    
+    # lasinfo only reads the header, thus the calls are bound by the process
+    # startup and I/O, not by CPU
+    def file_date(t):
+        return ahn.get_file_date(config['path_lasinfo'], ahn2_dir, ahn2_fp, t, 
+                                 a_date_pat, corruptedfiles)
+    threads = config.get('threads', 1)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        dates = list(executor.map(file_date, tiles))
     
-    queries = sql.Composed('')
-    for e, t in enumerate(tiles):
-        d = ahn.get_file_date(config['path_lasinfo'], ahn2_dir, ahn2_fp, t, a_date_pat, 
-                              corruptedfiles)
+    values = []
+    for t, d in zip(tiles, dates):
         if d:
             date = d.isoformat()
-            query = sql.SQL("""
-            UPDATE {schema}.{border_table}
-            SET file_date = {d}
-            WHERE {tile} = {t};
-            """).format(
-                    schema=tbl_schema,
-                    border_table=border_table,
-                    d=psycopg2.sql.Literal(date),
-                    tile=tbl_tile,
-                    t=psycopg2.sql.Literal(t)
-                )
-            queries += query
         else:
             logger.debug("No file date for tile: %s", t)
             date = None
-            query = sql.SQL("""
-            UPDATE {schema}.{border_table}
-            SET
-            {version} = NULL,
-            file_date = {d}
-            WHERE {tile} = {t};
-            """).format(
-                    schema=tbl_schema,
-                    border_table=border_table,
-                    version = tbl_version,
-                    d=psycopg2.sql.Literal(date),
-                    tile=tbl_tile,
-                    t=psycopg2.sql.Literal(t)
-                )
-            queries += query
-    logger.debug(conn.print_query(queries))
+        values.append(sql.SQL("({t}, {d})").format(t=sql.Literal(t), 
+                                                   d=sql.Literal(date)))
+    
+    # a single set-based UPDATE instead of one statement per tile
+    query = sql.SQL("""
+    UPDATE {schema}.{border_table} b
+    SET
+        file_date = v.file_date::timestamptz,
+        {version} = CASE
+            WHEN v.file_date IS NULL THEN NULL
+            ELSE b.{version}
+        END
+    FROM (
+        VALUES {values}
+    ) AS v(tile, file_date)
+    WHERE b.{tile} = v.tile;
+    """).format(
+            schema=tbl_schema,
+            border_table=border_table,
+            version=tbl_version,
+            values=sql.SQL(', ').join(values),
+            tile=tbl_tile
+        )
+    logger.debug(conn.print_query(query))
     if doexec:
-        conn.sendQuery(queries)
+        conn.sendQuery(query)
 
 
 def update_output(cfg, ahn_version, ahn_dir, border_table):
@@ -257,14 +469,24 @@ def update_tile_list(conn, config, tile_list, ahn_version=None,
     Returns
     -------
     dict
-        The updated configuration
+        The updated configuration, with the number of footprints per tile 
+        view from the tile catalog in footprint_cnt
     """
-    c = copy.deepcopy(config)
+    # the tile catalog is not copied into the configurations of the groups
+    c = copy.deepcopy({k:v for k,v in config.items() if k != 'tile_catalog'})
 #     logger.debug(config["input_polygons"]["tile_list"])
     tl = list(set(tile_list).intersection(set(config["input_polygons"]["tile_list"])))
     tile_views = batch3dfier.get_2Dtile_views(conn, config["input_polygons"]["tile_schema"], 
-                                 tl)
+                                 tl, config.get('tile_catalog'))
     c["input_polygons"]["tile_list"] = tile_views
+    # only the footprint counts of the tiles of the group are kept from the 
+    # catalog, so that the footprints are not counted again while lifting
+    catalog = config.get('tile_catalog')
+    if catalog and tile_views:
+        c["footprint_cnt"] = {v: catalog['views'][v]['footprint_cnt'] 
+                              for v in tile_views if v in catalog['views']}
+    else:
+        c["footprint_cnt"] = {}
     
     if ahn_version:
         c = update_output(c, ahn_version, ahn_dir, border_table)
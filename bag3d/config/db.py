@@ -5,15 +5,93 @@
 #from subprocess import run
 import logging
 import re
+import threading
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
 
 import psycopg2
 from psycopg2 import sql
 from psycopg2 import extras
+from psycopg2 import extensions
+
+from bag3d import telemetry
 
 logger = logging.getLogger(__name__)
 
+_query_stats = {}
+_query_stats_lock = threading.Lock()
+
+
+def fingerprint(query):
+    """Normalize a query so that the queries which differ only in their 
+    literal values (tile names, IDs, numbers) have the same fingerprint
+    
+    Parameters
+    ----------
+    query : str
+        SQL query
+    
+    Returns
+    -------
+    str
+        The normalized query
+    """
+    fp = re.sub(r"'(?:[^']|'')*'", "?", query)
+    # tile names in the identifiers, eg. "t_37hn1"
+    fp = re.sub(r'"[^"]*"', lambda m: re.sub(r'\d+', "?", m.group(0)), fp)
+    fp = re.sub(r'\b\d+(?:\.\d+)?\b', "?", fp)
+    fp = re.sub(r'\s+', " ", fp).strip()
+    fp = re.sub(r'ARRAY\[[?,\s]*\]', "?", fp)
+    fp = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', "(?)", fp)
+    return fp
+
+
+def query_stats():
+    """The statistics of the queries that were run so far
+    
+    Returns
+    -------
+    dict
+        {fingerprint : {'calls', 'time', 'max_time', 'rows', 'plan'}}
+    """
+    with _query_stats_lock:
+        return {k:dict(v) for k,v in _query_stats.items()}
+
+
+def query_report(n=20):
+    """Format the n query fingerprints with the most total time as a table"""
+    stats = sorted(query_stats().items(), key=lambda x: x[1]['time'], 
+                   reverse=True)[:n]
+    lines = ["%10s %8s %10s %10s  %s" % ("total (s)", "calls", "max (s)", 
+                                         "rows", "query")]
+    for fp,s in stats:
+        lines.append("%10.2f %8d %10.2f %10d  %s" % (
+            s['time'], s['calls'], s['max_time'], s['rows'], fp[:200]))
+    return "\n".join(lines)
+
+
 class db(object):
-    """A database connection class """
+    """A database connection class
+    
+    Every query that is run with sendQuery, getQuery and get_dict is timed 
+    and recorded by its fingerprint (see :py:func:`fingerprint` and 
+    :py:func:`query_report`). The queries that take longer than 
+    *slow_query* seconds are logged. If *explain_hot* is set, the queries 
+    that are run with ``hot=True`` are also run with 
+    ``EXPLAIN (ANALYZE, BUFFERS)`` (and rolled back) once per fingerprint, and 
+    their plan is logged.
+    
+    :py:meth:`execute_batch` runs many statements (eg. the DDL of the tile 
+    views) in transactions of *ddl_batch_size* statements, over 
+    *ddl_connections* connections. The 3dfier output is imported over 
+    *copy_connections* connections (see :py:func:`bag3d.importer.csv2db`).
+    """
+    
+    slow_query = 10.0
+    explain_hot = False
+    ddl_batch_size = 500
+    ddl_connections = 1
+    copy_connections = 4
 
     def __init__(self, dbname, host, port, user, password=None):
         self.dbname = dbname
@@ -31,12 +109,86 @@ class db(object):
             logger.exception("I'm unable to connect to the database")
             raise
 
-    def sendQuery(self, query):
+    def _record(self, query, duration, rowcount, hot=False):
+        """Record the statistics of a query"""
+        try:
+            q = query if isinstance(query, str) else self.print_query(query)
+        except BaseException:
+            q = str(query)
+        fp = fingerprint(q)
+        with _query_stats_lock:
+            st = _query_stats.setdefault(fp, {'calls': 0, 'time': 0.0, 
+                                              'max_time': 0.0, 'rows': 0,
+                                              'plan': None})
+            st['calls'] += 1
+            st['time'] += duration
+            st['max_time'] = max(st['max_time'], duration)
+            st['rows'] += max(rowcount, 0)
+            explain = hot and self.explain_hot and st['plan'] is None
+            if explain:
+                st['plan'] = ''
+        if self.slow_query is not None and duration >= self.slow_query:
+            logger.warning("Slow query (%.2fs, %s rows): %s", duration, 
+                           rowcount, q)
+        if explain:
+            plan = self.explain(query)
+            if plan:
+                logger.info("Query plan of %s\n%s", fp, plan)
+                with _query_stats_lock:
+                    _query_stats[fp]['plan'] = plan
+
+    def explain(self, query):
+        """Run EXPLAIN (ANALYZE, BUFFERS) on a query and roll it back
+        
+        The query is explained on a separate connection (see 
+        :py:meth:`clone`), so that the transaction of this connection is not 
+        touched. When this connection is in a transaction (not in autocommit 
+        mode and the query was not committed), the transaction can hold 
+        locks that the EXPLAIN would wait for, thus the query is not 
+        explained.
+
+        Parameters
+        ----------
+        query : str or psycopg2.sql.Composable
+            A single SQL statement
+
+        Returns
+        -------
+        str
+            The query plan, or None if the query cannot be explained
+        """
+        if self.conn.get_transaction_status() != \
+                extensions.TRANSACTION_STATUS_IDLE:
+            logger.debug("Not explaining the query in an open transaction")
+            return None
+        if isinstance(query, str):
+            query = sql.SQL(query)
+        q = sql.SQL("EXPLAIN (ANALYZE, BUFFERS) ") + query
+        plan = None
+        try:
+            conn = self.clone()
+        except psycopg2.Error as e:
+            logger.debug("Cannot explain the query: %s", e)
+            return None
+        try:
+            with conn.conn.cursor() as cur:
+                cur.execute(q)
+                plan = "\n".join(r[0] for r in cur.fetchall())
+        except psycopg2.Error as e:
+            logger.debug("Cannot explain the query: %s", e)
+        finally:
+            conn.conn.rollback()
+            conn.close()
+        return plan
+
+    def sendQuery(self, query, hot=False):
         """Send a query to the DB when no results need to return (e.g. CREATE)
 
         Parameters
         ----------
         query : str
+        hot : bool
+            Capture the query plan if explain_hot is set
 
 
         Returns
@@ -44,17 +196,80 @@ class db(object):
         nothing
 
         """
-        with self.conn:
-            with self.conn.cursor() as cur:
-                cur.execute(query)
+        start = perf_counter()
+        rowcount = -1
+        try:
+            with self.conn:
+                with self.conn.cursor() as cur:
+                    cur.execute(query)
+                    rowcount = cur.rowcount
+        finally:
+            duration = perf_counter() - start
+            telemetry.add_time('db', duration)
+            self._record(query, duration, rowcount, hot)
+
+    def clone(self):
+        """Open a new connection with the same parameters"""
+        return db(dbname=self.dbname, host=self.host, port=self.port,
+                  user=self.user, password=self.password)
 
-    def getQuery(self, query):
+    def execute_batch(self, queries, batch_size=None, connections=None):
+        """Run many statements in batches, each batch in its own transaction
+        
+        The statements must not depend on each other's results, because the 
+        batches are run in parallel when *connections* > 1. The additional 
+        connections are opened with :py:meth:`clone` and closed when done.
+        
+        Parameters
+        ----------
+        queries : list
+            SQL statements (str or psycopg2.sql.Composable)
+        batch_size : int
+            Nr. of statements in a transaction, defaults to *ddl_batch_size*
+        connections : int
+            Nr. of connections to use, defaults to *ddl_connections*
+        
+        Returns
+        -------
+        int
+            Nr. of batches
+        """
+        batch_size = batch_size or self.ddl_batch_size
+        connections = connections or self.ddl_connections
+        queries = [sql.SQL(q) if isinstance(q, str) else q for q in queries]
+        batches = [sql.SQL(";\n").join(queries[i:i+batch_size])
+                   for i in range(0, len(queries), batch_size)]
+        connections = max(1, min(connections, len(batches)))
+        logger.debug("Running %s statements in %s batches on %s connections",
+                     len(queries), len(batches), connections)
+        if connections == 1:
+            for b in batches:
+                self.sendQuery(b)
+            return len(batches)
+
+        pool = [self] + [self.clone() for i in range(connections - 1)]
+
+        def run(i):
+            for b in batches[i::connections]:
+                pool[i].sendQuery(b)
+
+        try:
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                list(executor.map(run, range(connections)))
+        finally:
+            for c in pool[1:]:
+                c.close()
+        return len(batches)
+
+    def getQuery(self, query, hot=False):
         """DB query where the results need to return (e.g. SELECT)
 
         Parameters
         ----------
         query : str
             SQL query
+        hot : bool
+            Capture the query plan if explain_hot is set
 
 
         Returns
@@ -62,27 +277,45 @@ class db(object):
         psycopg2 resultset
 
         """
-        with self.conn:
-            with self.conn.cursor() as cur:
-                cur.execute(query)
-                return cur.fetchall()
+        start = perf_counter()
+        rowcount = -1
+        try:
+            with self.conn:
+                with self.conn.cursor() as cur:
+                    cur.execute(query)
+                    rowcount = cur.rowcount
+                    return cur.fetchall()
+        finally:
+            duration = perf_counter() - start
+            telemetry.add_time('db', duration)
+            self._record(query, duration, rowcount, hot)
 
-    def get_dict(self, query):
+    def get_dict(self, query, hot=False):
         """DB query where the results need to return as a dictionary
 
         Parameters
         ----------
         query : str
             SQL query
+        hot : bool
+            Capture the query plan if explain_hot is set
 
         Returns
         -------
         psycopg2 resultset
         """
-        with self.conn:
-            with self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute(query)
-                return cur.fetchall()
+        start = perf_counter()
+        rowcount = -1
+        try:
+            with self.conn:
+                with self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                    cur.execute(query)
+                    rowcount = cur.rowcount
+                    return cur.fetchall()
+        finally:
+            duration = perf_counter() - start
+            telemetry.add_time('db', duration)
+            self._record(query, duration, rowcount, hot)
     
     def print_query(self, query):
         """Format a SQL query for printing by replacing newlines and tab-spaces"""
@@ -10,6 +10,8 @@ from psycopg2 import sql
 
 logger = logging.getLogger(__name__)
 
+TILE_CATALOG = "tile_catalog"
+
 
 def update_tile_index(db, table_index, fields_index):
     """Update the tile index to include the lower/left boundary of each polygon.
@@ -245,7 +247,7 @@ def create_views(db, schema_tiles, table_index, fields_index, table_centroid,
         prefix_tiles = ""
     assert isinstance(prefix_tiles, str)
     # Create a BAG tile with equivalent area of an AHN tile
-    queries = sql.Composed('')
+    queries = []
     for tile in tiles:
         # !!! the 't_' prefix is hard-coded in config.call3dfier() !!!
         n = prefix_tiles + str(tile)
@@ -289,16 +291,91 @@ def create_views(db, schema_tiles, table_index, fields_index, table_centroid,
               field_idx_geom=field_idx_geom_q,
               field_ctr_geom=field_ctr_geom_q
               )
-        queries += query
-    logger.debug(db.print_query(queries))
-    db.sendQuery(queries)
+        queries.append(query)
+    if queries:
+        logger.debug(db.print_query(queries[0]))
+    db.execute_batch(queries)
 
     logger.debug("%s Views created in schema '%s'." % (len(tiles), schema_tiles))
+    create_tile_catalog(db, schema_tiles, table_index, fields_index,
+                        table_centroid, fields_centroid, table_footprint,
+                        fields_footprint, prefix_tiles)
 
 #     except:
 #         return("Cannot create Views in schema '%s'" % schema_tiles)
 
 
+def create_tile_catalog(db, schema_tiles, table_index, fields_index,
+                        table_centroid, fields_centroid, table_footprint,
+                        fields_footprint, prefix_tiles='t_'):
+    """Creates the catalog of the footprint tiles in schema_tiles.
+
+    The table <schema_tiles>.tile_catalog records for each tile the name of
+    its view, the number and the extent of the footprints in it, and the
+    fields and geometry column of the view. It is read by
+    :py:func:`bag3d.config.batch3dfier.read_tile_catalog`, so the tile views
+    don't need to be looked up in information_schema.
+
+    Parameters
+    ----------
+    The same as of :py:func:`create_views`
+
+    Returns
+    -------
+    nothing
+        nothing
+    """
+    if not prefix_tiles:
+        prefix_tiles = ""
+    fields_view = list(fields_footprint) + [fields_index[2]]
+    query = sql.SQL("""
+    DROP TABLE IF EXISTS {schema_tiles}.{catalog};
+    CREATE TABLE {schema_tiles}.{catalog} (
+        tile_id text PRIMARY KEY,
+        view_name text NOT NULL,
+        footprint_cnt integer,
+        bbox box2d,
+        fields text[],
+        geometry_column text
+    );
+    INSERT INTO {schema_tiles}.{catalog}
+    SELECT
+        idx.{field_idx}::text,
+        {prefix} || idx.{field_idx}::text,
+        count(poly.{field_poly_id}),
+        st_extent(poly.{field_poly_geom}),
+        {fields}::text[],
+        {field_poly_geom_l}
+    FROM
+        {schema_idx}.{table_idx} idx
+    LEFT JOIN {schema_ctr}.{table_ctr} ctr ON
+        st_containsproperly(idx.{field_idx_geom}, ctr.{field_ctr_geom})
+        OR st_contains(idx.geom_border, ctr.{field_ctr_geom})
+    LEFT JOIN {schema_poly}.{table_poly} poly ON
+        poly.{field_poly_id} = ctr.{field_ctr_id}
+    GROUP BY idx.{field_idx};
+    """).format(schema_tiles=sql.Identifier(schema_tiles),
+                catalog=sql.Identifier(TILE_CATALOG),
+                prefix=sql.Literal(prefix_tiles),
+                fields=sql.Literal(fields_view),
+                field_poly_geom_l=sql.Literal(fields_footprint[1]),
+                schema_idx=sql.Identifier(table_index[0]),
+                table_idx=sql.Identifier(table_index[1]),
+                field_idx=sql.Identifier(fields_index[2]),
+                field_idx_geom=sql.Identifier(fields_index[1]),
+                schema_ctr=sql.Identifier(table_centroid[0]),
+                table_ctr=sql.Identifier(table_centroid[1]),
+                field_ctr_id=sql.Identifier(fields_centroid[0]),
+                field_ctr_geom=sql.Identifier(fields_centroid[1]),
+                schema_poly=sql.Identifier(table_footprint[0]),
+                table_poly=sql.Identifier(table_footprint[1]),
+                field_poly_id=sql.Identifier(fields_footprint[0]),
+                field_poly_geom=sql.Identifier(fields_footprint[1]))
+    logger.debug(db.print_query(query))
+    db.sendQuery(query)
+    logger.debug("Created %s.%s", schema_tiles, TILE_CATALOG)
+
+
 def partition(db, schema_tiles, table_index, fields_index, table_footprint,
               fields_footprint, prefix_tiles):
     """Partitions geometries in a 2D footprint table into tiles.
@@ -165,11 +165,14 @@ def postgis(conn, config, out_dir, doexec=True):
     
     # The 3D BAG (building heights + footprint geom)s
     f = os.path.join(postgis_dir, "bag3d_{d}.backup".format(d=date))
-    tbl = "bagactueel.%s" % bag3d
+    tbl = ["--table", "bagactueel.%s" % bag3d]
+    if config["output"].get("compact"):
+        # bag3d is a view of the compact table
+        tbl += ["--table", "bagactueel.%s_compact" % bag3d]
     command = ["pg_dump", "--host", conn.host, "--port", conn.port,
                "--username", conn.user, "--no-password", "--format", 
                "custom", "--no-owner", "--compress", "7", "--encoding", 
-               "UTF8", "--verbose", "--file", f, "--table", tbl, conn.dbname]
+               "UTF8", "--verbose", "--file", f] + tbl + [conn.dbname]
     logger.info("Exporting PostGIS backup")
     bag.run_subprocess(command, shell=True, doexec=doexec)
     compute_md5(f, postgis_dir)
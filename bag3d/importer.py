@@ -3,18 +3,54 @@
 """Import batch3dfier output into the database"""
 
 import os
-from subprocess import run
+import io
+import copy
+import time
+import struct
+from datetime import datetime, timezone
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 
 import psycopg2
 from psycopg2 import sql
 import logging
 
 from bag3d.update import bag
+from bag3d import quality
+from bag3d import telemetry
+from bag3d.batch3dfier.process import get_tile_group
 
 logger = logging.getLogger('import')
 
+BORDER_UNION = "bag3d_border_union"
 
-def create_heights_table(conn, schema, table):
+HEIGHT_FIELDS = ["ground-0.00", "ground-0.10", "ground-0.20", "ground-0.30",
+                 "ground-0.40", "ground-0.50", "roof-0.00", "roof-0.10",
+                 "roof-0.25", "roof-0.50", "roof-0.75", "roof-0.90",
+                 "roof-0.95", "roof-0.99"]
+
+# the spatial orders of the 3D BAG table, see create_bag3d_table
+SPATIAL_ORDERS = [None, 'geohash', 'cluster']
+
+RMSE_FIELDS = ["rmse-0.00", "rmse-0.10", "rmse-0.25", "rmse-0.50", "rmse-0.75",
+               "rmse-0.90", "rmse-0.95", "rmse-0.99"]
+
+# the NODATA value of 3dfier, imported as NULL
+NODATA = "-99.99"
+
+# the types of the fields in 3dfier's CSV-BUILDINGS-MULTIPLE output, the
+# ahn_file_date, ahn_version and tile_id fields are added while importing
+CSV_TYPES = ['text'] + ['float4'] * 22 + ['bool', 'int4', 'int4']
+
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_BINARY_TRAILER = struct.pack('!h', -1)
+_BINARY_NULL = struct.pack('!i', -1)
+_FLOAT4 = struct.Struct('!if')
+_INT4 = struct.Struct('!ii')
+
+
+def create_heights_table(conn, schema, table, unlogged=False):
     """Create a postgres table that can store the content of 3dfier's CSV-BUILDINGS-MULTIPLE output
     
     Note
@@ -30,6 +66,8 @@ def create_heights_table(conn, schema, table):
         Name of the schema where to create the table
     table : string
         Name of the new table
+    unlogged : bool
+        Create an UNLOGGED table, for loading. An existing table is not altered.
     
     Raises
     ------
@@ -45,7 +83,7 @@ def create_heights_table(conn, schema, table):
     schema_q = sql.Identifier(schema)
     table_q = sql.Identifier(table)
     query = sql.SQL("""
-    CREATE TABLE IF NOT EXISTS {schema}.{table} (
+    CREATE {unlogged} TABLE IF NOT EXISTS {schema}.{table} (
         id varchar(16),
         "ground-0.00" real,
         "ground-0.10" real,
@@ -76,7 +114,8 @@ def create_heights_table(conn, schema, table):
         ahn_version smallint,
         tile_id text
         );
-    """).format(schema=schema_q, table=table_q)
+    """).format(schema=schema_q, table=table_q,
+                unlogged=sql.SQL("UNLOGGED" if unlogged else ""))
     logger.debug(conn.print_query(query))
     try:
         conn.sendQuery(query)
@@ -87,14 +126,176 @@ def create_heights_table(conn, schema, table):
         return False
 
 
-def csv2db(conn, cfg, out_paths):
+def ahn_metadata(conn, cfg, tiles):
+    """Get the AHN file date and version of the tiles from the tile index
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    cfg: dict
+        batch3dfier YAML config as returned by :meth:`bag3d.config.args.parse_config`
+    tiles : list of str
+        Tile IDs
+    
+    Returns
+    -------
+    dict
+        {tile ID : (file_date, ahn_version)}
+    """
+    query = sql.SQL("""SELECT {unit_name}, file_date, ahn_version
+                        FROM {schema}.{table}
+                        WHERE {unit_name} = ANY({tiles});
+                    """).format(
+                        schema=sql.Identifier(cfg['tile_index']['elevation']['schema']),
+                        table=sql.Identifier(cfg['tile_index']['elevation']['table']),
+                        unit_name=sql.Identifier(cfg['tile_index']['elevation']['fields']['unit_name']),
+                        tiles=sql.Literal(list(tiles)))
+    logger.debug(conn.print_query(query))
+    return {r[0]: (r[1], r[2]) for r in conn.getQuery(query)}
+
+
+def csv_records(path, ahn_file_date, ahn_version, tile):
+    """Read a CSV-BUILDINGS-MULTIPLE file and append the AHN fields to the records
+    
+    The header is skipped. The trailing comma of the 3dfier output (until #58 
+    is fixed in 3dfier) is replaced by the ahn_file_date, ahn_version and 
+    tile_id values.
+    
+    Returns
+    -------
+    io.StringIO
+        The records, for passing to COPY
+    """
+    sfx = ",%s,%s,%s\n" % (ahn_file_date, ahn_version, tile)
+    out = io.StringIO()
+    with open(path, "r") as f_in:
+        next(f_in, None)
+        for line in f_in:
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            if line.endswith(","):
+                line = line[:-1]
+            out.write(line + sfx)
+    out.seek(0)
+    return out
+
+
+def _binary_field(typ, value):
+    """Encode a CSV value as a field of the PostgreSQL binary COPY format"""
+    if value == NODATA:
+        return _BINARY_NULL
+    if typ == 'float4':
+        return _FLOAT4.pack(4, float(value))
+    elif typ == 'int4':
+        return _INT4.pack(4, int(value))
+    elif typ == 'bool':
+        v = value.lower()
+        if v in ('true', 't', '1'):
+            return b'\x00\x00\x00\x01\x01'
+        elif v in ('false', 'f', '0'):
+            return b'\x00\x00\x00\x01\x00'
+        raise ValueError("invalid boolean '%s'" % value)
+    else:
+        b = value.encode('utf-8')
+        return struct.pack('!i', len(b)) + b
+
+
+def _binary_ahn_fields(ahn_file_date, ahn_version, tile):
+    """Encode the ahn_file_date, ahn_version and tile_id fields"""
+    if ahn_file_date is None:
+        out = _BINARY_NULL
+    else:
+        if not isinstance(ahn_file_date, datetime):
+            ahn_file_date = datetime.combine(ahn_file_date, datetime.min.time())
+        if ahn_file_date.tzinfo is None:
+            ahn_file_date = ahn_file_date.replace(tzinfo=timezone.utc)
+        d = ahn_file_date - PG_EPOCH
+        us = (d.days * 86400 + d.seconds) * 1000000 + d.microseconds
+        out = struct.pack('!iq', 8, us)
+    if ahn_version is None:
+        out += _BINARY_NULL
+    else:
+        out += struct.pack('!ih', 2, int(ahn_version))
+    return out + _binary_field('text', tile)
+
+
+def csv_binary(path, ahn_file_date, ahn_version, tile):
+    """Convert a CSV-BUILDINGS-MULTIPLE file to the PostgreSQL binary COPY format
+    
+    The records are parsed and validated in Python, so the server does not 
+    need to parse and cast the values. The NODATA values of 3dfier become 
+    NULL. The header is skipped, the trailing comma of the 3dfier output is 
+    ignored.
+    
+    Parameters
+    ----------
+    path : str
+        Path to the CSV file
+    ahn_file_date : datetime.datetime
+        File date of the AHN tile. A naive datetime is taken as UTC.
+    ahn_version : int
+        AHN version of the tile
+    tile : str
+        Tile ID
+    
+    Raises
+    ------
+    ValueError
+        If a record does not have the 26 fields of the 3dfier output or has 
+        an invalid value. The message contains the tile and the line number.
+    
+    Returns
+    -------
+    io.BytesIO
+        The records, for passing to COPY ... WITH (FORMAT binary)
+    """
+    nr_fields = len(CSV_TYPES)
+    ntuple = struct.pack('!h', nr_fields + 3)
+    ahn_fields = _binary_ahn_fields(ahn_file_date, ahn_version, tile)
+    out = io.BytesIO()
+    out.write(_BINARY_HEADER)
+    with open(path, "r") as f_in:
+        next(f_in, None)
+        for lineno, line in enumerate(f_in, start=2):
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            fields = line.split(",")
+            if len(fields) == nr_fields + 1 and fields[-1] == '':
+                fields.pop()
+            if len(fields) != nr_fields:
+                raise ValueError("Tile %s, line %s: expected %s fields, got %s" % (
+                    tile, lineno, nr_fields, len(fields)))
+            try:
+                row = [_binary_field(t, v) for t,v in zip(CSV_TYPES, fields)]
+            except (ValueError, struct.error) as e:
+                raise ValueError("Tile %s, line %s: %s" % (tile, lineno, e))
+            out.write(ntuple)
+            out.write(b''.join(row))
+            out.write(ahn_fields)
+    out.write(_BINARY_TRAILER)
+    out.seek(0)
+    return out
+
+
+def csv2db(conn, cfg, out_paths, connections=None):
     """Create a table with multiple height info per BAG building footprint
     
+    The AHN file date and version of all tiles are fetched in a single query 
+    and appended to the records of the CSV files. The files are loaded with 
+    COPY in parallel over *connections* connections, into an UNLOGGED table, 
+    which is then set to LOGGED and indexed on the 'id'.
+    
+    If output:copy_format is 'binary', the records are parsed and validated 
+    in Python by :py:func:`csv_binary` and loaded with binary COPY. The files 
+    with malformed records are not imported and they are reported with the 
+    tile and line number.
+    
     Note
     ----
     Only for 3dfier's CSV-BUILDINGS-MULTIPLE output. 
-    Only Linux.
-    Alter the CSV files by adding the ahn_file_date, ahn_version fields and values.
     
     Parameters
     ----------
@@ -104,82 +305,97 @@ def csv2db(conn, cfg, out_paths):
         batch3dfier YAML config as returned by :meth:`bag3d.config.args.parse_config`
     out_paths: list of strings
         Paths of the CSV files
-    """
-    schema_pc_q = sql.Identifier(cfg['tile_index']['elevation']['schema'])
-    table_pc_q = sql.Identifier(cfg['tile_index']['elevation']['table'])
-    field_pc_unit_q = sql.Identifier(cfg['tile_index']['elevation']['fields']['unit_name'])
+    connections : int
+        Nr. of parallel connections, defaults to :py:attr:`bag3d.config.db.db.copy_connections`.
+        The additional connections are opened with 
+        :py:meth:`bag3d.config.db.db.clone`.
     
+    Returns
+    -------
+    list of str
+        The tiles that could not be imported
+    """
     schema_out_q = sql.Identifier(cfg['output']['schema'])
     table_out_q = sql.Identifier(cfg['output']['table'])
     
-    table_idx = sql.Identifier(cfg['output']['schema'] + "_id_idx")
-    a = create_heights_table(conn, cfg['output']['schema'], cfg['output']['table'])
-
+    table_idx = sql.Identifier(cfg['output']['table'] + "_id_idx")
     conn.sendQuery(sql.SQL("CREATE SCHEMA IF NOT EXISTS {schema};").format(schema=schema_out_q))
+    a = create_heights_table(conn, cfg['output']['schema'], cfg['output']['table'],
+                             unlogged=True)
     
     if a:
-        tbl = ".".join([cfg['output']['schema'], cfg['output']['table']])
-        with conn.conn.cursor() as cur:
-            for path in out_paths:
-                csv_file = os.path.split(path)[1]
-                fname = os.path.splitext(csv_file)[0]
-                tile = fname.replace(cfg['prefix_tile_footprint'], '', 1)
-                tile_q = sql.Literal(tile)
-                
-                query = sql.SQL("""SELECT file_date, ahn_version
-                                    FROM {schema}.{table}
-                                    WHERE {unit_name} = {tile};
-                                """).format(schema=schema_pc_q,
-                                           table=table_pc_q,
-                                           unit_name=field_pc_unit_q,
-                                           tile=tile_q)
-                logger.debug(conn.print_query(query))
-                resultset = conn.getQuery(query)
-                logger.debug(resultset)
-                # the AHN3 file creation date that is stored in the tile index
+        tile_group = get_tile_group(cfg)
+        tiles = csv_tiles(cfg, out_paths)
+        metadata = ahn_metadata(conn, cfg, tiles)
+        binary = cfg['output'].get('copy_format') == 'binary'
+        if binary:
+            copy_q = sql.SQL("COPY {schema}.{table} FROM STDIN WITH (FORMAT binary);"
+                             ).format(schema=schema_out_q, table=table_out_q)
+        else:
+            copy_q = sql.SQL("""COPY {schema}.{table} FROM STDIN 
+                                WITH (DELIMITER ',', NULL {nodata});
+                             """).format(schema=schema_out_q, table=table_out_q,
+                                         nodata=sql.Literal(NODATA))
+        failed = []
+        connections = max(1, min(connections or conn.copy_connections, 
+                                 len(out_paths)))
+        pool = Queue()
+        pool.put(conn)
+        for i in range(connections - 1):
+            pool.put(conn.clone())
+        logger.info("Importing %s CSV files on %s connections", 
+                    len(out_paths), connections)
+        
+        def copy_csv(path, tile):
+            start = time.perf_counter()
+            # the AHN3 file creation date that is stored in the tile index
+            if tile not in metadata or metadata[tile][0] is None:
+                logger.error("No AHN file date and version for tile %s", tile)
+            ahn_file_date, ahn_version = metadata.get(tile, (None, None))
+            if binary:
                 try:
-                    ahn_file_date = resultset[0][0].isoformat()
-                    ahn_version = resultset[0][1]
-                except (IndexError, AttributeError) as e:
-                    ahn_file_date = -99.99
-                    ahn_version = -99.99
-                    logger.error(e)
-                
-                # Need to do some linux text-fu so that the whole csv file can
-                # be imported with COPY instead of row-wise edit and import
-                # in python (suuuper slow)
-                # Watch out for trailing commas from the CSV (until #58 is fixed in 3dfier)
-                cmd_add_ahn = "gawk -i inplace -F',' 'BEGIN { OFS = \",\" } {$27=\"%s,%s,%s\"; print}' %s" % (
-                    ahn_file_date, 
-                    ahn_version,
-                    tile,
-                    path)
-                run(cmd_add_ahn, shell=True)
-                cmd_header = "sed -i '1s/.*/id,ground-0.00,ground-0.10,ground-0.20,\
-ground-0.30,ground-0.40,ground-0.50,roof-0.00,rmse-0.00,roof-0.10,rmse-0.10,\
-roof-0.25,rmse-0.25,roof-0.50,rmse-0.50,roof-0.75,rmse-0.75,roof-0.90,rmse-0.90,\
-roof-0.95,rmse-0.95,roof-0.99,rmse-0.99,roof_flat,nr_ground_pts,nr_roof_pts,\
-ahn_file_date,ahn_version,tile_id/' %s" % path
-                run(cmd_header, shell=True)
-                
-                with open(path, "r") as f_in:
-                    next(f_in) # skip header
-                    logger.debug(f_in)
-                    cur.copy_from(f_in, tbl, sep=',', null='-99.99')
-                        
-        conn.sendQuery(
-            sql.SQL("""CREATE INDEX IF NOT EXISTS {table}
-                    ON {schema_q}.{table_q} (id);
-                    """).format(schema_q=schema_out_q,
-                                table_q=table_out_q,
-                                table=table_idx)
-        )
-        conn.sendQuery(
-            sql.SQL("""COMMENT ON TABLE {schema}.{table} IS
-                    'Building heights generated with 3dfier.';
-                    """).format(schema=schema_out_q,
-                               table=table_out_q)
-        )
+                    records = csv_binary(path, ahn_file_date, ahn_version, tile)
+                except ValueError as e:
+                    logger.error("Cannot import %s: %s", path, e)
+                    failed.append(tile)
+                    return
+            else:
+                ahn_file_date = NODATA if ahn_file_date is None \
+                    else ahn_file_date.isoformat()
+                ahn_version = NODATA if ahn_version is None else ahn_version
+                records = csv_records(path, ahn_file_date, ahn_version, tile)
+            c = pool.get()
+            try:
+                with c.conn:
+                    with c.conn.cursor() as cur:
+                        cur.copy_expert(copy_q, records)
+                        rows = cur.rowcount
+            finally:
+                pool.put(c)
+            telemetry.record('import', group=tile_group, tile=tile,
+                             rows=rows,
+                             import_time=time.perf_counter() - start)
+        
+        try:
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                list(executor.map(copy_csv, out_paths, tiles))
+        finally:
+            while not pool.empty():
+                c = pool.get()
+                if c is not conn:
+                    c.close()
+        
+        query = sql.SQL("""
+        ALTER TABLE {schema_q}.{table_q} SET LOGGED;
+        CREATE INDEX IF NOT EXISTS {table} ON {schema_q}.{table_q} (id);
+        COMMENT ON TABLE {schema_q}.{table_q} IS
+            'Building heights generated with 3dfier.';
+        """).format(schema_q=schema_out_q, table_q=table_out_q, table=table_idx)
+        logger.debug(conn.print_query(query))
+        conn.sendQuery(query)
+        if failed:
+            logger.error("Could not import %s tiles: %s", len(failed), failed)
+        return failed
     else:
         logger.error("csv2db: exit because create_heights_table returned False")
         raise
@@ -307,6 +523,32 @@ def create_bag3d_relations(conn, cfg):
     conn.sendQuery(query)
 
 
+def csv_paths(out_dir):
+    """The paths of the CSV files in the 3dfier output directory
+    
+    Raises
+    ------
+    UnboundLocalError
+        If the directory does not exist
+    """
+    for root, dir, filenames in os.walk(out_dir, topdown=True):
+        csv_files = [f for f in filenames if os.path.splitext(f)[1].lower() == ".csv"]
+        out_paths = [os.path.join(out_dir, f) for f in csv_files]
+    try:
+        logger.debug("out_paths: %s", out_paths)
+        logger.info("There are {} CSV files in the directory".format(len(csv_files)))
+    except UnboundLocalError as e:
+        logger.exception("Couln't find any CSVs in %s", out_dir)
+        raise
+    return out_paths
+
+
+def csv_tiles(cfg, out_paths):
+    """The tile IDs of the CSV files"""
+    return [os.path.splitext(os.path.basename(p))[0].replace(
+                cfg['prefix_tile_footprint'], '', 1) for p in out_paths]
+
+
 def import_csv(conn, cfg):
     """Import the batch3dfier CSV output into the BAG database
     
@@ -317,20 +559,99 @@ def import_csv(conn, cfg):
     cfg: dict
         batch3dfier YAML config as returned by :meth:`bag3d.config.args.parse_config`
     """
-    
-    # Get CSV files in dir
-    for root, dir, filenames in os.walk(cfg['output']['dir'], topdown=True):
-        csv_files = [f for f in filenames if os.path.splitext(f)[1].lower() == ".csv"]
-        out_paths = [os.path.join(cfg['output']['dir'], f) for f in csv_files]
-    try:
-        logger.debug("out_paths: %s", out_paths)
-        logger.info("There are {} CSV files in the directory".format(len(csv_files)))
-    except UnboundLocalError as e:
-        logger.exception("Couln't find any CSVs in %s", cfg['output']['dir'])
-        raise
+    out_paths = csv_paths(cfg['output']['dir'])
     csv2db(conn, cfg, out_paths)
     # TODO: add option for dropping the relations if exist
     create_bag3d_relations(conn, cfg)
+    quality.update_tile_quality(conn, cfg, csv_tiles(cfg, out_paths))
+
+
+def merged_border_name(name):
+    """Name of the merged border table from the name of the AHN3 border table
+    
+    Only the '_ahn3' suffix that :py:func:`bag3d.config.border.update_output` 
+    adds is removed, eg. 'heights_ahn3_border_ahn3' -> 'heights_ahn3_border'.
+    """
+    sfx = '_ahn3'
+    if name.endswith(sfx):
+        return name[:-len(sfx)]
+    else:
+        return name
+
+
+def merge_border_csv(conn, cfg_ahn2, cfg_ahn3):
+    """Import the AHN2 and AHN3 output of the border tiles into a single table
+    
+    Alternative to importing both border tile groups with 
+    :py:func:`import_csv` and uniting them with :py:func:`unite_border_tiles`. 
+    The heights are resolved per building while importing: the AHN3 heights 
+    are kept if none of them is NULL, otherwise the AHN2 heights are used. 
+    Thus only a single 3D BAG table is created for the border tiles, with 
+    the name of output:bag3d_table without the '_ahn3' suffix (eg. 
+    'bag3d_border'), which then can be passed to :py:func:`create_bag3d_table`.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    cfg_ahn2 : dict
+        Configuration of the AHN2 border tiles, as returned by 
+        :py:func:`bag3d.config.border.process`
+    cfg_ahn3 : dict
+        Configuration of the AHN3 border tiles
+    
+    Returns
+    -------
+    dict
+        The configuration of the merged border tiles
+    """
+    cfg = copy.deepcopy(cfg_ahn3)
+    for k in ['table', 'bag3d_table']:
+        cfg['output'][k] = merged_border_name(cfg_ahn3['output'][k])
+    schema_q = sql.Identifier(cfg['output']['schema'])
+    table_q = sql.Identifier(cfg['output']['table'])
+    table_ahn2_q = sql.Identifier(cfg_ahn2['output']['table'])
+    
+    drop_q = sql.SQL("""
+    DROP TABLE IF EXISTS {schema}.{table};
+    DROP TABLE IF EXISTS {schema}.{table_ahn2};
+    """).format(schema=schema_q, table=table_q, table_ahn2=table_ahn2_q)
+    logger.debug(conn.print_query(drop_q))
+    conn.sendQuery(drop_q)
+    
+    tiles = []
+    paths_ahn3 = csv_paths(cfg_ahn3['output']['dir'])
+    paths_ahn2 = csv_paths(cfg_ahn2['output']['dir'])
+    if paths_ahn3:
+        csv2db(conn, cfg, paths_ahn3)
+        tiles += csv_tiles(cfg, paths_ahn3)
+    else:
+        create_heights_table(conn, cfg['output']['schema'], cfg['output']['table'])
+    if paths_ahn2:
+        csv2db(conn, cfg_ahn2, paths_ahn2)
+        tiles += csv_tiles(cfg_ahn2, paths_ahn2)
+    else:
+        create_heights_table(conn, cfg['output']['schema'], cfg_ahn2['output']['table'])
+    
+    notnull = sql.SQL(" AND ").join(
+        sql.SQL("{} IS NOT NULL").format(sql.Identifier(f)) for f in HEIGHT_FIELDS)
+    query = sql.SQL("""
+    DELETE FROM {schema}.{table} WHERE NOT ({notnull});
+    INSERT INTO {schema}.{table}
+    SELECT b.*
+    FROM {schema}.{table_ahn2} b
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {schema}.{table} a WHERE a.id = b.id
+    );
+    DROP TABLE {schema}.{table_ahn2};
+    """).format(schema=schema_q, table=table_q, table_ahn2=table_ahn2_q,
+                notnull=notnull)
+    logger.debug(conn.print_query(query))
+    conn.sendQuery(query)
+    
+    create_bag3d_relations(conn, cfg)
+    quality.update_tile_quality(conn, cfg, sorted(set(tiles)))
+    return cfg
 
 
 def unite_border_tiles(conn, schema, border_ahn2, border_ahn3):
@@ -384,7 +705,7 @@ def unite_border_tiles(conn, schema, border_ahn2, border_ahn3):
     """
     
     query = sql.SQL("""
-    CREATE OR REPLACE VIEW {schema}.bag3d_border_union AS
+    CREATE OR REPLACE VIEW {schema}.{border_union} AS
     WITH border_ahn3_notnull AS(
         SELECT
             a.*
@@ -434,6 +755,7 @@ def unite_border_tiles(conn, schema, border_ahn2, border_ahn3):
     ;
     """).format(
         schema=sql.Identifier(schema),
+        border_union=sql.Identifier(BORDER_UNION),
         border_ahn3=sql.Identifier(border_ahn3),
         border_ahn2=sql.Identifier(border_ahn2)
         )
@@ -445,7 +767,33 @@ def unite_border_tiles(conn, schema, border_ahn2, border_ahn3):
         raise
 
 
-def create_bag3d_table(conn, schema, name):
+def spatial_order(order):
+    """The ORDER BY clause of the 3D BAG table for the spatial order
+    
+    Parameters
+    ----------
+    order : str
+        One of :py:data:`SPATIAL_ORDERS`
+    
+    Raises
+    ------
+    ValueError
+        If the order is not known
+    
+    Returns
+    -------
+    psycopg2.sql.Composable
+    """
+    if order not in SPATIAL_ORDERS:
+        raise ValueError("Unknown order '%s', use one of %s" % (order, SPATIAL_ORDERS))
+    if order == 'geohash':
+        return sql.SQL(
+            "ORDER BY st_geohash(st_transform(st_centroid(geovlak), 4326), 12)")
+    return sql.SQL("")
+
+
+def create_bag3d_table(conn, schema, name, border=BORDER_UNION, order=None,
+                       brin=False):
     """Unite the border tiles with the rest
     
     Note
@@ -453,7 +801,12 @@ def create_bag3d_table(conn, schema, name):
     Persists and indexes the table 'bag3d' by uniting the border tiles with the 
     rest. 
     Drops the table 'bag3d' if exists before the operation.
-    Drops the view 'bag3d_border_union'.
+    
+    The rows can be physically ordered in space, so that the spatial queries 
+    and the reads per tile or municipality touch fewer pages. With 'geohash' 
+    the rows are sorted by the GeoHash of the centroid of the footprints 
+    while the table is created, with 'cluster' the table is clustered on its 
+    GiST index afterwards.
     
     Parameters
     ----------
@@ -463,9 +816,20 @@ def create_bag3d_table(conn, schema, name):
         Value from output:schema
     name : str
         Name of the new table
+    border : str
+        Relation of the border tiles in schema, either the view created by 
+        :py:func:`unite_border_tiles` or the table created by 
+        :py:func:`merge_border_csv`
+    order : str
+        Spatial order of the rows, one of :py:data:`SPATIAL_ORDERS`
+    brin : bool
+        Create BRIN indexes on tile_id and gemeentecode. They are only 
+        useful if the table is ordered in space.
     
     Raises
     ------
+    ValueError
+        If the order is not known
     BaseException
         If cannot create the table
     psycopg2.IntegrityError
@@ -476,22 +840,23 @@ def create_bag3d_table(conn, schema, name):
     None
         Creates a table in database
     """
-    drop_q = sql.SQL("DROP TABLE IF EXISTS {schema}.{bag3d} CASCADE;").format(
-        bag3d=sql.Identifier(name),
-        schema=sql.Identifier(schema))
-    
     query_t = sql.SQL("""
     CREATE TABLE {schema}.{bag3d} AS
-    SELECT *
-    FROM {schema}.{bag3d_rest}
-    WHERE ahn_version IS NOT NULL
-    UNION
-    SELECT *
-    FROM {schema}.bag3d_border_union
-    WHERE ahn_version IS NOT NULL;
+    SELECT * FROM (
+        SELECT *
+        FROM {schema}.{bag3d_rest}
+        WHERE ahn_version IS NOT NULL
+        UNION
+        SELECT *
+        FROM {schema}.{border}
+        WHERE ahn_version IS NOT NULL
+    ) u
+    {order};
     """).format(schema=sql.Identifier(schema), 
                 bag3d=sql.Identifier(name),
-                bag3d_rest=sql.Identifier(name+"_rest"))
+                bag3d_rest=sql.Identifier(name+"_rest"),
+                border=sql.Identifier(border),
+                order=spatial_order(order))
     
     idx_name = name + "_geom_idx"
     query_i = sql.SQL("""
@@ -501,14 +866,23 @@ def create_bag3d_table(conn, schema, name):
     """).format(schema=sql.Identifier(schema),
                 bag3d=sql.Identifier(name),
                 idx_name=sql.Identifier(idx_name))
+    if order == 'cluster':
+        query_i += sql.SQL("""
+    CLUSTER {schema}.{bag3d} USING {idx_name};
+    """).format(schema=sql.Identifier(schema),
+                bag3d=sql.Identifier(name),
+                idx_name=sql.Identifier(idx_name))
+    if brin:
+        query_i += brin_indexes(schema, name, ['tile_id', 'gemeentecode'])
     
     try:
-        logger.debug(conn.print_query(drop_q))
-        conn.sendQuery(drop_q)
+        # it is a view if the table was made compact with create_compact_table
+        drop_relation(conn, schema, name)
         logger.debug(conn.print_query(query_t))
         conn.sendQuery(query_t)
         logger.debug(conn.print_query(query_i))
         conn.sendQuery(query_i)
+        conn.vacuum(schema, name)
     except psycopg2.IntegrityError as e:
         logger.exception("There are overlapping footprints in the border and non-border tiles, possibly because some tiles were processed in a batch where they do not belong.")
         logger.exception(e)
@@ -518,10 +892,243 @@ def create_bag3d_table(conn, schema, name):
         raise
 
 
+def brin_indexes(schema, table, columns):
+    """CREATE INDEX statements of BRIN indexes, named <table>_<column>_brin"""
+    return sql.SQL('').join(
+        sql.SQL("""
+    CREATE INDEX {idx} ON {schema}.{table} USING brin ({column});
+    """).format(idx=sql.Identifier("%s_%s_brin" % (table, c)),
+                schema=sql.Identifier(schema), table=sql.Identifier(table),
+                column=sql.Identifier(c))
+        for c in columns)
+
+
+def compact_name(field):
+    """Name of a height field in the compact table, eg. 'roof-0.50' -> 'roof_050'"""
+    return field.replace('-', '_').replace('.', '')
+
+
+def relation_columns(conn, schema, table):
+    """The columns of a table or view with their type
+    
+    Returns
+    -------
+    list of tuple
+        [(name, type)], in the order of the columns
+    """
+    rel = sql.Literal("{}.{}".format(sql.Identifier(schema).as_string(conn.conn),
+                                     sql.Identifier(table).as_string(conn.conn)))
+    query = sql.SQL("""
+    SELECT attname, format_type(atttypid, atttypmod)
+    FROM pg_attribute
+    WHERE attrelid = {rel}::regclass AND attnum > 0 AND NOT attisdropped
+    ORDER BY attnum;
+    """).format(rel=rel)
+    logger.debug(conn.print_query(query))
+    return [(r[0], r[1]) for r in conn.getQuery(query)]
+
+
+def drop_relation(conn, schema, name):
+    """Drop a table or a view if exists"""
+    rel = sql.Literal("{}.{}".format(sql.Identifier(schema).as_string(conn.conn),
+                                     sql.Identifier(name).as_string(conn.conn)))
+    query = sql.SQL("""
+    SELECT relkind FROM pg_class WHERE oid = to_regclass({rel});
+    """).format(rel=rel)
+    r = conn.getQuery(query)
+    if len(r) == 0:
+        return
+    kind = sql.SQL("VIEW") if r[0][0] == 'v' else sql.SQL("TABLE")
+    query = sql.SQL("DROP {kind} IF EXISTS {schema}.{name} CASCADE;").format(
+        kind=kind, schema=sql.Identifier(schema), name=sql.Identifier(name))
+    logger.debug(conn.print_query(query))
+    conn.sendQuery(query)
+
+
+def dependent_relations(conn, schema, name):
+    """The views and materialized views that are defined on a relation
+    
+    Returns
+    -------
+    list of str
+        Schema-qualified names of the dependent relations
+    """
+    query = sql.SQL("""
+    SELECT DISTINCT c.oid::regclass::text
+    FROM pg_depend d
+    JOIN pg_rewrite rw ON rw.oid = d.objid
+    JOIN pg_class c ON c.oid = rw.ev_class
+    WHERE d.classid = 'pg_rewrite'::regclass
+        AND d.refclassid = 'pg_class'::regclass
+        AND d.refobjid = to_regclass({rel})
+        AND c.oid <> d.refobjid
+    ORDER BY 1;
+    """).format(rel=sql.Literal("{}.{}".format(
+        sql.Identifier(schema).as_string(conn.conn),
+        sql.Identifier(name).as_string(conn.conn))))
+    logger.debug(conn.print_query(query))
+    return [r[0] for r in conn.getQuery(query)]
+
+
+def create_compact_table(conn, schema, name, order=None, brin=False):
+    """Convert the 3D BAG table to a compact layout behind a compatibility view
+    
+    The table is copied into <name>_compact, where
+    
+    - the heights are stored in centimetres, as the int4 'height_base' (the 
+      first height that is not NULL) and the difference of each height from 
+      it as int2, eg. 'roof_050',
+    - the RMSE values are stored in centimetres as int2, eg. 'rmse_050',
+    - 'identificatie' is stored as bigint if all its values are numeric,
+    - 'gemeentecode' is not stored, because it is derived from 'identificatie'.
+    
+    int4 is used instead of int2 when a value does not fit into int2. Then the 
+    table is replaced by the view <name> with the original columns and types, 
+    so the exports and the quality checks work on it as before. The table 
+    cannot be replaced if other views depend on it, then nothing is changed.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    schema : str
+        Value from output:schema
+    name : str
+        Name of the 3D BAG table, as created by :py:func:`create_bag3d_table`
+    order : str
+        Spatial order of the rows, as in :py:func:`create_bag3d_table`
+    brin : bool
+        Create a BRIN index on tile_id
+    
+    Raises
+    ------
+    ValueError
+        If there are views that depend on the 3D BAG table
+    
+    Returns
+    -------
+    str
+        Name of the compact table
+    """
+    dependents = dependent_relations(conn, schema, name)
+    if dependents:
+        raise ValueError("%s depend on %s.%s, drop them before creating the "
+                         "compact table" % (", ".join(dependents), schema, name))
+    compact = name + "_compact"
+    schema_q = sql.Identifier(schema)
+    name_q = sql.Identifier(name)
+    compact_q = sql.Identifier(compact)
+    columns = relation_columns(conn, schema, name)
+    types = dict(columns)
+    heights = [f for f in HEIGHT_FIELDS if f in types]
+    rmses = [f for f in RMSE_FIELDS if f in types]
+    
+    base = sql.SQL("round(coalesce({}) * 100)").format(
+        sql.SQL(', ').join(sql.Identifier(f) for f in heights))
+    query = sql.SQL("""
+    SELECT 
+        coalesce(max(greatest({diffs})), 0),
+        coalesce(max(greatest({rmses})), 0),
+        coalesce(bool_and(identificatie::text ~ {pattern}), FALSE)
+    FROM (SELECT *, {base} AS height_base FROM {schema}.{name}) b;
+    """).format(
+        diffs=sql.SQL(', ').join(
+            sql.SQL("abs(round({} * 100) - height_base)").format(sql.Identifier(f))
+            for f in heights),
+        rmses=sql.SQL(', ').join(
+            sql.SQL("abs(round({} * 100))").format(sql.Identifier(f)) for f in rmses),
+        pattern=sql.Literal(r'^[0-9]{16}$' if 'char' in types['identificatie'] 
+                            or types['identificatie'] == 'text' 
+                            else r'^[0-9]{1,18}$'),
+        base=base, schema=schema_q, name=name_q)
+    logger.debug(conn.print_query(query))
+    max_diff, max_rmse, id_numeric = conn.getQuery(query)[0]
+    diff_type = sql.SQL("int2" if max_diff <= 32767 else "int4")
+    rmse_type = sql.SQL("int2" if max_rmse <= 32767 else "int4")
+    id_type = types['identificatie']
+    id_bigint = id_numeric and id_type not in ('bigint', 'integer', 'smallint')
+    logger.info("Compact layout of %s: heights as %s, RMSE as %s, identificatie as %s",
+                name, diff_type.string, rmse_type.string, 
+                'bigint' if id_bigint else id_type)
+    
+    # the compact table
+    fields_t = []
+    # the compatibility view
+    fields_v = []
+    for c,t in columns:
+        c_q = sql.Identifier(c)
+        t_q = sql.SQL(t)
+        if c in heights:
+            fields_t.append(sql.SQL("(round({c} * 100) - height_base)::{t} AS {n}").format(
+                c=c_q, t=diff_type, n=sql.Identifier(compact_name(c))))
+            fields_v.append(sql.SQL("((height_base + {n}) / 100.0)::{t} AS {c}").format(
+                c=c_q, t=t_q, n=sql.Identifier(compact_name(c))))
+        elif c in rmses:
+            fields_t.append(sql.SQL("round({c} * 100)::{t} AS {n}").format(
+                c=c_q, t=rmse_type, n=sql.Identifier(compact_name(c))))
+            fields_v.append(sql.SQL("({n} / 100.0)::{t} AS {c}").format(
+                c=c_q, t=t_q, n=sql.Identifier(compact_name(c))))
+        elif c == 'identificatie' and id_bigint:
+            fields_t.append(sql.SQL("identificatie::bigint AS identificatie"))
+            if 'char' in t or t == 'text':
+                fields_v.append(sql.SQL(
+                    "lpad(identificatie::text, 16, '0')::{t} AS identificatie").format(t=t_q))
+            else:
+                fields_v.append(sql.SQL("identificatie::{t} AS identificatie").format(t=t_q))
+        elif c == 'gemeentecode':
+            fields_v.append(sql.SQL("left({i}, 4)::{t} AS gemeentecode").format(
+                i=sql.SQL("lpad(identificatie::text, 16, '0')") if id_bigint 
+                    else sql.SQL("identificatie::text"),
+                t=t_q))
+        else:
+            fields_t.append(c_q)
+            fields_v.append(c_q)
+    
+    query = sql.SQL("""
+    DROP TABLE IF EXISTS {schema}.{compact} CASCADE;
+    CREATE TABLE {schema}.{compact} AS
+    SELECT
+        height_base::int4 AS height_base,
+        {fields}
+    FROM (SELECT *, {base} AS height_base FROM {schema}.{name}) b
+    {order};
+    ALTER TABLE {schema}.{compact} ADD PRIMARY KEY (gid);
+    CREATE INDEX {idx_geom} ON {schema}.{compact} USING gist (geovlak);
+    CREATE INDEX {idx_id} ON {schema}.{compact} (identificatie);
+    CREATE INDEX {idx_tile} ON {schema}.{compact} (tile_id);
+    {cluster}
+    {brin}
+    COMMENT ON TABLE {schema}.{compact} IS 
+        'The 3D BAG in a compact layout, the heights are in centimetres';
+    DROP TABLE {schema}.{name};
+    CREATE VIEW {schema}.{name} AS
+    SELECT
+        {fields_v}
+    FROM {schema}.{compact};
+    COMMENT ON VIEW {schema}.{name} IS 'The 3D BAG';
+    """).format(schema=schema_q, name=name_q, compact=compact_q, base=base,
+                fields=sql.SQL(',\n        ').join(fields_t),
+                fields_v=sql.SQL(',\n        ').join(fields_v),
+                idx_geom=sql.Identifier(compact + "_geom_idx"),
+                idx_id=sql.Identifier(compact + "_identificatie_idx"),
+                idx_tile=sql.Identifier(compact + "_tile_id_idx"),
+                order=spatial_order(order),
+                cluster=sql.SQL("CLUSTER {}.{} USING {};").format(
+                    schema_q, compact_q, sql.Identifier(compact + "_geom_idx"))
+                    if order == 'cluster' else sql.SQL(""),
+                brin=brin_indexes(schema, compact, ['tile_id']) if brin 
+                    else sql.SQL(""))
+    logger.debug(conn.print_query(query))
+    conn.sendQuery(query)
+    conn.vacuum(schema, compact)
+    return compact
+
+
 def drop_border_view(conn, schema):
     query_d = sql.SQL("""
-    DROP VIEW IF EXISTS {schema}.bag3d_border_union;
-    """).format(schema=sql.Identifier(schema))
+    DROP VIEW IF EXISTS {schema}.{border_union};
+    """).format(schema=sql.Identifier(schema),
+                border_union=sql.Identifier(BORDER_UNION))
     try:
         logger.debug(conn.print_query(query_d))
         conn.sendQuery(query_d)
@@ -4,6 +4,7 @@
 
 import logging
 import json
+from collections import OrderedDict
 from math import sqrt
 
 from psycopg2 import sql
@@ -163,6 +164,7 @@ def create_quality_table(conn):
     roof_missing_pct float4,
     building_cnt json
     );
+    ALTER TABLE public.bag3d_quality ADD COLUMN IF NOT EXISTS metrics json;
     """)
     try:
         logger.debug(conn.print_query(query))
@@ -171,13 +173,46 @@ def create_quality_table(conn):
         logger.exception(e)
         raise
 
-def get_counts(conn, config):
+METRICS = OrderedDict()
+"""Quality metrics that are computed by :meth:`get_counts`, in a single scan
+over the 3D BAG table. Maps the metric name to its SQL filter expression."""
+
+
+def register_metric(name, expression):
+    """Register a quality metric
+    
+    The metric counts the buildings in the 3D BAG table that satisfy 
+    ``expression``. All registered metrics are computed in the same scan, 
+    thus adding a metric does not add a scan over the table.
+    
+    Parameters
+    ----------
+    name : str
+        Name of the metric, the counts are returned as ``<name>_cnt`` and 
+        ``<name>_pct``
+    expression : str
+        SQL boolean expression on the fields of the 3D BAG table, used in 
+        ``COUNT(*) FILTER (WHERE <expression>)``
+    """
+    if not expression or not expression.strip():
+        raise ValueError("Empty filter expression for metric %s" % name)
+    METRICS[name] = expression
+
+
+register_metric("valid_height", "(bouwjaar > ahn_file_date) IS NOT TRUE")
+register_metric("invalid_height", "bouwjaar > ahn_file_date")
+register_metric("ground_missing", "nr_ground_pts = 0")
+register_metric("roof_missing", "nr_roof_pts = 0")
+
+
+def get_counts(conn, config, metrics=None):
     """Various counts on the 3D BAG
     
     * Total number of buildings, 
-    * Nr. of buildings with missing ground height,
-    * Nr. of buildings with missing roof height,
-    * The previous two as percent
+    * For each registered metric (see :meth:`register_metric`) the nr. of 
+      buildings that satisfy the metric, and the same as percent
+    
+    The counts are computed in a single scan over the 3D BAG table.
     
     Parameters
     ----------
@@ -185,116 +220,185 @@ def get_counts(conn, config):
         Open connection
     config: dict
         batch3dfier YAML config as returned by :meth:`bag3d.config.args.parse_config`
+    metrics : dict
+        Metrics to compute as {name: filter expression}. Defaults to the 
+        registered metrics.
     
     Returns
     -------
     dict
         With the field names as keys
     """
+    if metrics is None:
+        metrics = METRICS
     schema = sql.Identifier(config['input_polygons']['footprints']['schema'])
+    counts = []
+    pcts = []
+    for name,expression in metrics.items():
+        cnt = sql.Identifier(name + "_cnt")
+        counts.append(sql.SQL("COUNT(*) FILTER (WHERE {expr}) AS {cnt}").format(
+            expr=sql.SQL(expression), cnt=cnt))
+        pcts.append(sql.SQL(
+            "{cnt}::float4 / NULLIF(total_cnt, 0)::float4 * 100 AS {pct}").format(
+                cnt=cnt, pct=sql.Identifier(name + "_pct")))
     query = sql.SQL("""
-    WITH total AS (
-        SELECT
-            COUNT(gid) total_cnt
-        FROM
-            {schema}.{bag3d}
-    ),
-    ground AS (
-        SELECT
-            COUNT(gid) ground_missing_cnt
-        FROM
-            {schema}.{bag3d}
-        WHERE nr_ground_pts = 0
-    ),
-    roof AS (
+    WITH counts AS (
         SELECT
-            COUNT(gid) roof_missing_cnt
+            COUNT(*) total_cnt,
+            {counts}
         FROM
             {schema}.{bag3d}
-        WHERE nr_roof_pts = 0
-    ),
-    invalid AS (
-        SELECT
-            COUNT (gid) invalid_height_cnt
-        FROM
-            {schema}.{bag3d}
-        WHERE bouwjaar > ahn_file_date
     )
     SELECT
         current_timestamp AS timestamp,
-        t.total_cnt,
-        (t.total_cnt::float4 - i.invalid_height_cnt::float4) / t.total_cnt::float4 * 100 AS valid_height_pct,
-        i.invalid_height_cnt::float4 / t.total_cnt::float4 * 100 AS invalid_height_pct,
-        (
-            g.ground_missing_cnt::FLOAT4 / t.total_cnt::FLOAT4
-        )* 100 AS ground_missing_pct,
-        (
-            r.roof_missing_cnt::FLOAT4 / t.total_cnt::FLOAT4
-        )* 100 AS roof_missing_pct
+        *,
+        {pcts}
     FROM
-        total t,
-        ground g,
-        roof r,
-        invalid i;
+        counts;
     """).format(bag3d=sql.Identifier(config["output"]["bag3d_table"]),
-                schema=schema)
+                schema=schema,
+                counts=sql.SQL(",\n            ").join(counts),
+                pcts=sql.SQL(",\n        ").join(pcts))
     try:
         logger.debug(conn.print_query(query))
-        res = conn.get_dict(query)
+        res = conn.get_dict(query, hot=True)
         logger.debug(res)
         return res
     except BaseException as e:
         logger.exception(e)
         raise
 
-def buildings_per_tile(conn, config):
-    """Count the number of buildings in the BAG and the 3D BAG per tile"""
+def create_tile_quality_table(conn):
+    """Create a table to store the quality statistics per tile and tile group"""
+    query = sql.SQL("""
+    CREATE TABLE IF NOT EXISTS public.tile_quality (
+    tile_id text,
+    tile_group text,
+    timestamp timestamptz,
+    bag_cnt int,
+    bag3d_cnt int,
+    null_height_cnt int,
+    invalid_height_cnt int,
+    rmse_avg float4,
+    PRIMARY KEY (tile_id, tile_group)
+    );
+    """)
+    try:
+        logger.debug(conn.print_query(query))
+        conn.sendQuery(query)
+    except BaseException as e:
+        logger.exception(e)
+        raise
+
+
+def update_tile_quality(conn, config, tiles):
+    """Compute the quality statistics of the imported tiles
+    
+    Counts per tile the buildings in the BAG, the lifted buildings, the 
+    buildings with a missing or invalid height and the mean RMSE of the roof 
+    height, and stores them in the *tile_quality* table. The tile group is 
+    the output:bag3d_table of the configuration. The statistics of the tile 
+    group are replaced.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    config: dict
+        batch3dfier YAML config as returned by :meth:`bag3d.config.args.parse_config`
+    tiles : list of str
+        The tiles that were imported
+    """
     schema = sql.Identifier(config['input_polygons']['footprints']['schema'])
     table_bag_q = sql.Identifier(config['input_polygons']['footprints']['table'])
     schema_idx_q = sql.Identifier(config['tile_index']['polygons']['schema'])
     table_idx_q = sql.Identifier(config['tile_index']['polygons']['table'])
     field_idx_unit_q = sql.Identifier(config['tile_index']['polygons']['fields']['unit_name'])
     field_idx_geom_q = sql.Identifier(config['tile_index']['polygons']['fields']['geometry'])
-
+    tile_group = sql.Literal(config["output"]["bag3d_table"])
+    
+    create_tile_quality_table(conn)
     query = sql.SQL("""
-    WITH bag_tiles AS (
-    SELECT
-        {table_bag}.gid,
-        {table_idx}.{field_idx}
-    FROM
-        {schema}.{table_bag}
-    JOIN {schema}.pand_centroid ON
-        {table_bag}.gid = pand_centroid.gid,
-        {schema_idx}.{table_idx}
-    WHERE
-        st_containsproperly({table_idx}.{field_idx_geom}, pand_centroid.geom)
-        OR st_contains({table_idx}.geom_border, pand_centroid.geom)
-    ),
-    bag_tiles_cnt AS (
-        SELECT {field_idx} AS tile_id, count(*) AS bag_cnt
-        FROM bag_tiles
-        GROUP BY {field_idx}
-    ),
-    bag3d_tiles_cnt AS (
-        SELECT tile_id, count(*) AS bag3d_cnt
+    DELETE FROM public.tile_quality WHERE tile_group = {tile_group};
+    INSERT INTO public.tile_quality
+    WITH lifted AS (
+        SELECT
+            tile_id,
+            count(*) AS bag3d_cnt,
+            count(*) FILTER (
+                WHERE "roof-0.95" IS NULL OR "ground-0.10" IS NULL
+            ) AS null_height_cnt,
+            count(*) FILTER (WHERE NOT height_valid) AS invalid_height_cnt,
+            avg("rmse-0.95") AS rmse_avg
         FROM {schema}.{bag3d}
         GROUP BY tile_id
     ),
-    counts AS (
-        SELECT a.tile_id, bag_cnt, bag3d_cnt
-        FROM bag_tiles_cnt a
-        LEFT JOIN bag3d_tiles_cnt b ON a.tile_id = b.tile_id
+    bag_tiles_cnt AS (
+        SELECT {table_idx}.{field_idx} AS tile_id, count(*) AS bag_cnt
+        FROM
+            {schema_idx}.{table_idx}
+        JOIN {schema}.pand_centroid ON
+            {table_idx}.{field_idx_geom} && pand_centroid.geom
+        JOIN {schema}.{table_bag} ON
+            {table_bag}.gid = pand_centroid.gid
+        WHERE
+            {table_idx}.{field_idx} = ANY({tiles})
+            AND (
+                st_containsproperly({table_idx}.{field_idx_geom}, pand_centroid.geom)
+                OR st_contains({table_idx}.geom_border, pand_centroid.geom)
+            )
+        GROUP BY {table_idx}.{field_idx}
     )
-    SELECT array_to_json(array_agg(counts)) AS building_cnt
-    FROM counts;
+    SELECT
+        t.tile_id,
+        {tile_group},
+        current_timestamp,
+        coalesce(b.bag_cnt, 0),
+        coalesce(l.bag3d_cnt, 0),
+        coalesce(l.null_height_cnt, 0),
+        coalesce(l.invalid_height_cnt, 0),
+        l.rmse_avg
+    FROM unnest({tiles}::text[]) t(tile_id)
+    LEFT JOIN bag_tiles_cnt b ON t.tile_id = b.tile_id
+    LEFT JOIN lifted l ON t.tile_id = l.tile_id;
     """).format(bag3d=sql.Identifier(config["output"]["bag3d_table"]),
                 schema=schema,
                 table_bag=table_bag_q,
                 schema_idx=schema_idx_q,
                 table_idx=table_idx_q,
                 field_idx=field_idx_unit_q,
-                field_idx_geom=field_idx_geom_q
+                field_idx_geom=field_idx_geom_q,
+                tile_group=tile_group,
+                tiles=sql.Literal(list(tiles))
                 )
+    try:
+        logger.debug(conn.print_query(query))
+        conn.sendQuery(query)
+    except BaseException as e:
+        logger.exception(e)
+        raise
+
+
+def buildings_per_tile(conn, config):
+    """Count the number of buildings in the BAG and the 3D BAG per tile
+    
+    Aggregates the *tile_quality* table that is filled by 
+    :meth:`update_tile_quality` during the import. The border tiles are 
+    processed in more than one tile group, for these the group with the most 
+    lifted buildings is counted.
+    """
+    query = sql.SQL("""
+    WITH counts AS (
+        SELECT
+            tile_id,
+            max(bag_cnt) AS bag_cnt,
+            max(bag3d_cnt) AS bag3d_cnt
+        FROM public.tile_quality
+        GROUP BY tile_id
+    )
+    SELECT array_to_json(array_agg(counts)) AS building_cnt
+    FROM counts;
+    """)
     try:
         logger.debug(conn.print_query(query))
         res = conn.getQuery(query)
@@ -317,15 +421,18 @@ def update_quality_table(conn, counts, buildings_per_tile):
                     invalid_height_pct,
                     ground_missing_pct,
                     roof_missing_pct,
-                    building_cnt
-                ) VALUES (%(time)s, %(total)s, %(valid)s, %(invalid)s, %(ground)s, %(roof)s, %(building)s);
+                    building_cnt,
+                    metrics
+                ) VALUES (%(time)s, %(total)s, %(valid)s, %(invalid)s, %(ground)s, %(roof)s, %(building)s, %(metrics)s);
                 """, {'time': counts[0]['timestamp'],
                     'total': counts[0]['total_cnt'],
                     'valid': counts[0]['valid_height_pct'],
                     'invalid': counts[0]['invalid_height_pct'],
                     'ground': counts[0]['ground_missing_pct'],
                     'roof': counts[0]['roof_missing_pct'],
-                    'building': Json(buildings_per_tile[0][0])
+                    'building': Json(buildings_per_tile[0][0]),
+                    'metrics': Json({k:v for k,v in counts[0].items()
+                                     if k.endswith(('_cnt', '_pct'))})
                       }
                             )
     except BaseException as e:
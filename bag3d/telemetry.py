@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+"""Performance telemetry of a 3D BAG run
+
+Each processed tile is recorded as one JSON object per line by the
+*telemetry* logger (see logging.cfg). The records are summarized with
+``bag3d perf-report <telemetry file>``. The stages of the process (see 
+:py:func:`stage`) are recorded in the same file.
+"""
+
+import os
+import json
+import struct
+import argparse
+import logging
+import threading
+import cProfile
+from time import perf_counter
+from datetime import datetime
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger_tel = logging.getLogger('telemetry')
+
+_times = {}
+_times_lock = threading.Lock()
+
+
+def record(event, **fields):
+    """Emit a telemetry record
+
+    Parameters
+    ----------
+    event : str
+        Type of the record, eg. 'tile' or 'import'
+    fields
+        The measurements, they must be JSON serializable
+    """
+    rec = {'event': event, 'time': datetime.utcnow().isoformat()}
+    rec.update(fields)
+    logger_tel.info(json.dumps(rec, default=str))
+
+
+def add_time(kind, seconds):
+    """Add to the time spent on a kind of work, eg. 'db' or 'subprocess'
+    
+    The times are summed over all threads of the process.
+    """
+    with _times_lock:
+        _times[kind] = _times.get(kind, 0.0) + seconds
+
+
+def get_times():
+    """The time spent on each kind of work so far, see :py:func:`add_time`"""
+    with _times_lock:
+        return dict(_times)
+
+
+@contextmanager
+def stage(name, profile_dir=None):
+    """Measure a stage of the 3D BAG process
+    
+    Records the wall time, and the time spent in database queries and 
+    subprocesses during the stage. The DB and subprocess times are summed over
+    all threads, so they can be more than the wall time.
+    
+    Parameters
+    ----------
+    name : str
+        Name of the stage
+    profile_dir : str
+        If provided, the stage is profiled with cProfile and the statistics 
+        are written into <profile_dir>/<name>.pstats. Only the main thread is 
+        profiled.
+    """
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = None
+    before = get_times()
+    start = perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        wall = perf_counter() - start
+        if profiler:
+            profiler.disable()
+            path = os.path.join(profile_dir, name + ".pstats")
+            profiler.dump_stats(path)
+            logger.info("Wrote the profile of %s to %s", name, path)
+        after = get_times()
+        fields = {k + "_time": after[k] - before.get(k, 0.0) for k in after}
+        logger.info("Stage %s took %.1fs (%s)", name, wall, 
+                    ", ".join("%s %.1fs" % (k, v) for k,v in sorted(fields.items())))
+        record('stage', name=name, wall_time=wall, failed=failed, **fields)
+
+
+def las_point_count(path):
+    """Number of points in a LAS/LAZ file, read from the file header
+
+    Parameters
+    ----------
+    path : str
+        Path to the LAS/LAZ file
+
+    Returns
+    -------
+    int
+        Number of point records, or None if the header cannot be read
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(255)
+    except OSError as e:
+        logger.debug(e)
+        return None
+    if len(header) < 111 or header[:4] != b'LASF':
+        logger.debug("%s is not a LAS file", path)
+        return None
+    version_minor = header[25]
+    count = struct.unpack_from('<I', header, 107)[0]
+    if version_minor >= 4 and len(header) >= 255:
+        # LAS 1.4 stores the 64bit point count after the legacy fields
+        count = max(count, struct.unpack_from('<Q', header, 247)[0])
+    return count
+
+
+def read_records(path, event=None):
+    """Read the telemetry records from a JSON-lines file
+
+    Parameters
+    ----------
+    path : str
+        Path to the telemetry file
+    event : str
+        Only return the records of this type
+
+    Returns
+    -------
+    list of dict
+    """
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                logger.debug("Skipping malformed telemetry record %s", line)
+                continue
+            if event is None or rec.get('event') == event:
+                records.append(rec)
+    return records
+
+
+def percentiles(values, q=(50, 90, 99, 100)):
+    """Percentiles of the values, ignoring the missing values
+
+    Returns
+    -------
+    dict
+        {percentile : value}, empty if there are no values
+    """
+    a = np.array([v for v in values if v is not None], dtype='float64')
+    if a.size == 0:
+        return {}
+    return {p: float(v) for p,v in zip(q, np.percentile(a, q))}
+
+
+def summarize(records, straggler_factor=3.0, nr_stragglers=10):
+    """Summarize the tile and import records per tile group
+
+    Parameters
+    ----------
+    records : list of dict
+        As returned by :py:func:`read_records`
+    straggler_factor : float
+        A tile is a straggler if its 3dfier wall time is more than
+        straggler_factor times the median wall time of its group
+    nr_stragglers : int
+        Maximum number of stragglers to report per group
+
+    Returns
+    -------
+    dict
+        {tile group : summary}
+    """
+    imports = {}
+    for rec in records:
+        if rec.get('event') == 'import':
+            imports[(rec.get('group'), rec.get('tile'))] = rec
+    groups = {}
+    for rec in records:
+        if rec.get('event') == 'tile':
+            groups.setdefault(rec.get('group'), []).append(rec)
+
+    summary = {}
+    for group,recs in groups.items():
+        wall = [r.get('wall_time') for r in recs]
+        ends = [datetime.fromisoformat(r['time']).timestamp() for r in recs]
+        starts = [e - (r.get('wall_time') or 0) - (r.get('yml_time') or 0)
+                  for e,r in zip(ends, recs)]
+        span = max(ends) - min(starts)
+        lifted = [r for r in recs if r.get('success')]
+        points = sum(r.get('points') or 0 for r in lifted)
+        lifted_wall = sum(r.get('wall_time') or 0 for r in lifted)
+        import_time = [imports[(group, r['tile'])].get('import_time')
+                       for r in recs if (group, r['tile']) in imports]
+
+        p_wall = percentiles(wall)
+        stragglers = []
+        if p_wall:
+            limit = p_wall[50] * straggler_factor
+            stragglers = sorted(
+                [(r['tile'], r['wall_time']) for r in recs
+                 if r.get('wall_time') is not None and r['wall_time'] > limit],
+                key=lambda x: x[1], reverse=True)[:nr_stragglers]
+        summary[group] = {
+            'tiles': len(recs),
+            'failed': len(recs) - len(lifted),
+            'span': span,
+            'tiles_per_hour': len(recs) / span * 3600 if span > 0 else None,
+            'rows_per_second': (sum(r.get('output_rows') or 0 for r in lifted)
+                                / span if span > 0 else None),
+            'points_per_second': points / lifted_wall if lifted_wall > 0 else None,
+            'wall_time': p_wall,
+            'cpu_time': percentiles(r.get('cpu_time') for r in recs),
+            'peak_rss': percentiles(r.get('peak_rss') for r in recs),
+            'queue_wait': percentiles(r.get('queue_wait') for r in recs),
+            'yml_time': percentiles(r.get('yml_time') for r in recs),
+            'import_time': percentiles(import_time),
+            'stragglers': stragglers
+            }
+    return summary
+
+
+def format_report(summary):
+    """Format the summary of :py:func:`summarize` as text"""
+    def fmt(v):
+        return "-" if v is None else "%.2f" % v
+
+    lines = []
+    for group in sorted(summary, key=str):
+        s = summary[group]
+        lines.append("Tile group: %s" % group)
+        lines.append("  tiles: %s, failed: %s, elapsed: %ss" % (
+            s['tiles'], s['failed'], fmt(s['span'])))
+        lines.append("  throughput: %s tiles/h, %s buildings/s, %s points/s per 3dfier" % (
+            fmt(s['tiles_per_hour']), fmt(s['rows_per_second']),
+            fmt(s['points_per_second'])))
+        for m in ['queue_wait', 'yml_time', 'wall_time', 'cpu_time', 'peak_rss',
+                  'import_time']:
+            p = s[m]
+            lines.append("  %-12s %s" % (m, "  ".join(
+                "p%s=%s" % (k, fmt(v)) for k,v in sorted(p.items())) or "-"))
+        if s['stragglers']:
+            lines.append("  stragglers:")
+            for tile,t in s['stragglers']:
+                lines.append("    %s %ss" % (tile, fmt(t)))
+    return "\n".join(lines)
+
+
+def perf_report(cli_args):
+    """The ``bag3d perf-report`` command
+
+    Parameters
+    ----------
+    cli_args : list of strings
+        Command line arguments, without the command name
+    """
+    parser = argparse.ArgumentParser(
+        prog="bag3d perf-report",
+        description="Summarize the performance telemetry of a 3D BAG run")
+    parser.add_argument("path", help="The telemetry file (JSON-lines)")
+    parser.add_argument("--straggler-factor", type=float, default=3.0,
+                        help="Report the tiles that take longer than this \
+                        times the median wall time")
+    parser.add_argument("--stragglers", type=int, default=10,
+                        help="Maximum number of stragglers to report per tile group")
+    parser.add_argument("--json", action="store_true",
+                        help="Output the summary as JSON")
+    a = parser.parse_args(cli_args)
+    summary = summarize(read_records(a.path),
+                        straggler_factor=a.straggler_factor,
+                        nr_stragglers=a.stragglers)
+    if a.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(format_report(summary))
@@ -9,10 +9,15 @@ import locale
 from datetime import datetime
 
 import re
+import shutil
+import zipfile
+import tempfile
 import urllib.request, json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from bag3d.config import border
+from bag3d.config import batch3dfier
 from bag3d.update import bag
 
 logger = logging.getLogger(__name__)
@@ -87,19 +92,23 @@ def get_file_date(path_lasinfo, ahn_dir, ahn_pat, t, f_date_pat, corruptedfiles)
             return None
 
 
-def download(path_lasinfo, ahn3_dir, ahn2_dir, tile_index_file, ahn3_file_pat, ahn2_file_pat):
+def download(path_lasinfo, ahn3_dir, ahn2_dir, tile_index_file, ahn3_file_pat, 
+             ahn2_file_pat, path_lasindex=None, threads=3):
     """Update the AHN3 files in the provided folder
 
     1. Downloads the latest AHN3 index (bladindex) to the local file system
     2. Downloads all AHN3 tiles that are not in the provided directory and checks them for error with lasinfo (without parsing the points).
     3. Appends the 'file creation date' attribute of the LAZ file to the AHN index.
     4. If an AHN3 file is not available, marks the tile as AHN2 and add the date of the AHN2 file.
+    5. If path_lasindex is provided, creates the spatial index of the files with :py:func:`index_pointclouds`.
 
     Parameters
     ----------
     ahn3_dir: path to the directory for the AHN3 files
     ahn2_dir: path to the directory for the AHN2 files
     tile_index_file: path for the AHN tile index
+    path_lasindex: path to the lasindex executable
+    threads: number of parallel lasindex processes
     """
     logger.debug("download() %s", (ahn3_dir, ahn2_dir, tile_index_file, ahn3_file_pat, ahn2_file_pat))
     
@@ -178,30 +187,264 @@ def download(path_lasinfo, ahn3_dir, ahn2_dir, tile_index_file, ahn3_file_pat, a
     logger.info("Corrupted files: %s", corruptedfiles)
     logger.info("Nr. AHN3 files in dir: %s; Nr. AHN3 tiles available: %s", file_count, has_data_cnt)
     logger.info("Nr. AHN2 files required: %s", ahn2_files)
+    
+    if path_lasindex:
+        index_pointclouds(path_lasindex, [ahn3_dir, ahn2_dir], threads=threads)
+
+
+def index_pointclouds(path_lasindex, dirs, threads=3, doexec=True):
+    """Create the spatial index (.lax) of the LAS/LAZ files with lasindex
+    
+    The files that already have an up-to-date index are skipped. 3dfier 
+    (through LAStools) uses the .lax file next to the point cloud file for 
+    reading only the points within the bounding box of the footprints.
+    
+    Parameters
+    ----------
+    path_lasindex : str
+        Path to the lasindex executable
+    dirs : list of str
+        Directories of the point cloud files, as in input_elevation:dataset_dir. 
+        Sublists are flattened.
+    threads : int
+        Number of parallel lasindex processes
+    doexec : bool
+        Passed to :py:func:`bag3d.update.bag.run_subprocess`
+    
+    Returns
+    -------
+    list of str
+        Paths of the files that failed
+    """
+    files = []
+    for d in flatten_dirs(dirs):
+        for item in sorted(os.listdir(d)):
+            path = os.path.join(d, item)
+            if os.path.isfile(path) and \
+                    os.path.splitext(item)[1].lower() in ('.las', '.laz'):
+                files.append(path)
+    todo = [f for f in files if not batch3dfier.has_index(f)]
+    logger.info("Indexing %s point cloud files, %s are already indexed",
+                len(todo), len(files) - len(todo))
+    
+    def lasindex(path):
+        return bag.run_subprocess([path_lasindex, '-i', path], doexec=doexec)
+    
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        res = list(executor.map(lasindex, todo))
+    failed = [f for f,ok in zip(todo, res) if not ok]
+    if failed:
+        logger.error("Could not index %s files: %s", len(failed), failed)
+    return failed
+
+
+def flatten_dirs(dirs):
+    """Flatten the (possibly nested) list of input_elevation:dataset_dir"""
+    if isinstance(dirs, str):
+        return [dirs]
+    out = []
+    for d in dirs:
+        out += flatten_dirs(d)
+    return out
+
+
+RASTER_CATALOG = 'raster_catalog.json'
+
+
+def raster_catalog(dir_out):
+    """Path of the raster catalog in the directory"""
+    return os.path.join(dir_out, RASTER_CATALOG)
 
 
-def downloader(tile_list, url, dir_out, doexec=True):
+def read_catalog(dir_out):
+    """Read the raster catalog of a directory
+    
+    Returns
+    -------
+    dict
+        {tile ID : {'path', 'url', 'cog', 'size', 'downloaded'}}, empty if 
+        there is no catalog in the directory
+    """
     try:
-        fout = os.path.join(dir_out, 'tile')
-        for tile in tile_list:
-            command = ['wget', '-nc', '-P', dir_out, url.format(tile), '-O', fout]
-            bag.run_subprocess(command, shell=False, doexec=doexec)
-            command = ['unzip', '-o', fout, '-d', dir_out]
-            bag.run_subprocess(command, shell=False, doexec=doexec)
-            command = ['rm', fout]
-            bag.run_subprocess(command, shell=False, doexec=doexec)
-        logger.info("Downloaded %s tiles", len(tile_list))
-    except Exception as e:
-        logger.exception(e)
-
-
-def download_raster(conn, config, ahn2_rast_dir, ahn3_rast_dir, doexec=True):
-    "wget https://geodata.nationaalgeoregister.nl/ahn3/extract/ahn3_05m_dsm/R_37HN1.ZIP -O tile && unzip -o tile && rm tile"
+        with open(raster_catalog(dir_out), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_catalog(dir_out, catalog):
+    """Write the raster catalog of a directory
+    
+    The catalog is written to a temporary file first, so a concurrent reader 
+    never sees a partial catalog.
+    """
+    fd, tmp = tempfile.mkstemp(suffix='.json', dir=dir_out)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(catalog, f, indent=1, sort_keys=True)
+    os.replace(tmp, raster_catalog(dir_out))
+
+
+def extract_raster(zip_path, dir_out):
+    """Extract the GeoTIFF from a downloaded AHN raster zip
+    
+    The raster is streamed from the archive into a temporary file in dir_out, 
+    thus parallel extractions into the same directory don't collide.
+    
+    Returns
+    -------
+    tuple
+        (path to the temporary file, lowercase name of the raster in the archive)
+    """
+    with zipfile.ZipFile(zip_path) as z:
+        members = [m for m in z.infolist() 
+                   if os.path.splitext(m.filename)[1].lower() in ('.tif', '.tiff')]
+        if len(members) == 0:
+            raise ValueError("There is no GeoTIFF in %s" % zip_path)
+        fd, tmp = tempfile.mkstemp(suffix='.tif', dir=dir_out)
+        with z.open(members[0]) as src, os.fdopen(fd, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    return tmp, os.path.basename(members[0].filename).lower()
+
+
+def to_cog(src, dst, path_gdal_translate='gdal_translate', doexec=True):
+    """Convert a raster to a Cloud-Optimized GeoTIFF
     
+    The COG is tiled (512x512), DEFLATE compressed and has internal overviews, 
+    so the windowed reads of :py:func:`bag3d.quality.compute_stats` only touch 
+    the blocks under the footprints. Requires GDAL >= 3.1.
+    """
+    command = [path_gdal_translate, '-q', '-of', 'COG',
+               '-co', 'COMPRESS=DEFLATE', '-co', 'PREDICTOR=YES',
+               '-co', 'BLOCKSIZE=512', '-co', 'OVERVIEWS=AUTO',
+               src, dst]
+    return bag.run_subprocess(command, shell=False, doexec=doexec)
+
+
+def fetch_raster(tile, url, dir_out, cog=True, 
+                 path_gdal_translate='gdal_translate', doexec=True):
+    """Download, extract and convert the raster of a single tile
+    
+    Each tile is downloaded to a unique temporary file, so several tiles can 
+    be fetched into the same directory at once.
+    
+    Parameters
+    ----------
+    tile : str
+        Tile ID
+    url : str
+        Download URL of the zipped raster
+    dir_out : str
+        Directory of the raster files
+    cog : bool
+        Convert the raster to a Cloud-Optimized GeoTIFF with :py:func:`to_cog`
+    
+    Returns
+    -------
+    dict
+        The catalog entry of the raster, or None if it failed
+    """
+    fd, zip_path = tempfile.mkstemp(suffix='.zip', dir=dir_out)
+    os.close(fd)
+    tif = None
+    cog_tmp = None
+    try:
+        command = ['wget', '-q', url, '-O', zip_path]
+        if not bag.run_subprocess(command, shell=False, doexec=doexec):
+            logger.error("Could not download %s", url)
+            return None
+        if not doexec:
+            return None
+        tif, name = extract_raster(zip_path, dir_out)
+        os.remove(zip_path)
+        path = os.path.join(dir_out, name)
+        if cog:
+            # the COG is moved in place only when complete, so a failed 
+            # conversion or a concurrent reader never sees a partial raster
+            cog_tmp = tif + ".cog.tif"
+            if not to_cog(tif, cog_tmp, path_gdal_translate, doexec):
+                logger.error("Could not convert %s to COG", tile)
+                return None
+            os.replace(cog_tmp, path)
+        else:
+            os.replace(tif, path)
+        return {'path': path,
+                'url': url,
+                'cog': cog,
+                'size': os.path.getsize(path),
+                'downloaded': datetime.now().isoformat()}
+    except (zipfile.BadZipFile, ValueError) as e:
+        logger.error("Tile %s: %s", tile, e)
+        return None
+    finally:
+        for p in [zip_path, tif, cog_tmp]:
+            if p and os.path.exists(p):
+                os.remove(p)
+
+
+def downloader(tile_list, url, dir_out, threads=3, cog=True,
+               path_gdal_translate='gdal_translate', doexec=True):
+    """Download the raster tiles in parallel and record them in the raster catalog
+    
+    The tiles that are already in the catalog of dir_out are skipped.
+    
+    Parameters
+    ----------
+    tile_list : list of str
+        Tile IDs, formatted into the url
+    url : str
+        Download URL with a {} placeholder for the tile ID
+    dir_out : str
+        Directory of the raster files and the catalog
+    threads : int
+        Number of parallel downloads
+    
+    Returns
+    -------
+    list of str
+        The tiles that failed, empty if doexec is False
+    """
+    catalog = read_catalog(dir_out)
+    todo = [t for t in tile_list if not (t.lower() in catalog and 
+                                         os.path.isfile(catalog[t.lower()]['path']))]
+    logger.info("Downloading %s tiles, %s are already in the catalog",
+                len(todo), len(tile_list) - len(todo))
+    
+    def fetch(tile):
+        return fetch_raster(tile, url.format(tile), dir_out, cog=cog,
+                            path_gdal_translate=path_gdal_translate, 
+                            doexec=doexec)
+    
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        res = list(executor.map(fetch, todo))
+    if not doexec:
+        return []
+    failed = []
+    for tile,entry in zip(todo, res):
+        if entry:
+            catalog[tile.lower()] = entry
+        else:
+            failed.append(tile)
+    write_catalog(dir_out, catalog)
+    logger.info("Downloaded %s tiles", len(todo) - len(failed))
+    if failed:
+        logger.error("Could not download %s tiles: %s", len(failed), failed)
+    return failed
+
+
+def download_raster(conn, config, ahn2_rast_dir, ahn3_rast_dir, threads=3,
+                    doexec=True):
+    """Download the AHN 0.5m raster files of the tiles that are not on the border
+    
+    AHN3 where it is available, AHN2 elsewhere. The rasters are converted to 
+    Cloud-Optimized GeoTIFF, unless quality:cog is False, and are recorded in 
+    the raster catalog of the directory (see :py:func:`rast_file_idx`).
+    """
     tbl_schema = config["tile_index"]['elevation']['schema']
     tbl_name = config["tile_index"]['elevation']['table']
     tbl_tile = config["tile_index"]['elevation']['fields']['unit_name']
     border_table = config["tile_index"]['elevation']['border_table']
+    cog = config["quality"].get('cog', True) is not False
+    path_gdal_translate = config.get('path_gdal_translate') or 'gdal_translate'
     
     ahn2_url = "http://geodata.nationaalgeoregister.nl/ahn2/extract/ahn2_05m_ruw/r{}.tif.zip"
     ahn3_url = "https://geodata.nationaalgeoregister.nl/ahn3/extract/ahn3_05m_dsm/R_{}.ZIP"
@@ -214,13 +457,19 @@ def download_raster(conn, config, ahn2_rast_dir, ahn3_rast_dir, doexec=True):
     ahn2_tiles = [t[0].lower() for t in bt if t[1] is not None and t[1]==2]
     ahn3_tiles = [t[0].upper() for t in bt if t[1] is not None and t[1]==3]
     
-    downloader(ahn2_tiles, ahn2_url, ahn2_rast_dir, doexec)
-    downloader(ahn3_tiles, ahn3_url, ahn3_rast_dir, doexec)
+    failed = downloader(ahn2_tiles, ahn2_url, ahn2_rast_dir, threads, cog,
+                        path_gdal_translate, doexec)
+    failed += downloader(ahn3_tiles, ahn3_url, ahn3_rast_dir, threads, cog,
+                         path_gdal_translate, doexec)
+    return failed
 
 
 def rast_file_idx(conn, config, ahn2_rast_dir, ahn3_rast_dir):
     """Create an index of tiles and AHN raster files
     
+    The raster catalog of the directory is used if it exists, otherwise the 
+    files are matched by their name.
+    
     Parameters
     ----------
     ahn2_rast_dir : str
@@ -235,8 +484,6 @@ def rast_file_idx(conn, config, ahn2_rast_dir, ahn3_rast_dir):
     """
     assert os.path.isdir(ahn2_rast_dir)
     assert os.path.isdir(ahn3_rast_dir)
-    ahn2_files = os.listdir(ahn2_rast_dir)
-    ahn3_files = os.listdir(ahn3_rast_dir)
     
     tbl_schema = config["tile_index"]['elevation']['schema']
     tbl_name = config["tile_index"]['elevation']['table']
@@ -245,22 +492,21 @@ def rast_file_idx(conn, config, ahn2_rast_dir, ahn3_rast_dir):
     bt = border.get_non_border_tiles(conn, tbl_schema, tbl_name, 
                                      border_table, tbl_tile)
     ahn2_tiles = [t[0].lower() for t in bt if t[1] is not None and t[1]==2]
-    ahn3_tiles = [t[0].upper() for t in bt if t[1] is not None and t[1]==3]
+    ahn3_tiles = [t[0].lower() for t in bt if t[1] is not None and t[1]==3]
     
     file_idx = {}
-    for tile in ahn2_tiles:
-        t = tile.lower()
-        f = "r{}.tif".format(t)
-        if f in ahn2_files:
-            file_idx[t] = os.path.join(ahn2_rast_dir,f)
-        else:
-            pass
-    for tile in ahn3_tiles:
-        t = tile.lower()
-        f = "r_{}.tif".format(t)
-        if f in ahn3_files:
-            file_idx[t] = os.path.join(ahn3_rast_dir,f)
+    for rast_dir,tiles,pat in [(ahn2_rast_dir, ahn2_tiles, "r{}.tif"),
+                               (ahn3_rast_dir, ahn3_tiles, "r_{}.tif")]:
+        catalog = read_catalog(rast_dir)
+        if catalog:
+            for t in tiles:
+                if t in catalog:
+                    file_idx[t] = catalog[t]['path']
         else:
-            pass
+            files = set(os.listdir(rast_dir))
+            for t in tiles:
+                f = pat.format(t)
+                if f in files:
+                    file_idx[t] = os.path.join(rast_dir, f)
     logger.debug(file_idx)
     return file_idx
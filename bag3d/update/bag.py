@@ -2,10 +2,20 @@
 
 """Update the BAG database (2D) and tile index"""
 
+import os
 import os.path
-from time import sleep, process_time
-from datetime import datetime, date
-from subprocess import PIPE
+import io
+import re
+import struct
+import hashlib
+import shlex
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, process_time, perf_counter
+from datetime import datetime, date, timezone
+from email.utils import parsedate_to_datetime
+from subprocess import PIPE, TimeoutExpired
 from psutil import Popen, Process, NoSuchProcess, ZombieProcess, AccessDenied, swap_memory
 import locale
 
@@ -14,14 +24,20 @@ import locale
 import logging
 from bs4 import BeautifulSoup
 import urllib.request
+import fiona
 from psycopg2 import sql
 
 from bag3d.config import db
+from bag3d import telemetry
 
 
 logger = logging.getLogger(__name__)
 logger_perf = logging.getLogger('performance')
 
+BAG_SCHEMA = 'bagactueel'
+BAG_DIR = './data.nlextract.nl/bag/postgis'
+BAG_FILE = 'bag-laatst.backup'
+
 
 # def report_procs(pid):
 #     proc = Process(pid)
@@ -42,7 +58,8 @@ logger_perf = logging.getLogger('performance')
     #     return None
 
 
-def run_subprocess(command, shell=False, doexec=True, monitor=False, tile_id=None):
+def run_subprocess(command, shell=False, doexec=True, monitor=False, tile_id=None,
+                   stats=None):
     """Subprocess runner
     
     If subrocess returns non-zero exit code, STDERR is sent to the logger.
@@ -55,6 +72,10 @@ def run_subprocess(command, shell=False, doexec=True, monitor=False, tile_id=Non
         Passed to subprocess.run()
     doexec : bool
         Execute the subprocess or just print out the concatenated command
+    stats : dict
+        If provided, it is filled with the resource usage of the process and 
+        its children: wall_time (s), cpu_time (s), peak_rss (bytes). The 
+        memory and CPU usage is sampled every second.
     
     Returns
     -------
@@ -66,6 +87,7 @@ def run_subprocess(command, shell=False, doexec=True, monitor=False, tile_id=Non
         if shell:
             command = cmd
         logger.debug(command)
+        start = perf_counter()
         popen = Popen(command, shell=shell, stderr=PIPE, stdout=PIPE)
         pid = popen.pid
         if monitor:
@@ -95,9 +117,13 @@ def run_subprocess(command, shell=False, doexec=True, monitor=False, tile_id=Non
         #             running = proc.is_running()
         #             logger.debug("%s is running: %s" % (tile_id, running))
         #             sleep(1)
-        stdout, stderr = popen.communicate()
+        if stats is not None:
+            stdout, stderr = monitor_process(popen, stats)
+        else:
+            stdout, stderr = popen.communicate()
         err = stderr.decode(locale.getpreferredencoding(do_setlocale=True))
         popen.wait()
+        telemetry.add_time('subprocess', perf_counter() - start)
         if popen.returncode != 0:
             logger.debug("Process returned with non-zero exit code: %s", popen.returncode)
             logger.error(err)
@@ -109,6 +135,53 @@ def run_subprocess(command, shell=False, doexec=True, monitor=False, tile_id=Non
         return True
 
 
+def monitor_process(popen, stats, interval=1):
+    """Wait for the process while sampling its resource usage
+    
+    Parameters
+    ----------
+    popen : psutil.Popen
+        The running process
+    stats : dict
+        Filled with wall_time (s), cpu_time (s), peak_rss (bytes) of the 
+        process and its children
+    interval : float
+        Sampling interval in seconds
+    
+    Returns
+    -------
+    tuple
+        (stdout, stderr) as returned by Popen.communicate()
+    """
+    start = perf_counter()
+    peak_rss = 0
+    cpu = {}
+    while True:
+        try:
+            procs = [popen] + popen.children(recursive=True)
+        except (NoSuchProcess, ZombieProcess):
+            procs = []
+        rss = 0
+        for p in procs:
+            try:
+                with p.oneshot():
+                    rss += p.memory_info().rss
+                    t = p.cpu_times()
+                    cpu[p.pid] = t.user + t.system
+            except (NoSuchProcess, ZombieProcess, AccessDenied):
+                pass
+        peak_rss = max(peak_rss, rss)
+        try:
+            stdout, stderr = popen.communicate(timeout=interval)
+            break
+        except TimeoutExpired:
+            continue
+    stats['wall_time'] = perf_counter() - start
+    stats['cpu_time'] = sum(cpu.values())
+    stats['peak_rss'] = peak_rss
+    return stdout, stderr
+
+
 def get_latest_BAG(url):
     """Get the date of the latest BAG extract from NLExtract
     
@@ -169,61 +242,431 @@ CREATE SCHEMA IF NOT EXISTS tile_index;
         logger.debug(conn.print_query(query))
 
 
-def run_pg_restore(dbase, doexec=True):
+def download_BAG(url, doexec=True):
+    """Download the latest BAG extract
+    
+    An interrupted download is resumed, unless the extract was republished 
+    since (see :py:func:`remote_last_modified`). The file is verified with its 
+    MD5 checksum, and it is deleted if the checksum does not match.
+    
+    Parameters
+    ----------
+    url : str
+        URL to the BAG extract eg http://data.nlextract.nl/bag/postgis/
+    doexec : bool
+        Passed to :py:func:`run_subprocess`
+    
+    Returns
+    -------
+    bool
+        True on success, False on failure
+    """
+    dl_url = os.path.join(url, BAG_FILE)
+    path = os.path.join(BAG_DIR, BAG_FILE)
+    if doexec and os.path.exists(path):
+        # NLExtract publishes the new extracts under the same name, thus a 
+        # kept file from an older extract cannot be resumed
+        remote = remote_last_modified(dl_url)
+        local = datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+        if remote is None or remote > local:
+            logger.info("Discarding %s, there is a newer extract", path)
+            os.remove(path)
+    command = ['wget', '-q', '-c', '-x', dl_url] 
+    if not run_subprocess(command, doexec=doexec):
+        return False
+    if doexec:
+        if verify_BAG(url, path) is False:
+            os.remove(path)
+            return False
+    return True
+
+
+def remote_last_modified(url):
+    """The Last-Modified time of a file on the server
+    
+    Returns
+    -------
+    datetime.datetime
+        Timezone-aware, or None if it cannot be determined
+    """
+    try:
+        req = urllib.request.Request(url, method='HEAD')
+        with urllib.request.urlopen(req) as r:
+            lm = r.headers.get('Last-Modified')
+        return parsedate_to_datetime(lm) if lm else None
+    except (urllib.error.URLError, TypeError, ValueError) as e:
+        logger.warning("Cannot get the Last-Modified time of %s: %s", url, e)
+        return None
+
+
+def md5sum(path):
+    """MD5 checksum of a file"""
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def verify_BAG(url, path):
+    """Verify the downloaded BAG extract with the MD5 checksum of NLExtract
+    
+    Parameters
+    ----------
+    url : str
+        URL to the BAG extract eg http://data.nlextract.nl/bag/postgis/
+    path : str
+        Path to the downloaded file
+    
+    Returns
+    -------
+    bool or None
+        True if the checksum matches, False if not, None if there is no 
+        checksum to compare to
+    """
+    try:
+        r = urllib.request.urlopen(os.path.join(url, BAG_FILE + '.md5')).read()
+        expected = r.decode().split()[0].lower()
+    except (urllib.error.URLError, IndexError, UnicodeDecodeError):
+        logger.warning("Cannot get the MD5 checksum of %s, not verifying the download", BAG_FILE)
+        return None
+    actual = md5sum(path)
+    if actual != expected:
+        logger.error("MD5 checksum of %s does not match, expected %s got %s",
+                     path, expected, actual)
+        return False
+    return True
+
+
+def pg_conn_args(dbase):
+    """The connection arguments of psql and pg_restore
+    
+    Parameters
+    ----------
+    dbase : dict
+        Dict containing the database connection parameters from the config file
+    
+    Returns
+    -------
+    list of str
+    """
+    return ['-h', str(dbase['host']), '-p', str(dbase['port']),
+            '-U', dbase['user'], '-d', dbase['dbname'], '-w']
+
+
+def count_tables(conn, schema):
+    """Nr. of tables in a schema, 0 if the schema does not exist"""
+    query = sql.SQL("""
+    SELECT count(*) FROM information_schema.tables
+    WHERE table_schema = {schema} AND table_type = 'BASE TABLE';
+    """).format(schema=sql.Literal(schema))
+    logger.debug(conn.print_query(query))
+    return conn.getQuery(query)[0][0]
+
+
+def run_pg_restore(dbase, jobs=20, doexec=True):
     """Run the pg_restore process
     
+    Drops the *bagactueel* schema, then restores the BAG extract into it.
+    
+    Note
+    ----
+    With --no-owner --no-privileges, pg_restore exits with non-zero even if 
+    it only skipped ignorable errors (eg. the objects that exist in public), 
+    thus the result should be checked on the database (see 
+    :py:func:`count_tables`) instead of relying on the return value.
+    
     Parameters
     ----------
     dbase : dict
         Dict containing the database connection parameters from the config file
+    jobs : int
+        Nr. of parallel pg_restore jobs
     doexec : bool
         Passed to :py:func:`run_subprocess`
     
     Returns
     -------
-    nothing
-        nothing
+    bool
+        True if pg_restore exited with 0
     """
     # Drop the schema first in order to restore
-    command = ['psql', '-h', dbase['host'], '-U', dbase['user'],
-               '-d', dbase['dbname'], '-w', '-c',
-               "'DROP SCHEMA IF EXISTS bagactueel CASCADE;'"]
+    command = ['psql'] + pg_conn_args(dbase) + [
+               '-c', "'DROP SCHEMA IF EXISTS bagactueel CASCADE;'"]
     run_subprocess(command, shell=True, doexec=doexec)
     
     # Restore from the latest extract
-    command = ['pg_restore', '--no-owner', '--no-privileges', '-j', '20',
-               '-h', dbase['host'], '-U', dbase['user'], '-d', dbase['dbname'],
-               '-w', './data.nlextract.nl/bag/postgis/bag-laatst.backup']
-    run_subprocess(command, doexec=doexec)
+    command = ['pg_restore', '--no-owner', '--no-privileges', '-j', str(jobs)] + \
+              pg_conn_args(dbase) + [os.path.join(BAG_DIR, BAG_FILE)]
+    return run_subprocess(command, doexec=doexec)
 
 
-def download_BAG(url, doexec=True):
-    """Download the latest BAG extract
+def split_toc(toc, jobs):
+    """Split the table of contents of a dump for a parallel restore
     
     Parameters
     ----------
-    url : str
-        URL to the BAG extract eg http://data.nlextract.nl/bag/postgis/
+    toc : list of str
+        The lines of ``pg_restore -l``
+    jobs : int
+        Nr. of parallel jobs
+    
+    Returns
+    -------
+    tuple
+        (data, indexes, rest), where *data* and *indexes* are at most *jobs* 
+        TOC lists with the table data and with the indexes and primary keys, 
+        and *rest* is a TOC list with all the other entries
+    """
+    entries = [l for l in toc if l.strip() and not l.startswith(';')]
+    data = [[] for i in range(jobs)]
+    indexes = [[] for i in range(jobs)]
+    rest = []
+    d = 0
+    i = 0
+    for e in entries:
+        if ' TABLE DATA ' in e or ' SEQUENCE SET ' in e:
+            data[d % jobs].append(e)
+            d += 1
+        elif (' INDEX ' in e and ' INDEX ATTACH ' not in e) or \
+                (' CONSTRAINT ' in e and ' FK CONSTRAINT ' not in e):
+            indexes[i % jobs].append(e)
+            i += 1
+        else:
+            rest.append(e)
+    return ([l for l in data if l], [l for l in indexes if l], rest)
+
+
+def filter_toc(toc, schema):
+    """The entries of a pg_restore table of contents that belong to a schema
+    
+    The entries are in the form of '<id>; <catalog> <oid> <TYPE> <schema> 
+    <name> <owner>', the schema itself is '... SCHEMA - <schema> <owner>' 
+    and its comment is '... COMMENT - SCHEMA <schema> <owner>'.
+    
+    Parameters
+    ----------
+    toc : list of str
+        The lines of ``pg_restore -l``
+    schema : str
+        Name of the schema
+    
+    Returns
+    -------
+    list of str
+    """
+    out = []
+    for l in toc:
+        m = re.match(r'^\d+; \d+ \d+ (?:[A-Z]+ )+(\S+) (\S+)', l)
+        if m is None:
+            continue
+        if m.group(1) == schema:
+            out.append(l)
+        # the schema and the comment on it
+        elif m.group(1) == '-' and (' SCHEMA - %s ' % schema in l or
+                                    ' - SCHEMA %s ' % schema in l):
+            out.append(l)
+    return out
+
+
+def pipefail(commands):
+    """A shell pipeline that fails if any of its commands fails
+    
+    /bin/sh only returns the exit status of the last command of a pipeline, 
+    thus eg. a pg_restore that dies on a truncated archive would go 
+    unnoticed if psql exits cleanly. The pipeline is run by bash with the 
+    pipefail option.
+    
+    Parameters
+    ----------
+    commands : list of str
+        The commands of the pipeline
+    
+    Returns
+    -------
+    list of str
+        Command to pass to :py:func:`run_subprocess` with shell=True
+    """
+    return ['bash', '-o', 'pipefail', '-c', shlex.quote(" | ".join(commands))]
+
+
+def run_pg_restore_staging(dbase, jobs=20, staging=BAG_SCHEMA + '_staging',
+                           doexec=True):
+    """Restore the BAG extract into a staging schema
+    
+    pg_restore cannot restore into a schema with a different name, thus the 
+    dump is restored as SQL through psql, with the schema-qualified names 
+    rewritten to *staging*. Only the objects of bagactueel are restored 
+    (see :py:func:`filter_toc`), the objects in other schemas (eg. public, 
+    the extensions) must exist in the database. The table data and then the 
+    indexes and primary keys are restored by *jobs* parallel pg_restore | psql pipelines, the rest of the 
+    objects (eg. foreign keys) after them. A pipeline fails if any of its 
+    commands fails (see :py:func:`pipefail`).
+    
+    Parameters
+    ----------
+    dbase : dict
+        Dict containing the database connection parameters from the config file
+    jobs : int
+        Nr. of parallel restore pipelines
+    staging : str
+        Name of the staging schema, it is dropped if exists
     doexec : bool
         Passed to :py:func:`run_subprocess`
     
+    Returns
+    -------
+    bool
+        True on success, False on failure
+    """
+    dump = os.path.join(BAG_DIR, BAG_FILE)
+    psql = " ".join(['psql', '-q', '-v', 'ON_ERROR_STOP=1'] + pg_conn_args(dbase))
+    restore = "pg_restore --no-owner --no-privileges --section={s} {l} -f - " + dump
+    rename_ddl = r"sed -E 's/\b%s\./%s./g; s/SCHEMA %s\b/SCHEMA %s/g'" % (
+        BAG_SCHEMA, staging, BAG_SCHEMA, staging)
+    rename_data = r"sed -E 's/^COPY %s\./COPY %s./; s/setval\(.%s\./setval('\''%s./'" % (
+        BAG_SCHEMA, staging, BAG_SCHEMA, staging)
+
+    def pipeline(section, toc_list, rename):
+        l = "-L %s" % toc_list if toc_list else ""
+        command = pipefail([restore.format(s=section, l=l), rename, psql])
+        return run_subprocess(command, shell=True, doexec=doexec)
+
+    command = ['psql'] + pg_conn_args(dbase) + [
+               '-c', "'DROP SCHEMA IF EXISTS %s CASCADE;'" % staging]
+    run_subprocess(command, shell=True, doexec=doexec)
+
+    if doexec:
+        toc = subprocess.run(['pg_restore', '-l', dump], stdout=subprocess.PIPE,
+                             check=True).stdout.decode().splitlines()
+    else:
+        toc = []
+    toc = filter_toc(toc, BAG_SCHEMA)
+    data, indexes, rest = split_toc(toc, jobs)
+    with tempfile.TemporaryDirectory() as tmp:
+        def write_list(name, entries):
+            p = os.path.join(tmp, name)
+            with open(p, 'w') as f:
+                f.write("\n".join(entries) + "\n")
+            return p
+
+        if not pipeline('pre-data', write_list("pre-data.list", toc), rename_ddl):
+            return False
+        for section, lists, rename in [('data', data, rename_data),
+                                       ('post-data', indexes, rename_ddl)]:
+            paths = [write_list("%s_%s.list" % (section, n), l)
+                     for n,l in enumerate(lists)]
+            logger.info("Restoring the %s section in %s jobs", section, len(paths))
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                res = list(executor.map(
+                    lambda p: pipeline(section, p, rename), paths))
+            if not all(res):
+                return False
+        if rest:
+            return pipeline('post-data', write_list("rest.list", rest), rename_ddl)
+    return True
+
+
+def swap_schema(conn, staging=BAG_SCHEMA + '_staging', doexec=True):
+    """Replace the bagactueel schema with the staging schema
+    
+    The schemas are renamed in a single transaction, so the queries see 
+    either the old or the new BAG. The old BAG is kept as *bagactueel_old* 
+    until the next swap.
+    
+    The views outside bagactueel that depend on it (eg. the tile views in 
+    tile_schema) are bound to the old BAG by the rename, therefore they are 
+    recreated on the new BAG in the same transaction, with their definition 
+    from before the swap. The views that depend on these are bound to them, 
+    thus they follow. If there are materialized views depending on bagactueel, 
+    or a view cannot be recreated (eg. a column was removed from the BAG), 
+    the swap fails and nothing is changed.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    staging : str
+        Name of the staging schema
+    doexec : bool
+        Execute the query
+    
+    Raises
+    ------
+    psycopg2.Error
+        If the dependent objects cannot be moved to the new BAG
+    
     Returns
     -------
     nothing
         nothing
     """
-    dl_url = os.path.join(url, 'bag-laatst.backup')
-    command = ['wget', '-q', '-r', dl_url] 
-    run_subprocess(command, doexec=doexec)
+    old = BAG_SCHEMA + '_old'
+    query = sql.SQL("""
+    DROP SCHEMA IF EXISTS {old} CASCADE;
+    DO $$
+    DECLARE
+        r record;
+        views text[] := '{{}}';
+        v text;
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = {live_name}) THEN
+            -- the relations outside the schema that are defined on it
+            FOR r IN
+                SELECT DISTINCT c.oid, c.oid::regclass::text AS name, c.relkind
+                FROM pg_depend d
+                JOIN pg_rewrite rw ON rw.oid = d.objid
+                JOIN pg_class c ON c.oid = rw.ev_class
+                JOIN pg_class t ON t.oid = d.refobjid
+                JOIN pg_namespace tn ON tn.oid = t.relnamespace
+                JOIN pg_namespace cn ON cn.oid = c.relnamespace
+                WHERE d.classid = 'pg_rewrite'::regclass
+                    AND d.refclassid = 'pg_class'::regclass
+                    AND tn.nspname = {live_name}
+                    AND cn.nspname <> {live_name}
+            LOOP
+                IF r.relkind <> 'v' THEN
+                    RAISE EXCEPTION '% depends on % and cannot be moved to the new BAG, drop it before the update',
+                        r.name, {live_name};
+                END IF;
+                views := views || format('CREATE OR REPLACE VIEW %s AS %s',
+                                         r.name, pg_get_viewdef(r.oid));
+            END LOOP;
+            ALTER SCHEMA {live} RENAME TO {old};
+        END IF;
+        ALTER SCHEMA {staging} RENAME TO {live};
+        FOREACH v IN ARRAY views LOOP
+            EXECUTE v;
+        END LOOP;
+        RAISE NOTICE 'Recreated % views on the new BAG', coalesce(array_length(views, 1), 0);
+    END $$;
+    """).format(old=sql.Identifier(old),
+                live=sql.Identifier(BAG_SCHEMA),
+                live_name=sql.Literal(BAG_SCHEMA),
+                staging=sql.Identifier(staging))
+    logger.debug(conn.print_query(query))
+    if doexec:
+        conn.sendQuery(query)
 
 
-def restore_BAG(dbase, doexec=True):
+def restore_BAG(dbase, jobs=20, staging=False, doexec=True):
     """Restores the BAG extract into a database
     
+    With *staging*, the extract is restored into the *bagactueel_staging* 
+    schema, which then replaces *bagactueel* (see :py:func:`swap_schema`), 
+    thus the BAG remains queryable during the update. Otherwise the 
+    *bagactueel* schema is dropped before the restore. The downloaded 
+    extract is only deleted after a successful restore, so that a failed 
+    update can resume the download.
+    
     Parameters
     ----------
     dbase : dict
         Dict containing the database connection parameters from the config file
+    jobs : int
+        Nr. of parallel restore jobs
+    staging : bool
+        Restore into a staging schema and swap it with bagactueel
     doexec : bool
         Passed to :py:func:`run_subprocess`
     
@@ -261,29 +704,61 @@ def restore_BAG(dbase, doexec=True):
     # Download the latest dump if necessary ------------------------------------
     if bag_latest > godzilla_update:
         logger.info("There is a newer BAG-extract available, starting download and update...")
-        download_BAG(bag_url, doexec=doexec)
+        if not download_BAG(bag_url, doexec=doexec):
+            logger.error("Failed to download the BAG extract")
+            conn.close()
+            return False
         
-        run_pg_restore(dbase, doexec=doexec)
+        if staging:
+            restored = run_pg_restore_staging(dbase, jobs=jobs, doexec=doexec)
+            note = 'auto-update by swapping the bagactueel schema'
+        else:
+            restored = run_pg_restore(dbase, jobs=jobs, doexec=doexec)
+            note = 'auto-update by overwriting the bagactueel schema'
+            # the live schema is already dropped, thus what counts is 
+            # whether it is restored, not the exit code of pg_restore
+            if not restored and doexec:
+                n = count_tables(conn, BAG_SCHEMA)
+                logger.warning("pg_restore exited with errors, %s tables are restored into %s",
+                               n, BAG_SCHEMA)
+                restored = n > 0
+        if not restored:
+            logger.error("Failed to restore the BAG extract, keeping %s for the next attempt",
+                         BAG_DIR)
+            conn.close()
+            return False
+        if staging:
+            swap_schema(conn, doexec=doexec)
         
         # Update timestamp in bag_updates
         query = sql.SQL("""
 INSERT INTO public.bag_updates (last_update, note)
-VALUES ({}, 'auto-update by overwriting the bagactueel schema');
-        """).format(sql.Literal(bag_latest))
+VALUES ({}, {});
+        """).format(sql.Literal(bag_latest), sql.Literal(note))
 #         logger.debug(query.as_string(conn.conn).strip().replace('\n', ' '))
         logger.debug(conn.print_query(query))
         
         if doexec:
             conn.sendQuery(query)
-            conn.sendQuery("""
-            COMMENT ON SCHEMA bagactueel IS 
-            '!!! WARNING !!! This schema contains the BAG itself.
-             At every update, there is a DROP SCHEMA bagactueel CASCADE,
-            which deletes the schema with all its contents and all objects
-            depending on the schema. Therefore you might want to save
-            your scripts to recreate the views etc. that depend on
-            this schema, otherwise they will be lost forever.';
-            """)
+            if staging:
+                conn.sendQuery("""
+                COMMENT ON SCHEMA bagactueel IS 
+                '!!! WARNING !!! This schema contains the BAG itself.
+                 At every update, it is renamed to bagactueel_old and the
+                previous bagactueel_old is dropped with DROP SCHEMA CASCADE.
+                The views that depend on this schema are recreated on the new
+                BAG, the update fails if there are other dependent objects.';
+                """)
+            else:
+                conn.sendQuery("""
+                COMMENT ON SCHEMA bagactueel IS 
+                '!!! WARNING !!! This schema contains the BAG itself.
+                 At every update, there is a DROP SCHEMA bagactueel CASCADE,
+                which deletes the schema with all its contents and all objects
+                depending on the schema. Therefore you might want to save
+                your scripts to recreate the views etc. that depend on
+                this schema, otherwise they will be lost forever.';
+                """)
             try:
                 conn.conn.commit()
                 logger.debug("Updated bag_updates and commented on bagactueel schema.")
@@ -311,7 +786,7 @@ def import_index(idx, dbname, tile_schema, host, port, user,
     """Import the tile index into the database
     
     Calls ogr2ogr to import a tile index with EPSG:28992 into the tile_index
-    schema.
+    schema. Kept for the file formats that :py:func:`load_index` cannot read.
     """
     if pw:
         pg_conn = 'PG:"dbname={d} host={h} port={p} user={u} password={pw}"'.format(
@@ -330,6 +805,227 @@ def import_index(idx, dbname, tile_schema, host, port, user,
     run_subprocess(command, shell=True, doexec=doexec)
 
 
+# Column types of the fiona field types in the tile index
+INDEX_FIELD_TYPES = {
+    'int': 'integer',
+    'int32': 'integer',
+    'int64': 'bigint',
+    'float': 'double precision',
+    'str': 'varchar',
+    'bool': 'boolean',
+    'date': 'date',
+    'time': 'time',
+    'datetime': 'timestamp with time zone'
+    }
+
+_WKB_TYPES = {'LineString': 2, 'Polygon': 3, 'MultiPolygon': 6}
+
+
+def _wkb_rings(rings):
+    b = struct.pack('<I', len(rings))
+    for ring in rings:
+        b += struct.pack('<I', len(ring))
+        for pt in ring:
+            b += struct.pack('<2d', pt[0], pt[1])
+    return b
+
+
+def ewkb_hex(geometry, srid=28992):
+    """Hex-encoded EWKB of a GeoJSON-like geometry
+    
+    Only the geometry types of a tile index are supported (LineString, 
+    Polygon, MultiPolygon). The Z coordinates are dropped.
+    
+    Parameters
+    ----------
+    geometry : dict
+        GeoJSON-like geometry, as returned by fiona
+    srid : int
+        EPSG code that is embedded in the EWKB
+    
+    Returns
+    -------
+    str
+        The EWKB as hex string, as PostGIS accepts it in COPY
+    """
+    gtype = geometry['type']
+    if gtype not in _WKB_TYPES:
+        raise ValueError("Unsupported geometry type %s" % gtype)
+    b = struct.pack('<BII', 1, _WKB_TYPES[gtype] | 0x20000000, srid)
+    coords = geometry['coordinates']
+    if gtype == 'LineString':
+        b += struct.pack('<I', len(coords))
+        for pt in coords:
+            b += struct.pack('<2d', pt[0], pt[1])
+    elif gtype == 'Polygon':
+        b += _wkb_rings(coords)
+    else:
+        b += struct.pack('<I', len(coords))
+        for polygon in coords:
+            b += struct.pack('<BI', 1, _WKB_TYPES['Polygon'])
+            b += _wkb_rings(polygon)
+    return b.hex()
+
+
+def border_line(bounds):
+    """The lower/left boundary of a bounding box
+    
+    The same line as :py:func:`bag3d.config.footprints.update_tile_index`
+    computes.
+    
+    Parameters
+    ----------
+    bounds : tuple
+        (xmin, ymin, xmax, ymax)
+    
+    Returns
+    -------
+    dict
+        GeoJSON-like LineString
+    """
+    xmin, ymin, xmax, ymax = bounds
+    return {'type': 'LineString',
+            'coordinates': [(xmax, ymin), (xmin, ymin), (xmin, ymax)]}
+
+
+def _geom_bounds(geometry):
+    coords = geometry['coordinates']
+    if geometry['type'] == 'Polygon':
+        coords = [coords]
+    pts = [pt for polygon in coords for ring in polygon for pt in ring]
+    xs = [pt[0] for pt in pts]
+    ys = [pt[1] for pt in pts]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def _copy_value(v):
+    """A value in the text format of COPY"""
+    if v is None:
+        return '\\N'
+    s = str(v)
+    for c,e in [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')]:
+        s = s.replace(c, e)
+    return s
+
+
+def load_index(conn, idx, schema, table, fields_index=['id', 'geom'],
+               border=False, srid=28992, doexec=True):
+    """Load a tile index into the database without ogr2ogr
+    
+    Reads the tile index with fiona and copies the features as EWKB with a 
+    single COPY into a new table. The primary key and the GIST indexes are 
+    created after the load, and the ID is a serial like with ogr2ogr. All the attributes of the file are kept, 
+    including the *ahn_version* and *file_date* of the AHN tile index.
+    
+    Features without a geometry or with an unsupported geometry type are 
+    skipped, like ogr2ogr does with ``-skip-failure``.
+    
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    idx : str
+        Path to the tile index file (eg. GeoJSON, GeoPackage)
+    schema : str
+        Schema of the tile index
+    table : str
+        Table of the tile index, it is overwritten
+    fields_index : list of str
+        [ID, geometry] field names in the table. The ID is taken from the 
+        attribute with the same name in the file, or it is a sequential 
+        integer if there is no such attribute.
+    border : bool
+        Add the geom_border field with the lower/left boundary of each 
+        polygon, which is otherwise done by 
+        :py:func:`bag3d.config.footprints.update_tile_index`
+    srid : int
+        EPSG code of the geometries
+    
+    Returns
+    -------
+    int
+        Nr. of loaded features
+    """
+    id_col, geom_col = fields_index
+    i = os.path.abspath(idx)
+    with fiona.open(i, 'r') as src:
+        geom_type = src.schema['geometry'].replace('3D ', '')
+        if geom_type not in ('Polygon', 'MultiPolygon'):
+            geom_type = 'Geometry'
+        props = [(k, INDEX_FIELD_TYPES.get(v.split(':')[0], 'varchar'))
+                 for k,v in src.schema['properties'].items() if k != id_col]
+        has_id = id_col in src.schema['properties']
+
+        buf = io.StringIO()
+        cnt = 0
+        skipped = 0
+        for n,feature in enumerate(src):
+            geometry = feature['geometry']
+            if geometry is None or geometry['type'] not in ('Polygon', 'MultiPolygon'):
+                skipped += 1
+                continue
+            fid = feature['properties'][id_col] if has_id else n + 1
+            row = [fid] + [feature['properties'][k] for k,_ in props]
+            row.append(ewkb_hex(geometry, srid))
+            if border:
+                row.append(ewkb_hex(border_line(_geom_bounds(geometry)), srid))
+            buf.write('\t'.join(_copy_value(v) for v in row) + '\n')
+            cnt += 1
+    if skipped > 0:
+        logger.warning("Skipped %s features without a polygon geometry in %s",
+                       skipped, i)
+
+    columns = [sql.SQL("{} serial").format(sql.Identifier(id_col))]
+    columns += [sql.SQL("{} {}").format(sql.Identifier(k), sql.SQL(t))
+                for k,t in props]
+    columns.append(sql.SQL("{} geometry({}, {})").format(
+        sql.Identifier(geom_col), sql.SQL(geom_type), sql.Literal(srid)))
+    if border:
+        columns.append(sql.SQL("geom_border geometry(linestring, {})").format(
+            sql.Literal(srid)))
+    schema_q = sql.Identifier(schema)
+    table_q = sql.Identifier(table)
+    query = sql.SQL("""
+    DROP TABLE IF EXISTS {schema}.{table} CASCADE;
+    CREATE TABLE {schema}.{table} ({columns});
+    """).format(schema=schema_q, table=table_q,
+                columns=sql.SQL(', ').join(columns))
+    query_copy = sql.SQL("COPY {schema}.{table} FROM STDIN;").format(
+        schema=schema_q, table=table_q)
+    query_idx = sql.SQL("""
+    ALTER TABLE {schema}.{table} ADD PRIMARY KEY ({id_col});
+    SELECT setval(pg_get_serial_sequence({name}, {id_name}),
+                  coalesce(max({id_col}), 0) + 1, false)
+    FROM {schema}.{table};
+    CREATE INDEX {geom_idx} ON {schema}.{table} USING gist ({geom_col});
+    """).format(schema=schema_q, table=table_q,
+                id_col=sql.Identifier(id_col),
+                name=sql.Literal('"%s"."%s"' % (schema, table)),
+                id_name=sql.Literal(id_col),
+                geom_col=sql.Identifier(geom_col),
+                geom_idx=sql.Identifier(table + "_" + geom_col + "_geom_idx"))
+    if border:
+        query_idx += sql.SQL("""
+        CREATE INDEX {border_idx} ON {schema}.{table} USING gist (geom_border);
+        """).format(schema=schema_q, table=table_q,
+                    border_idx=sql.Identifier(table + "_" + geom_col + "_border_idx"))
+    logger.debug(conn.print_query(query))
+    logger.debug(conn.print_query(query_copy))
+    logger.debug(conn.print_query(query_idx))
+    if doexec:
+        start = perf_counter()
+        buf.seek(0)
+        with conn.conn:
+            with conn.conn.cursor() as cur:
+                cur.execute(query)
+                cur.copy_expert(query_copy, buf)
+                cur.execute(query_idx)
+        telemetry.add_time('db', perf_counter() - start)
+        conn.vacuum(schema, table)
+    logger.info("Loaded %s features from %s into %s.%s", cnt, i, schema, table)
+    return cnt
+
+
 def grant_access(conn, user, tile_schema, tile_index_schema):
     """Grants all the necessary privileges for a user for operating on the 3DBAG database
     
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+import yaml
+
+import bag3d
+from bag3d.config import args
+from bag3d.config import db
+
+from data import EXAMPLE_DIR, load_example_data, configure
+
+
+def pytest_addoption(parser):
+    parser.addoption("--bench-config", action="store",
+                     default=os.path.join(EXAMPLE_DIR, "bag3d_test.yml"),
+                     help="bag3d config with the database for the benchmarks")
+    parser.addoption("--scale", action="store", type=int, default=1,
+                     help="Nr. of copies of the example tile")
+
+
+#-------------------------------------------------------------- data & folders
+@pytest.fixture(scope="session")
+def scale(request):
+    return request.config.getoption("--scale")
+
+
+@pytest.fixture(scope="session")
+def pc_dirs(tmpdir_factory):
+    """Copies of the example point cloud directories, with links to the files"""
+    dirs = []
+    for d in ['ahn3', 'ahn2']:
+        src = os.path.join(EXAMPLE_DIR, d, 'laz')
+        dst = tmpdir_factory.mktemp(d)
+        for f in os.listdir(src):
+            os.symlink(os.path.join(src, f), str(dst.join(f)))
+        dirs.append(str(dst))
+    return dirs
+
+
+@pytest.fixture(scope="session")
+def cfg(request, tmpdir_factory, pc_dirs):
+    """The configuration of the benchmarks, with the output in a temporary directory"""
+    with open(request.config.getoption("--bench-config"), 'r') as f:
+        c = yaml.safe_load(f)
+    root = tmpdir_factory.mktemp("bag3d")
+    c['input_elevation']['dataset_dir'] = pc_dirs
+    c['output']['dir'] = str(root.join("output"))
+    c['input_polygons']['extent'] = None
+    c['input_polygons']['tile_list'] = ['all']
+    cfg_file = str(root.join("bag3d_cfg.yml"))
+    with open(cfg_file, 'w') as f:
+        yaml.dump(c, f)
+    schema = os.path.join(os.path.dirname(bag3d.__file__), 'bag3d_cfg_schema.yml')
+    return args.parse_config({'cfg_file': cfg_file, 'threads': 1}, schema)
+
+
+@pytest.fixture(scope="session")
+def conn(request, cfg):
+    d = cfg['database']
+    dbs = db.db(dbname=d['dbname'], host=str(d['host']), port=str(d['port']),
+                user=d['user'], password=d['pw'])
+
+    def disconnect():
+        dbs.close()
+    request.addfinalizer(disconnect)
+    return dbs
+
+
+@pytest.fixture(scope="session")
+def example_db(conn, cfg, scale, pc_dirs):
+    """The example data, loaded and partitioned into tiles"""
+    load_example_data(conn, cfg, scale=scale, pc_dirs=pc_dirs)
+    return conn
+
+
+@pytest.fixture(scope="session")
+def groups(example_db, cfg):
+    """The configurations of the tile groups: rest, border_ahn2, border_ahn3"""
+    return configure(example_db, cfg)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""Load the example data into the database for the benchmarks
+
+The example data is a single AHN tile (25gn1) that is split into 16 units.
+For measuring how the stages scale, :py:func:`replicate` copies the
+footprints, the tile indexes and the point cloud files N times next to the
+original tile.
+"""
+
+import os
+import copy
+import logging
+
+from psycopg2 import sql
+
+from bag3d.config import footprints
+from bag3d.config import batch3dfier
+from bag3d.config import border
+from bag3d.update import bag
+from bag3d.batch3dfier import fake3dfier
+
+logger = logging.getLogger(__name__)
+
+EXAMPLE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example_data')
+
+CENTROID_TABLE = "pand_centroid"
+CLIP_PREFIX = "_clip3dfy_"
+
+
+def pg_conn_str(database):
+    """OGR connection string of the database from the config"""
+    pg_conn = 'PG:"dbname={d} host={h} port={p} user={u}'.format(
+        d=database['dbname'], h=database['host'], p=database['port'],
+        u=database['user'])
+    if database.get('pw'):
+        pg_conn += ' password={pw}'.format(pw=database['pw'])
+    return pg_conn + '"'
+
+
+def load_example_data(conn, cfg, scale=1, pc_dirs=None):
+    """Import the example footprints and tile indexes, and partition the footprints
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    cfg : dict
+        bag3d configuration, as returned by :py:func:`bag3d.config.args.parse_config`
+    scale : int
+        Nr. of copies of the example tile, see :py:func:`replicate`
+    pc_dirs : list of str
+        Directories with the point cloud files, in the order of
+        input_elevation:dataset_dir. Required if scale > 1.
+    """
+    fprint = cfg['footprints']
+    polygons = cfg['tile_index']['polygons']
+    elevation = cfg['tile_index']['elevation']
+    database = cfg['database']
+    conn.sendQuery("CREATE EXTENSION IF NOT EXISTS postgis;")
+    for s in set([fprint['schema'], polygons['schema'], elevation['schema'],
+                  cfg['tile_schema'], cfg['output']['schema']]):
+        conn.sendQuery(sql.SQL("CREATE SCHEMA IF NOT EXISTS {};").format(
+            sql.Identifier(s)))
+
+    for idx,tbl,b in [('bag_index.geojson', polygons, True),
+                      ('ahn_index.geojson', elevation, False)]:
+        bag.load_index(conn, os.path.join(EXAMPLE_DIR, idx),
+                       tbl['schema'], tbl['table'],
+                       fields_index=[tbl['fields']['primary_key'],
+                                     tbl['fields']['geometry']],
+                       border=b)
+    command = ['ogr2ogr', '-f', 'PostgreSQL', pg_conn_str(database),
+               os.path.join(EXAMPLE_DIR, 'pandactueelbestaand.gpkg'),
+               '-a_srs', 'EPSG:28992', '-overwrite', '-dim', 'XY',
+               '-nlt', 'POLYGON',
+               '-nln', '%s.%s' % (fprint['schema'], fprint['table']),
+               '-lco', 'FID=ogc_fid',
+               '-lco', 'GEOMETRY_NAME=%s' % fprint['fields']['geometry']]
+    bag.run_subprocess(command, shell=True)
+
+    table_index = [polygons['schema'], polygons['table']]
+    fields_index = [polygons['fields']['primary_key'],
+                    polygons['fields']['geometry'],
+                    polygons['fields']['unit_name']]
+    if scale > 1:
+        replicate(conn, cfg, scale, pc_dirs)
+        # the copied units need their own border
+        footprints.update_tile_index(conn, table_index, fields_index)
+    # as after the tile index import of the app
+    border.update_adjacency_table(conn, cfg)
+
+    table_footprint = [fprint['schema'], fprint['table']]
+    # the same as footprints.partition, but with the centroid table name
+    # that the importer and the quality checks use
+    footprints.create_centroids(
+        conn,
+        table_centroid=[fprint['schema'], CENTROID_TABLE],
+        table_footprint=table_footprint,
+        fields_footprint=[fprint['fields']['primary_key'],
+                          fprint['fields']['geometry']])
+    footprints.create_views(
+        conn, schema_tiles=cfg['tile_schema'],
+        table_index=table_index,
+        fields_index=fields_index,
+        table_centroid=[fprint['schema'], CENTROID_TABLE],
+        fields_centroid=[fprint['fields']['primary_key'], "geom"],
+        table_footprint=table_footprint,
+        fields_footprint=[fprint['fields']['primary_key'],
+                          fprint['fields']['geometry'],
+                          fprint['fields']['uniqueid']],
+        prefix_tiles=cfg['prefix_tile_footprint'])
+    conn.sendQuery(sql.SQL("ANALYZE {}.{};").format(
+        sql.Identifier(fprint['schema']), sql.Identifier(fprint['table'])))
+
+
+def table_columns(conn, schema, table):
+    """The column names of a table"""
+    query = sql.SQL("""
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_schema = {schema} AND table_name = {table}
+    ORDER BY ordinal_position;
+    """).format(schema=sql.Literal(schema), table=sql.Literal(table))
+    return [r[0] for r in conn.getQuery(query)]
+
+
+def replicate(conn, cfg, n, pc_dirs):
+    """Copy the example tile n-1 times towards East
+
+    The footprints and the tile index units are translated by the width of
+    the example tile. The copied units get the suffix 'r<i>', and the point
+    cloud files are linked under the new unit names.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    cfg : dict
+        bag3d configuration
+    n : int
+        Nr. of copies, including the original, max. 99
+    pc_dirs : list of str
+        Directories with the point cloud files
+    """
+    if n > 99:
+        raise ValueError("Cannot replicate the example data more than 99 times")
+    fprint = cfg['footprints']
+    fp_schema = sql.Identifier(fprint['schema'])
+    fp_table = sql.Identifier(fprint['table'])
+    fp_geom = sql.Identifier(fprint['fields']['geometry'])
+    polygons = cfg['tile_index']['polygons']
+    elevation = cfg['tile_index']['elevation']
+
+    query = sql.SQL("""
+    SELECT ceil(st_xmax(e) - st_xmin(e))
+    FROM (SELECT st_extent({geom}) e FROM {schema}.{table}) a;
+    """).format(geom=sql.Identifier(polygons['fields']['geometry']),
+                schema=sql.Identifier(polygons['schema']),
+                table=sql.Identifier(polygons['table']))
+    width = conn.getQuery(query)[0][0]
+    fields = table_columns(conn, fprint['schema'], fprint['table'])
+    fields = [f for f in fields if f not in ['ogc_fid', 'gid', 'identificatie',
+                                              fprint['fields']['geometry']]]
+    gid_max = conn.getQuery(sql.SQL("SELECT max(gid) FROM {}.{};").format(
+        fp_schema, fp_table))[0][0]
+
+    for i in range(1, n):
+        logger.debug("Creating copy %s of the example tile", i)
+        dx = sql.Literal(float(width * i))
+        query = sql.SQL("""
+        INSERT INTO {schema}.{table} (gid, identificatie, {geom}, {fields})
+        SELECT
+            gid + {gid_offset},
+            left(identificatie, 6) ||
+                lpad((substr(identificatie, 7)::bigint + {id_offset})::text, 10, '0'),
+            st_translate({geom}, {dx}, 0),
+            {fields}
+        FROM {schema}.{table}
+        WHERE gid <= {gid_max};
+        """).format(schema=fp_schema, table=fp_table, geom=fp_geom,
+                    fields=sql.SQL(', ').join(sql.Identifier(f) for f in fields),
+                    gid_offset=sql.Literal(gid_max * i),
+                    id_offset=sql.Literal(100000000 * i),
+                    gid_max=sql.Literal(gid_max),
+                    dx=dx)
+        conn.sendQuery(query)
+        for idx in [polygons, elevation]:
+            cols = table_columns(conn, idx['schema'], idx['table'])
+            cols = [c for c in cols if c not in [idx['fields']['primary_key'],
+                                                 idx['fields']['geometry'],
+                                                 idx['fields']['unit_name']]]
+            query = sql.SQL("""
+            INSERT INTO {schema}.{table} ({unit}, {geom}{cols})
+            SELECT {unit} || {sfx}, st_translate({geom}, {dx}, 0){cols}
+            FROM {schema}.{table}
+            WHERE {unit} NOT LIKE '%r%';
+            """).format(schema=sql.Identifier(idx['schema']),
+                        table=sql.Identifier(idx['table']),
+                        unit=sql.Identifier(idx['fields']['unit_name']),
+                        geom=sql.Identifier(idx['fields']['geometry']),
+                        cols=sql.SQL('').join(sql.SQL(', ') + sql.Identifier(c)
+                                              for c in cols),
+                        sfx=sql.Literal('r%s' % i),
+                        dx=dx)
+            conn.sendQuery(query)
+        for d in pc_dirs:
+            for f in os.listdir(d):
+                base,ext = os.path.splitext(f)
+                if ext.lower() in ['.las', '.laz'] and 'r' not in base.split('_')[-1]:
+                    link = os.path.join(d, "%sr%s%s" % (base, i, ext))
+                    if not os.path.exists(link):
+                        os.symlink(os.path.join(d, f), link)
+
+
+def configure(conn, cfg):
+    """Tile configuration, as in the --run-3dfier stage of the app
+
+    Returns
+    -------
+    list of dict
+        The configurations of the tile groups, as returned by
+        :py:func:`bag3d.config.border.process`
+    """
+    c = batch3dfier.configure_tiles(conn, copy.deepcopy(cfg), CLIP_PREFIX)
+    border.create_border_table(conn, c)
+    ahn3_dir, ahn2_dir = c["input_elevation"]["dataset_dir"]
+    return border.process(conn, c, ahn3_dir, ahn2_dir, export=False)
+
+
+def write_fixture_csvs(conn, config):
+    """Write a 3dfier CSV-BUILDINGS-MULTIPLE output for each tile of a configuration
+
+    The heights are generated from the ID of the footprint by
+    :py:func:`bag3d.batch3dfier.fake3dfier.csv_row`, so the same footprint
+    gets the same heights in every run.
+
+    Parameters
+    ----------
+    conn : :py:class:`bag3d.config.db.db`
+        Open connection
+    config : dict
+        Configuration of a tile group, as returned by
+        :py:func:`bag3d.config.border.process`
+
+    Returns
+    -------
+    list of str
+        Paths of the CSV files
+    """
+    out_dir = config['output']['dir']
+    os.makedirs(out_dir, exist_ok=True)
+    for f in os.listdir(out_dir):
+        os.remove(os.path.join(out_dir, f))
+    uniqueid = sql.Identifier(config['input_polygons']['footprints']['fields']['uniqueid'])
+    schema = sql.Identifier(config['input_polygons']['user_schema'])
+    paths = []
+    for tile in config['input_polygons']['tile_list']:
+        query = sql.SQL("SELECT {uid} FROM {schema}.{tile};").format(
+            uid=uniqueid, schema=schema, tile=sql.Identifier(tile))
+        ids = [r[0] for r in conn.getQuery(query)]
+        path = os.path.join(out_dir, tile.replace(config['clip_prefix'], '', 1) + ".csv")
+        with open(path, 'w') as f:
+            f.write(fake3dfier.HEADER)
+            for i in ids:
+                f.write(fake3dfier.csv_row(i))
+        paths.append(path)
+    return paths
+
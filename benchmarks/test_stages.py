@@ -0,0 +1,96 @@
+"""Benchmarks of the stages of the 3D BAG process on the example data
+
+The tests depend on each other in the order they are defined, run the
+whole module.
+"""
+
+import os
+from shutil import rmtree
+
+import pytest
+
+from bag3d.config import batch3dfier
+from bag3d import importer
+from bag3d import exporter
+from bag3d import quality
+
+from data import configure, write_fixture_csvs
+
+GROUPS = ['rest', 'border_ahn2', 'border_ahn3']
+
+
+def test_configure_tiles(benchmark, example_db, cfg):
+    benchmark.pedantic(configure, args=(example_db, cfg), rounds=3)
+
+
+def test_pc_file_index(benchmark, cfg):
+    pc_name_map = batch3dfier.pc_name_dict(cfg["input_elevation"]["dataset_dir"],
+                                           cfg["input_elevation"]["dataset_name"])
+    idx = benchmark(batch3dfier.pc_file_index, pc_name_map)
+    assert len(idx) > 0
+
+
+@pytest.mark.parametrize("group", range(3), ids=GROUPS)
+def test_import_csv(benchmark, example_db, groups, group):
+    c = groups[group]
+
+    def setup():
+        write_fixture_csvs(example_db, c)
+
+    benchmark.pedantic(importer.import_csv, args=(example_db, c),
+                       setup=setup, rounds=3)
+
+
+def test_unite_border_tiles(benchmark, example_db, cfg, groups):
+    benchmark(importer.unite_border_tiles, example_db, cfg["output"]["schema"],
+              groups[1]["output"]["bag3d_table"],
+              groups[2]["output"]["bag3d_table"])
+
+
+def test_merge_border_csv(benchmark, example_db, groups):
+    def setup():
+        write_fixture_csvs(example_db, groups[1])
+        write_fixture_csvs(example_db, groups[2])
+
+    benchmark.pedantic(importer.merge_border_csv,
+                       args=(example_db, groups[1], groups[2]),
+                       setup=setup, rounds=3)
+
+
+@pytest.mark.parametrize("order", importer.SPATIAL_ORDERS,
+                         ids=[str(o) for o in importer.SPATIAL_ORDERS])
+def test_create_bag3d_table(benchmark, example_db, cfg, order):
+    benchmark.pedantic(importer.create_bag3d_table,
+                       args=(example_db, cfg["output"]["schema"],
+                             cfg["output"]["bag3d_table"]),
+                       kwargs={'order': order, 'brin': order is not None},
+                       rounds=3)
+
+
+def test_export_csv(benchmark, example_db, cfg, tmpdir):
+    benchmark.pedantic(exporter.csv, args=(example_db, cfg, str(tmpdir)),
+                       rounds=3)
+
+
+def test_export_gpkg(benchmark, example_db, cfg, tmpdir):
+    def setup():
+        # ogr2ogr does not overwrite the GeoPackage
+        rmtree(os.path.join(str(tmpdir), "gpkg"), ignore_errors=True)
+
+    benchmark.pedantic(exporter.gpkg, args=(example_db, cfg, str(tmpdir)),
+                       setup=setup, rounds=3)
+
+
+def test_export_postgis(benchmark, example_db, cfg, tmpdir):
+    benchmark.pedantic(exporter.postgis, args=(example_db, cfg, str(tmpdir)),
+                       rounds=3)
+
+
+def test_quality_counts(benchmark, example_db, cfg):
+    counts = benchmark(quality.get_counts, example_db, cfg)
+    assert counts[0]['total_cnt'] > 0
+
+
+def test_buildings_per_tile(benchmark, example_db, cfg):
+    quality.create_tile_quality_table(example_db)
+    benchmark(quality.buildings_per_tile, example_db, cfg)
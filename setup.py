@@ -37,7 +37,8 @@ setup(name='bag3d',
     python_requires='>=3',
     keywords='GIS 3DGIS CityGML LiDAR',
     entry_points={
-        'console_scripts': ['bag3d = bag3d.__main__:main']
+        'console_scripts': ['bag3d = bag3d.__main__:main',
+                            'bag3d-fake3dfier = bag3d.batch3dfier.fake3dfier:main']
     },
     include_package_data=True,
     zip_safe=False
@@ -1,5 +1,10 @@
+import os.path
 import cProfile
 import pstats
+
+import yaml
+
+import bag3d
 from bag3d import app
 
 def view_stats(fil):
@@ -9,10 +14,14 @@ def view_stats(fil):
     sorted_stats.print_stats()
 
 def runner():
-    app.main(["bag3d", "/home/bdukai/software/bag3d/bag3d_config.yml",
-                    "--run-3dfier", "--no-exec"])
+    here = os.path.abspath(os.path.dirname(bag3d.__file__))
+    with open(os.path.join(here, 'logging.cfg'), 'r') as f:
+        log_conf = yaml.safe_load(f)
+    app.app(["bag3d", "/home/bdukai/software/bag3d/bag3d_config.yml",
+             "--run-3dfier", "--no-exec"], here, log_conf)
 
 if __name__ == '__main__':
+    # For profiling the stages separately, run bag3d with --profile <dir>
     filename = 'profile_output_new'
     cProfile.run('runner()', filename)
     view_stats(filename)
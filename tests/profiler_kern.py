@@ -1,11 +1,19 @@
+import os.path
+
+import yaml
 from line_profiler import LineProfiler
+
+import bag3d
 from bag3d import app
 from bag3d.batch3dfier import process
 
 args = ["bag3d", "/home/bdukai/software/bag3d/bag3d_config.yml",
                     "--run-3dfier", "--no-exec"]
+here = os.path.abspath(os.path.dirname(bag3d.__file__))
+with open(os.path.join(here, 'logging.cfg'), 'r') as f:
+    log_conf = yaml.safe_load(f)
 lp = LineProfiler()
-lp.add_function(process.run)
-lp_wrapper = lp(app.main)
-lp_wrapper(args)
-lp.print_stats()
\ No newline at end of file
+lp.add_function(process.run_groups)
+lp_wrapper = lp(app.app)
+lp_wrapper(args, here, log_conf)
+lp.print_stats()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""Testing config.batch3dfier"""
+
+import os.path
+import struct
+
+import pytest
+import fiona
+
+from bag3d.config import batch3dfier
+from bag3d.batch3dfier import process
+
+
+class TestYmlCache():
+    """Testing the cache of the 3dfier configs"""
+    def test_yml_cache_path(self, tmpdir):
+        d = str(tmpdir)
+        p1 = batch3dfier.yml_cache_path(d, "t_25gn1_1", 
+                                        ["/b.laz", "/a.laz"], {3, 2})
+        p2 = batch3dfier.yml_cache_path(d, "t_25gn1_1", 
+                                        ["/a.laz", "/b.laz"], {2, 3})
+        p3 = batch3dfier.yml_cache_path(d, "t_25gn1_1", 
+                                        ["/a.laz"], {3})
+        assert p1 == p2
+        assert p1 != p3
+        assert os.path.basename(p1).startswith("t_25gn1_1_")
+    
+    def test_write_yml_atomic(self, tmpdir):
+        p = os.path.join(str(tmpdir), "t_25gn1_1.yml")
+        batch3dfier.write_yml_atomic("options: {}\n", p)
+        with open(p, "r") as f_in:
+            assert f_in.read() == "options: {}\n"
+        assert os.listdir(str(tmpdir)) == ["t_25gn1_1.yml"]
+
+
+class TestCrop():
+    """Testing the point cloud cropping"""
+    @pytest.fixture
+    def las(self, tmpdir):
+        header = bytearray(227)
+        header[:4] = b'LASF'
+        struct.pack_into('<4d', header, 179, 110.0, 100.0, 210.0, 200.0)
+        p = tmpdir.join("c_25gn1.laz")
+        p.write_binary(bytes(header))
+        return str(p)
+    
+    def test_las_bounds(self, las):
+        assert batch3dfier.las_bounds(las) == (100.0, 200.0, 110.0, 210.0)
+    
+    def test_crop_pointclouds(self, las, tmpdir):
+        d = str(tmpdir.join("crop"))
+        # the file is within the buffered bounds, no need to crop
+        assert batch3dfier.crop_pointclouds((101, 201, 109, 209), [las], d,
+                                            buffer=5, doexec=False) == [las]
+        out = batch3dfier.crop_pointclouds((101, 201, 105, 205), [las], d,
+                                           buffer=1, doexec=False)
+        assert out == [os.path.join(d, "c_25gn1.laz")]
+
+
+class TestTileCatalog():
+    """Testing the tile lookups from the tile catalog"""
+    @pytest.fixture
+    def catalog(self):
+        entry = {'view': 't_25gn1_1', 'footprint_cnt': 10,
+                 'bbox': (0.0, 0.0, 1.0, 1.0),
+                 'fields': ['gid', 'geovlak', 'identificatie', 'unit'],
+                 'geometry': 'geovlak'}
+        return {'tiles': {'25gn1_1': entry}, 'views': {'t_25gn1_1': entry}}
+    
+    def test_get_2Dtile_views(self, catalog):
+        assert batch3dfier.get_2Dtile_views(None, 'bag_tiles', 
+                                            ['25gn1_1', '25gn1_2'],
+                                            catalog) == ['t_25gn1_1']
+        assert batch3dfier.get_2Dtile_views(None, 'bag_tiles', ['25gn1_2'],
+                                            catalog) is None
+    
+    def test_get_view_fields(self, catalog):
+        fields = batch3dfier.get_view_fields(None, 'bag_tiles', ['t_25gn1_1'],
+                                             catalog)
+        assert fields == {'all': ['gid', 'geovlak', 'identificatie', 'unit'],
+                          'geometry': 'geovlak'}
+
+
+class TestFootprintSnapshot():
+    """Testing the footprint snapshot that 3dfier reads instead of the DB"""
+    def test_extract_footprints(self, batch3dfier_db, tmpdir):
+        tiles = ['t_25gn1_1', 't_25gn1_2']
+        d = str(tmpdir.join("rest"))
+        snapshot = batch3dfier.extract_footprints(
+            batch3dfier_db, 'bag_tiles', tiles, uniqueid='identificatie',
+            geometry='geovlak', out_dir=d, threads=2)
+        assert sorted(snapshot) == tiles
+        # no temporary files are left behind
+        assert sorted(os.listdir(d)) == [t + ".gpkg" for t in tiles]
+        for tile in tiles:
+            cnt = batch3dfier_db.getQuery(
+                "SELECT count(*) FROM bag_tiles.%s;" % tile)[0][0]
+            with fiona.open(snapshot[tile], layer=tile) as src:
+                assert len(src) == cnt
+                assert 'identificatie' in src.schema['properties']
+
+    def test_yamlr_snapshot(self):
+        config = batch3dfier.yamlr(dbname='bag', host='localhost', port=5432, 
+                                   user='me', pw='secret', 
+                                   schema_tiles='bag_tiles', 
+                                   bag_tile='t_25gn1_1', 
+                                   pc_path=['/ahn3/c_25gn1.laz'], 
+                                   uniqueid='identificatie', 
+                                   ahn_version=set([3]),
+                                   footprints='/snapshot/rest/t_25gn1_1.gpkg')
+        assert '"/snapshot/rest/t_25gn1_1.gpkg"' in config
+        assert 'PG:' not in config
+        assert 'secret' not in config
+
+    def test_finish_group(self, tmpdir):
+        d = tmpdir.mkdir("rest")
+        d.join("t_25gn1_1.gpkg").write("")
+        group = {'tile_group': 'rest', 'tiles': ['t_25gn1_1'],
+                 'config': {'clip_prefix': '_clip3dfy_', 'tile_out': None,
+                            'input_polygons': {'user_schema': 'bag_tiles'}},
+                 'snapshot_dir': str(d)}
+        assert process.finish_group(None, group, []) == set()
+        assert not d.check()
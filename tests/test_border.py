@@ -78,4 +78,14 @@ class TestBorder():
             border.update_file_date(conn, cfg, 
                                     cfg["input_elevation"]["dataset_dir"][1], 
                                     cfg["input_elevation"]["dataset_name"][1], 
-                                    doexec=False)
\ No newline at end of file
+                                    doexec=False)
+
+    def test_update_adjacency_table(self, caplog, conn, cfg):
+        with caplog.at_level(logging.DEBUG):
+            border.update_adjacency_table(conn, cfg, doexec=False)
+
+    def test_get_adjacency_table(self):
+        c = {"tile_index": {"elevation": {"table": "ahn_index"}}}
+        assert border.get_adjacency_table(c) == "ahn_index_adjacency"
+        c["tile_index"]["elevation"]["adjacency_table"] = "ahn_adj"
+        assert border.get_adjacency_table(c) == "ahn_adj"
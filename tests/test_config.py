@@ -92,6 +92,29 @@ class TestDB():
         with pytest.raises(BaseException):
             # invalid password
             db.db(dbname='batch3dfier_db', host='localhost', port=5432, user='batch3dfier', password='invalid')
+    
+    def test_fingerprint(self):
+        """Queries that differ only in literals have the same fingerprint"""
+        q1 = """SELECT "ahn_version" FROM "tile_index"."ahn_index"
+                WHERE "unit" = '37hn1' AND "gid" IN (1, 2, 3);"""
+        q2 = """SELECT "ahn_version" FROM "tile_index"."ahn_index" WHERE "unit" = '25dn2' AND "gid" IN (4);"""
+        assert db.fingerprint(q1) == db.fingerprint(q2)
+        assert db.fingerprint('SELECT * FROM "t_37hn1";') == \
+            db.fingerprint('SELECT * FROM "t_25dn2";')
+    
+    def test_execute_batch(self, batch3dfier_db):
+        """The statements are run in batches over several connections"""
+        batch3dfier_db.sendQuery("CREATE SCHEMA IF NOT EXISTS test_batch;")
+        try:
+            queries = ["CREATE OR REPLACE VIEW test_batch.v%s AS SELECT %s AS a" % (i, i)
+                       for i in range(5)]
+            assert batch3dfier_db.execute_batch(queries, batch_size=2,
+                                                connections=2) == 3
+            r = batch3dfier_db.getQuery(
+                "SELECT count(*) FROM pg_views WHERE schemaname = 'test_batch';")
+            assert r[0][0] == 5
+        finally:
+            batch3dfier_db.sendQuery("DROP SCHEMA test_batch CASCADE;")
 
 #     def test_create_empty(self, empty_db):
 #         dbname=empty_db['dbname']
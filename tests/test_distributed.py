@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""Testing batch3dfier.distributed with multiple local worker processes"""
+
+import os
+from multiprocessing import Pool
+
+import pytest
+
+from bag3d.config import db
+from bag3d.batch3dfier import distributed
+
+DBS = {'dbname': 'batch3dfier_db', 'host': 'localhost', 'port': '5432',
+       'user': 'batch3dfier'}
+
+
+def claim_all(worker):
+    """Claim tiles until the queue is empty, as a worker process would"""
+    conn = db.db(**DBS)
+    claimed = []
+    try:
+        while True:
+            c = distributed.claim_tile(conn, worker)
+            if c is None:
+                break
+            claimed.append(c[1])
+            distributed.complete_tile(conn, c[0], c[1], worker, None,
+                                      max_attempts=1)
+    finally:
+        conn.close()
+    return claimed
+
+
+def fake_lift(conn, config, tile, worker, pc_file_idx, tile_group, yml_dir,
+              output_dir, doexec=True):
+    """Write a one-line CSV instead of running 3dfier"""
+    out_path = os.path.join(output_dir, tile + ".csv")
+    with open(out_path, "w") as f_out:
+        f_out.write("id,tile\n1,%s\n" % tile)
+    return {'out_path': out_path, 'stats': {}}
+
+
+def fake_worker(worker):
+    """Run a worker loop with fake_lift, as a worker process would"""
+    distributed.process.lift_tile = fake_lift
+    distributed.batch3dfier.pc_name_dict = lambda *args: {}
+    distributed.batch3dfier.pc_file_index = lambda *args: {}
+    conn = db.db(**DBS)
+    try:
+        return distributed.worker_loop(conn, worker, poll=1, stale_after=60)
+    finally:
+        conn.close()
+
+
+def group_config(tmpdir, group, tiles):
+    out_dir = tmpdir.mkdir(group)
+    return {"config": {"in": "bag3d_cfg_%s.yml" % group},
+            "input_elevation": {"dataset_dir": [], "dataset_name": []},
+            "input_polygons": {"tile_list": tiles, "user_schema": "tile_index"},
+            "clip_prefix": "_clip3dfy_",
+            "tile_out": None,
+            "output": {"dir": str(out_dir)}}
+
+
+@pytest.fixture(scope='module')
+def queue(batch3dfier_db):
+    distributed.create_queue_tables(batch3dfier_db)
+    tiles = ["t_%s" % i for i in range(200)]
+    config = {"input_polygons": {"tile_list": tiles}}
+    distributed.enqueue(batch3dfier_db, config, "test_group")
+    yield tiles
+    batch3dfier_db.sendQuery(
+        "DELETE FROM public.bag3d_tile_queue_config WHERE tile_group = 'test_group';")
+
+
+class TestDistributed():
+    def test_claim_skip_locked(self, batch3dfier_db, queue):
+        """Every tile is claimed exactly once by the concurrent workers"""
+        with Pool(4) as p:
+            res = p.map(claim_all, ["worker-%s" % i for i in range(4)])
+        claimed = [t for r in res for t in r]
+        assert len(claimed) == len(queue)
+        assert set(claimed) == set(queue)
+        status = distributed.get_status(batch3dfier_db, "test_group")
+        assert status == {'failed': len(queue)}
+
+    def test_coordinator_groups(self, batch3dfier_db, tmpdir):
+        """The workers stay alive until the run is finished, over several 
+        tile groups and a restart"""
+        configs = [group_config(tmpdir, "testrest", ["a_%s" % i for i in range(20)]),
+                   group_config(tmpdir, "testborder", ["b_%s" % i for i in range(5)])]
+        distributed.create_queue_tables(batch3dfier_db)
+        distributed.start_run(batch3dfier_db)
+        try:
+            with Pool(2) as p:
+                counts = p.map_async(fake_worker, ["worker-a", "worker-b"])
+                res = distributed.run_coordinator(batch3dfier_db, configs, 
+                                                  poll=1, stale_after=60)
+                assert res == {"testrest": set(), "testborder": set()}
+                # the failed tiles are queued again after the first groups 
+                # are done, as in the restart loop of the app
+                configs[1]["input_polygons"]["tile_list"] = ["b_0", "b_1"]
+                res = distributed.run_coordinator(batch3dfier_db, configs[1:], 
+                                                  poll=1, stale_after=60)
+                assert res == {"testborder": set()}
+                distributed.finish_run(batch3dfier_db)
+                assert sum(counts.get(timeout=120)) == 27
+        finally:
+            distributed.finish_run(batch3dfier_db)
+            batch3dfier_db.sendQuery("""
+            DELETE FROM public.bag3d_tile_queue_config 
+            WHERE tile_group IN ('testrest', 'testborder');""")
+        assert len(tmpdir.join("testrest").listdir()) == 20
+        assert len(tmpdir.join("testborder").listdir()) == 5
+
+    def test_worker_loop_lift_error(self, monkeypatch):
+        """A tile that raises is put back into the queue and the loop goes on"""
+        claims = [("test_group", "t_1"), ("test_group", "t_2"), None]
+        completed = []
+
+        class Conn():
+            class conn():
+                @staticmethod
+                def rollback():
+                    pass
+
+        def lift_tile(*args, **kwargs):
+            raise RuntimeError("3dfier crashed")
+
+        monkeypatch.setattr(distributed, "claim_tile",
+                            lambda *args: claims.pop(0))
+        monkeypatch.setattr(distributed, "get_status", lambda *args: {})
+        monkeypatch.setattr(distributed, "run_active", lambda *args: False)
+        monkeypatch.setattr(distributed, "get_group_config",
+                            lambda *args: {"input_elevation": {
+                                "dataset_dir": [], "dataset_name": []}})
+        monkeypatch.setattr(distributed.batch3dfier, "pc_name_dict",
+                            lambda *args: {})
+        monkeypatch.setattr(distributed.batch3dfier, "pc_file_index",
+                            lambda *args: {})
+        monkeypatch.setattr(distributed.process, "lift_tile", lift_tile)
+        monkeypatch.setattr(distributed, "complete_tile",
+                            lambda conn, g, t, w, out: completed.append((t, out)))
+        assert distributed.worker_loop(Conn(), "worker-1") == 0
+        assert completed == [("t_1", None), ("t_2", None)]
+
+    def test_shared_config(self):
+        config = {"database": {"dbname": "bag", "user": "me", "pw": "secret"},
+                  "input_polygons": {"tile_list": ["t_1"]}}
+        shared = distributed.shared_config(config)
+        assert "database" not in shared
+        assert "secret" not in distributed._dumps(shared)
+        assert config["database"]["pw"] == "secret"
@@ -0,0 +1,53 @@
+import os.path
+
+import pytest
+import fiona
+from fiona.crs import from_epsg
+
+from bag3d.config import batch3dfier
+from bag3d.batch3dfier import fake3dfier
+
+
+@pytest.fixture(scope='module')
+def tile_config(tmpdir_factory):
+    d = tmpdir_factory.mktemp("fake3dfier")
+    gpkg = str(d.join("t_25gn1_1.gpkg"))
+    schema = {'geometry': 'Polygon', 'properties': {'identificatie': 'str'}}
+    with fiona.open(gpkg, 'w', driver='GPKG', schema=schema,
+                    crs=from_epsg(28992)) as dst:
+        for i in range(10):
+            dst.write({'geometry': {'type': 'Polygon',
+                                    'coordinates': [[(i, 0), (i+1, 0), (i+1, 1), (i, 1), (i, 0)]]},
+                       'properties': {'identificatie': '03631000%08d' % i}})
+    laz = d.join("unit_25gn1_1.laz")
+    laz.write_binary(b'')
+    config = batch3dfier.yamlr(dbname=None, host=None, port=None, user=None,
+                               pw=None, schema_tiles=None, bag_tile='t_25gn1_1',
+                               pc_path=[str(laz)], uniqueid='identificatie',
+                               ahn_version=set([3]), footprints=gpkg)
+    yml = d.join("t_25gn1_1.yml")
+    yml.write(config)
+    yield str(yml), str(d.join("t_25gn1_1.csv"))
+
+
+class TestFake3dfier():
+    """Testing the 3dfier stand-in"""
+    def test_run(self, tile_config):
+        yml, out = tile_config
+        assert fake3dfier.run(yml, out) == 0
+        with open(out, 'r') as f:
+            lines = f.readlines()
+        assert len(lines) == 11
+        # 3dfier writes a trailing comma, the importer expects 27 fields
+        assert all(len(l.split(',')) == 27 for l in lines)
+
+    def test_fail_rate(self, tile_config, monkeypatch):
+        monkeypatch.setenv("BAG3D_FAKE3DFIER_FAIL_RATE", "1")
+        yml, out = tile_config
+        assert fake3dfier.run(yml, out) == 1
+
+    def test_csv_row(self):
+        assert fake3dfier.csv_row('1') == fake3dfier.csv_row('1')
+        row = fake3dfier.csv_row('1', nodata_rate=1).split(',')
+        assert row[7] == fake3dfier.NODATA
+        assert row[25] == '0'
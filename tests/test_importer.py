@@ -1,3 +1,81 @@
 # -*- coding: utf-8 -*-
 
-"""Module description"""
\ No newline at end of file
+"""Module description"""
+
+import struct
+from datetime import datetime, timezone
+
+import pytest
+
+from bag3d import importer
+from bag3d.batch3dfier import fake3dfier
+
+
+class TestCSV():
+    """Testing the preparation of the 3dfier output for COPY"""
+    def test_csv_records(self, tmpdir):
+        p = tmpdir.join("t_25gn1_1.csv")
+        p.write(fake3dfier.HEADER + fake3dfier.csv_row('1') + fake3dfier.csv_row('2'))
+        records = importer.csv_records(str(p), "2018-01-01T00:00:00", 3, "25gn1_1")
+        lines = records.read().splitlines()
+        assert len(lines) == 2
+        fields = lines[0].split(',')
+        # 26 fields of 3dfier and the ahn_file_date, ahn_version, tile_id
+        assert len(fields) == 29
+        assert fields[0] == '1'
+        assert fields[-3:] == ["2018-01-01T00:00:00", "3", "25gn1_1"]
+
+
+class TestBinaryCopy():
+    """Testing the binary COPY format of the 3dfier output"""
+    @pytest.fixture
+    def csv(self, tmpdir):
+        p = tmpdir.join("t_25gn1_1.csv")
+        p.write(fake3dfier.HEADER + fake3dfier.csv_row('1') + 
+                fake3dfier.csv_row('2', nodata_rate=1))
+        return p
+    
+    def test_csv_binary(self, csv):
+        d = datetime(2018, 1, 1, tzinfo=timezone.utc)
+        b = importer.csv_binary(str(csv), d, 3, "25gn1_1").read()
+        assert b.startswith(b'PGCOPY\n\xff\r\n\x00')
+        assert b.endswith(struct.pack('!h', -1))
+        # the first tuple: nr. of fields and the id
+        assert struct.unpack_from('!h', b, 19)[0] == 29
+        assert struct.unpack_from('!i1s', b, 21) == (1, b'1')
+        # the roof heights of the second building are NULL
+        assert b.count(struct.pack('!i', -1)) >= 16
+        # the ahn_file_date as microseconds since 2000-01-01
+        us = (d - importer.PG_EPOCH).days * 86400 * 1000000
+        assert struct.pack('!iq', 8, us) + struct.pack('!ih', 2, 3) in b
+    
+    def test_csv_binary_malformed(self, csv):
+        csv.write("1,2,3\n", mode='a')
+        with pytest.raises(ValueError) as e:
+            importer.csv_binary(str(csv), None, None, "25gn1_1")
+        assert "Tile 25gn1_1, line 4" in str(e.value)
+        row = fake3dfier.csv_row('3').split(',')
+        row[5] = 'x'
+        csv.write(fake3dfier.HEADER + ','.join(row))
+        with pytest.raises(ValueError):
+            importer.csv_binary(str(csv), None, None, "25gn1_1")
+
+
+def test_compact_name():
+    names = [importer.compact_name(f) for f in importer.HEIGHT_FIELDS + importer.RMSE_FIELDS]
+    assert names[0] == "ground_000"
+    assert "roof_050" in names and "rmse_099" in names
+    assert len(set(names)) == 22
+
+
+def test_spatial_order():
+    with pytest.raises(ValueError):
+        importer.spatial_order('hilbert')
+    assert importer.spatial_order('geohash').string.startswith("ORDER BY")
+    assert importer.spatial_order(None).string == ""
+
+
+def test_merged_border_name():
+    assert importer.merged_border_name("bag3d_border_ahn3") == "bag3d_border"
+    assert importer.merged_border_name("heights_ahn3_border_ahn3") == \
+        "heights_ahn3_border"
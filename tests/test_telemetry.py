@@ -0,0 +1,64 @@
+import json
+import struct
+
+import pytest
+
+from bag3d import telemetry
+
+
+@pytest.fixture(scope='module')
+def records():
+    recs = []
+    for i in range(10):
+        recs.append({'event': 'tile', 'time': '2018-06-01T10:00:%02d.000000' % (i * 5),
+                     'group': 'rest', 'tile': 't%s' % i, 'wall_time': 10.0,
+                     'cpu_time': 9.0, 'peak_rss': 1000, 'queue_wait': 1.0,
+                     'yml_time': 0.1, 'points': 100, 'output_rows': 10,
+                     'success': True})
+    recs[-1]['wall_time'] = 100.0
+    recs[0]['success'] = False
+    recs.append({'event': 'import', 'time': '2018-06-01T10:01:00.000000',
+                 'group': 'rest', 'tile': 't1', 'rows': 10, 'import_time': 2.0})
+    yield recs
+
+
+class TestTelemetry():
+    """Testing the telemetry module"""
+    def test_las_point_count(self, tmpdir):
+        header = bytearray(227)
+        header[0:4] = b'LASF'
+        header[24] = 1
+        header[25] = 2
+        struct.pack_into('<I', header, 107, 1234)
+        p = tmpdir.join("test.las")
+        p.write_binary(bytes(header))
+        assert telemetry.las_point_count(str(p)) == 1234
+        p.write_binary(b'not a las file')
+        assert telemetry.las_point_count(str(p)) is None
+
+    def test_read_records(self, tmpdir, records):
+        p = tmpdir.join("telemetry.jsonl")
+        p.write("\n".join(json.dumps(r) for r in records) + "\nmalformed\n")
+        assert len(telemetry.read_records(str(p))) == 11
+        assert len(telemetry.read_records(str(p), event='import')) == 1
+
+    def test_summarize(self, records):
+        s = telemetry.summarize(records)['rest']
+        assert s['tiles'] == 10
+        assert s['failed'] == 1
+        assert s['stragglers'] == [('t9', 100.0)]
+        assert s['wall_time'][50] == 10.0
+        assert s['import_time'][50] == 2.0
+        assert telemetry.format_report({'rest': s})
+
+    def test_summarize_whole_seconds(self, records):
+        # datetime.isoformat() omits the microseconds when they are 0
+        recs = [dict(r, time=r['time'].replace('.000000', '')) for r in records]
+        s = telemetry.summarize(recs)['rest']
+        assert s['span'] == telemetry.summarize(records)['rest']['span']
+
+    def test_stage(self, tmpdir):
+        with telemetry.stage('test', profile_dir=str(tmpdir)):
+            telemetry.add_time('db', 1.0)
+        assert tmpdir.join('test.pstats').check()
+        assert telemetry.get_times()['db'] >= 1.0
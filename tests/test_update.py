@@ -1,10 +1,14 @@
 from datetime import date
 import os.path
+import subprocess
+import zipfile
 
 import pytest
 import logging
 
 from bag3d.update import bag
+from bag3d.update import ahn
+from bag3d.config import batch3dfier
 
 @pytest.fixture('module')
 def bag_url():
@@ -47,4 +51,117 @@ class TestBAG():
                              'tile_index', 
                              'localhost', 
                              '5432', 
-                             'batch3dfier', doexec)
\ No newline at end of file
+                             'batch3dfier', doexec)
+
+    def test_ewkb_hex(self):
+        g = {'type': 'Polygon', 'coordinates': [[(0, 0), (1, 0), (1, 1), (0, 0)]]}
+        h = bag.ewkb_hex(g)
+        # little endian, polygon with SRID flag, EPSG:28992
+        assert h.startswith('01' + '03000020' + '40710000')
+        assert len(bytes.fromhex(h)) == 1 + 4 + 4 + 4 + 4 + 4 * 16
+        m = bag.ewkb_hex({'type': 'MultiPolygon', 'coordinates': [g['coordinates']]})
+        assert m.startswith('01' + '06000020')
+        with pytest.raises(ValueError):
+            bag.ewkb_hex({'type': 'Point', 'coordinates': (0, 0)})
+    
+    def test_border_line(self):
+        l = bag.border_line((0, 0, 2, 1))
+        assert l['coordinates'] == [(2, 0), (0, 0), (0, 1)]
+    
+    def test_split_toc(self):
+        toc = [";",
+               "; Archive created at 2018-06-01",
+               "3; 2615 16386 SCHEMA - bagactueel postgres",
+               "210; 1259 16390 TABLE bagactueel adres postgres",
+               "4321; 0 16390 TABLE DATA bagactueel adres postgres",
+               "4322; 0 16395 TABLE DATA bagactueel pand postgres",
+               "4323; 0 0 SEQUENCE SET bagactueel pand_gid_seq postgres",
+               "5001; 2606 17001 CONSTRAINT bagactueel pand pand_pkey postgres",
+               "5002; 1259 17002 INDEX bagactueel pand_geom_idx postgres",
+               "5003; 2606 17003 FK CONSTRAINT bagactueel adres adres_pand_fk postgres"]
+        data, indexes, rest = bag.split_toc(toc, 2)
+        assert len(data) == 2
+        assert sum(len(l) for l in data) == 3
+        assert len(indexes) == 2
+        assert rest == [toc[2], toc[3], toc[9]]
+
+    def test_filter_toc(self):
+        toc = [";",
+               "3; 2615 16386 SCHEMA - bagactueel postgres",
+               "4; 2615 2200 SCHEMA - public postgres",
+               "5; 0 0 COMMENT - SCHEMA bagactueel postgres",
+               "6; 0 0 COMMENT - SCHEMA public postgres",
+               "7; 3079 16387 EXTENSION - postgis ",
+               "210; 1259 16390 TABLE bagactueel adres postgres",
+               "4321; 0 16390 TABLE DATA bagactueel adres postgres",
+               "4322; 0 16395 TABLE DATA public spatial_ref_sys postgres",
+               "5001; 2606 17001 CONSTRAINT bagactueel pand pand_pkey postgres",
+               "5002; 2606 17002 FK CONSTRAINT bagactueel verblijfsobject fk_pand postgres",
+               "5003; 0 0 SEQUENCE SET bagactueel pand_seq postgres",
+               "5004; 1259 17003 TABLE bagactueel_old adres postgres",
+               "5005; 2615 17004 SCHEMA - bagactueel_old postgres"]
+        assert bag.filter_toc(toc, 'bagactueel') == [toc[1], toc[3], toc[6],
+                                                     toc[7], toc[9], toc[10],
+                                                     toc[11]]
+        assert bag.filter_toc(toc, 'public') == [toc[2], toc[4], toc[8]]
+
+    def test_pipefail(self):
+        ok = bag.pipefail(["echo 'bagactueel.pand'", "sed 's/bag/b/'", "cat"])
+        assert subprocess.run(" ".join(ok), shell=True).returncode == 0
+        failed = bag.pipefail(["false", "cat"])
+        assert subprocess.run(" ".join(failed), shell=True).returncode != 0
+
+
+class TestAHN():
+    """Testing the AHN module"""
+    def test_index_pointclouds(self, tmpdir):
+        laz = tmpdir.join("c_25gn1.laz")
+        laz.write_binary(b'')
+        assert not batch3dfier.has_index(str(laz))
+        lax = tmpdir.join("c_25gn1.lax")
+        lax.write_binary(b'')
+        os.utime(str(laz), (0, 0))
+        assert batch3dfier.has_index(str(laz))
+        assert ahn.index_pointclouds('lasindex', [[str(tmpdir)]], 
+                                     doexec=False) == []
+
+    def test_extract_raster(self, tmpdir):
+        zip_path = str(tmpdir.join("tile.zip"))
+        with zipfile.ZipFile(zip_path, 'w') as z:
+            z.writestr("R_37HN1.TIF", b'raster')
+        tmp, name = ahn.extract_raster(zip_path, str(tmpdir))
+        assert name == "r_37hn1.tif"
+        with open(tmp, 'rb') as f:
+            assert f.read() == b'raster'
+    
+    def test_raster_catalog(self, tmpdir):
+        assert ahn.read_catalog(str(tmpdir)) == {}
+        catalog = {'37hn1': {'path': str(tmpdir.join("r_37hn1.tif"))}}
+        ahn.write_catalog(str(tmpdir), catalog)
+        assert ahn.read_catalog(str(tmpdir)) == catalog
+        assert ahn.downloader(['37HN1'], "{}", str(tmpdir), doexec=False) == []
+
+    def test_fetch_raster_cog(self, tmpdir, monkeypatch):
+        def download(command, shell=False, doexec=True):
+            with zipfile.ZipFile(command[-1], 'w') as z:
+                z.writestr("R_37HN1.TIF", b'raster')
+            return True
+
+        def to_cog_failed(src, dst, path_gdal_translate, doexec):
+            with open(dst, 'wb') as f:
+                f.write(b'partial')
+            return False
+
+        def to_cog(src, dst, path_gdal_translate, doexec):
+            with open(dst, 'wb') as f:
+                f.write(b'cog')
+            return True
+
+        monkeypatch.setattr(ahn.bag, "run_subprocess", download)
+        monkeypatch.setattr(ahn, "to_cog", to_cog_failed)
+        assert ahn.fetch_raster('37HN1', "url", str(tmpdir)) is None
+        assert tmpdir.listdir() == []
+        monkeypatch.setattr(ahn, "to_cog", to_cog)
+        entry = ahn.fetch_raster('37HN1', "url", str(tmpdir))
+        assert entry['path'] == str(tmpdir.join("r_37hn1.tif"))
+        assert [p.basename for p in tmpdir.listdir()] == ["r_37hn1.tif"]